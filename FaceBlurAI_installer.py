@@ -37,7 +37,11 @@ packages = [
     "seaborn",
     "tqdm",
     "ultralytics-thop",
-    "omegaconf"
+    "omegaconf",
+    # Faster CPU inference (backend = onnx or openvino in config.ini)
+    "onnx",
+    "onnxruntime",
+    "openvino"
 ]
 
 # Special cases with custom index URL
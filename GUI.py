@@ -11,12 +11,17 @@
 import tkinter as tk
 from tkinter import filedialog
 import configparser
-import subprocess  # Add this import
 import tkinter as tk
 from tkinter import font as tkfont
 from tkinter import StringVar
 from PIL import Image, ImageTk  # Add this import
 from tkinter import ttk  # Add this import for the dropdown menu
+import os
+import queue
+import threading
+
+from backends import quantized_model_name
+from runtime_estimate import format_duration, format_progress
 
 #### GUI FOR THE FACEBLUR AI PROGRAM ####
 
@@ -102,9 +107,172 @@ def save_config():
         config.write(configfile)
 
 
-def start_other_script():  
-    subprocess.Popen(['python', 'working.py'])  # Replace 'working.py' with your file name
-    root.destroy()  # Close the config editor GUI
+#### JOB RUNNER ####
+
+# The video is blurred in a worker thread (or in the daemon), so the window keeps responding.
+# The worker only puts (kind, value) messages in job_events, the Tk loop reads them every POLL_MS.
+POLL_MS = 100
+job_events = queue.Queue()
+job_thread = None
+cancel_event = threading.Event()
+
+
+def run_job(cancel_event):
+    """Blur the video with the settings in config.ini and report to job_events. Runs in the worker thread."""
+    try:
+        job_events.put(('status', "Loading the model and the video..."))
+        # Imported here, loading the model libraries would keep the window from opening
+        from working import PREVIEW_WIDTH, load_config, preview_thumbnail, process_video
+        options = load_config('config.ini')
+        workers = options.pop('workers')
+        threads_per_worker = options.pop('threads_per_worker')
+        report_progress = lambda progress: job_events.put(('progress', progress))
+
+        def report_preview(frame):
+            # Shrunk here, so the Tk thread only shows it (the daemon already sends a thumbnail)
+            if frame.shape[1] > PREVIEW_WIDTH:
+                frame = preview_thumbnail(frame)
+            job_events.put(('preview', frame))
+
+        if options.pop('daemon'):
+            import daemon
+            job_events.put(('status', "Starting the daemon and loading the model..."))
+            daemon.start_daemon('config.ini')
+            if workers > 1:
+                job_events.put(('segments', workers))
+            result = daemon.submit_job(options, cancel_event=cancel_event, on_progress=report_progress,
+                                       on_preview=report_preview, workers=workers,
+                                       threads_per_worker=threads_per_worker)
+        elif workers > 1:
+            # The segments report their progress in the console only
+            from segments import process_video_parallel
+            job_events.put(('segments', workers))
+            result = process_video_parallel(workers=workers, threads_per_worker=threads_per_worker,
+                                            cancel_event=cancel_event, **options)
+        else:
+            result = process_video(cancel_event=cancel_event, progress_callback=report_progress,
+                                   preview_callback=report_preview, **options)
+    except Exception as e:
+        job_events.put(('error', e))
+    else:
+        job_events.put(('done', result))
+
+
+def start_other_script():
+    global job_thread, cancel_event
+    if job_thread is not None and job_thread.is_alive():
+        return  # One video at a time
+    # The job runs with the saved settings, which can differ from what the window shows
+    saved_config = configparser.ConfigParser()
+    saved_config.read('config.ini')
+    open_job_window(os.path.basename(saved_config['VideoSettings']['input_path']))
+    start_button.configure(state=tk.DISABLED)
+    cancel_event = threading.Event()
+    job_thread = threading.Thread(target=run_job, args=(cancel_event,), daemon=True)
+    job_thread.start()
+    root.after(POLL_MS, poll_job)
+
+
+def open_job_window(video_name):
+    global job_window, job_progress, job_status_var, job_stats_var, preview_label, cancel_button
+    job_window = tk.Toplevel(root)
+    job_window.title(f"Blurring {video_name}")
+    job_window.geometry("420x400")
+    job_window.configure(bg=bg_color)
+    job_window.protocol("WM_DELETE_WINDOW", cancel_job)  # Closing the window stops the run first
+
+    job_progress = ttk.Progressbar(job_window, length=380, maximum=100)
+    job_progress.pack(pady=(20, 5))
+    job_status_var = tk.StringVar(value="Starting...")
+    tk.Label(job_window, textvariable=job_status_var, bg=bg_color, fg=fg_color, wraplength=380).pack()
+    job_stats_var = tk.StringVar()
+    tk.Label(job_window, textvariable=job_stats_var, bg=bg_color, fg=fg_color).pack()
+    preview_label = tk.Label(job_window, bg=bg_color)
+    preview_label.pack(pady=10)
+    cancel_button = tk.Button(job_window, text="Stop and keep output", command=cancel_job, bg=button_bg, fg=button_fg)
+    cancel_button.pack(side=tk.BOTTOM, pady=15)
+
+
+def cancel_job():
+    if job_thread is None or not job_thread.is_alive():
+        job_window.destroy()
+        return
+    # The pipeline stops after the current batch and finishes the file with what is blurred so far
+    cancel_event.set()
+    job_status_var.set("Stopping, the frames blurred so far are kept...")
+    cancel_button.configure(state=tk.DISABLED)
+
+
+def poll_job():
+    """Show what the worker thread reported since the last call, and check again in POLL_MS while it runs."""
+    preview = None
+    while True:
+        try:
+            kind, value = job_events.get_nowait()
+        except queue.Empty:
+            break
+        if kind == 'progress':
+            show_progress(value)
+        elif kind == 'preview':
+            preview = value  # Only the newest preview is shown
+        elif kind == 'status':
+            job_status_var.set(value)
+        elif kind == 'segments':
+            job_status_var.set(f"Blurring in {value} segments, the progress is shown in the console...")
+            job_progress.configure(mode='indeterminate')
+            job_progress.start()
+        elif kind == 'done':
+            show_result(value)
+        elif kind == 'error':
+            show_job_end(f"Error: {value}")
+    if preview is not None:
+        show_preview(preview)
+    if job_thread.is_alive() or not job_events.empty():
+        root.after(POLL_MS, poll_job)
+
+
+def show_progress(progress):
+    if progress['total_frames']:
+        job_progress['value'] = progress['frames_processed'] * 100 / progress['total_frames']
+    if not cancel_event.is_set():
+        job_status_var.set(format_progress(progress))
+    job_stats_var.set(f"{progress['boxes_per_frame']:.1f} boxes per frame")
+
+
+def show_preview(frame):
+    import cv2  # Only needed once a job runs, so the window opens without loading it
+    image = ImageTk.PhotoImage(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+    preview_label.configure(image=image)
+    preview_label.image = image  # Keep a reference
+
+
+def show_result(result):
+    if result.output_path is None:
+        show_job_end("Stopped before blurring started.")
+    elif result.cancelled:
+        show_job_end(f"Stopped after {result.frames_processed} of {result.total_frames} frames, they are saved "
+                     f"in {os.path.basename(result.audio_output_path or result.output_path)}")
+    else:
+        job_progress['value'] = 100
+        show_job_end(f"Finished in {format_duration(result.elapsed_time)} ({result.fps:.1f} fps), saved as "
+                     f"{os.path.basename(result.audio_output_path or result.output_path)}")
+
+
+def show_job_end(message):
+    job_progress.stop()
+    job_progress.configure(mode='determinate')
+    job_status_var.set(message)
+    cancel_button.configure(text="Close", command=job_window.destroy, state=tk.NORMAL)
+    start_button.configure(state=tk.NORMAL)
+
+
+def close_gui():
+    # A running job is stopped first, so its output file is finished properly
+    if job_thread is not None and job_thread.is_alive():
+        cancel_job()
+        root.after(POLL_MS, close_gui)
+        return
+    root.destroy()
 
 # Load config file
 config = configparser.ConfigParser()
@@ -226,6 +394,11 @@ model_mapping = {
     "Person Accurate": "yolov8s.pt"
 }
 
+# Offer the INT8 models made by quantize.py as well
+for display_name, model_file in list(model_mapping.items()):
+    if os.path.isdir(quantized_model_name(model_file)):
+        model_mapping[f"{display_name} (INT8)"] = quantized_model_name(model_file)
+
 # Get the display names (keys of the dictionary) for the dropdown
 model_display_names = list(model_mapping.keys())
 
@@ -291,4 +464,5 @@ def browse_file():
     input_path_entry.delete(0, tk.END)  # Clear the current entry
     input_path_entry.insert(0, file_path)  # Insert the selected file path
 
+root.protocol("WM_DELETE_WINDOW", close_gui)
 root.mainloop()
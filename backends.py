@@ -0,0 +1,143 @@
+####################
+# File Name: backends.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Loads the YOLO models with PyTorch or as cached ONNX Runtime / OpenVINO exports for faster CPU inference.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import argparse
+import hashlib
+import os
+import shutil
+
+
+BACKENDS = ('pytorch', 'onnx', 'openvino')
+DEFAULT_EXPORT_SIZE = 640  # Input size YOLO uses when inference_size is not set
+
+# Exports are kept next to this script, named after the model file's hash and the input size
+EXPORT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exported_models')
+
+# The models offered in GUI.py
+KNOWN_MODELS = ['YOLOv8n-face.pt', 'yolov8m-face.pt', 'best_re_final.pt', 'yolov8s.pt']
+
+# INT8 models made by quantize.py are OpenVINO folders named after their .pt model
+QUANTIZED_SUFFIX = '_int8_openvino_model'
+
+
+def quantized_model_name(model_name):
+    """Name of the INT8 variant of a .pt model, e.g. yolov8m-face_int8_openvino_model."""
+    return os.path.splitext(model_name)[0] + QUANTIZED_SUFFIX
+
+
+def is_quantized_model(model_name):
+    return os.path.basename(model_name.rstrip('\\/')).endswith(QUANTIZED_SUFFIX)
+
+
+def base_model_name(model_name):
+    """The .pt model a (quantized) model was made from, used to pick per-model settings."""
+    if is_quantized_model(model_name):
+        return model_name.rstrip('\\/')[:-len(QUANTIZED_SUFFIX)] + '.pt'
+    return model_name
+
+
+def model_hash(model_path):
+    """Short SHA-256 of a model file, so a retrained model with the same name gets a new export."""
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def export_size(inference_size):
+    """Input size the model is exported for, a multiple of 32 like Detector uses."""
+    # Imported here, detection loads OpenCV, which the rest of this module doesn't need
+    from detection import round_to_stride
+    return round_to_stride(inference_size) if inference_size else DEFAULT_EXPORT_SIZE
+
+
+def cached_export_path(model_name, backend, inference_size=0):
+    """Where the export of model_name for backend is cached, e.g. exported_models/yolov8s_1a2b3c4d5e6f_640.onnx."""
+    stem = os.path.splitext(os.path.basename(model_name))[0]
+    key = f"{stem}_{model_hash(model_name)}_{export_size(inference_size)}"
+    if backend == 'onnx':
+        return os.path.join(EXPORT_CACHE_DIR, key + '.onnx')
+    # Ultralytics recognises OpenVINO models by the _openvino_model folder name
+    return os.path.join(EXPORT_CACHE_DIR, key + '_openvino_model')
+
+
+def export_model(model_name, backend, inference_size=0):
+    """Export the .pt model for backend into the cache (if it is not there yet) and return the cached path."""
+    from ultralytics import YOLO
+
+    target = cached_export_path(model_name, backend, inference_size)
+    if os.path.exists(target):
+        return target
+
+    print(f"Exporting {model_name} to {backend} (only needed once)...")
+    # Dynamic input shapes, so the batch size can change between runs
+    exported = YOLO(model_name).export(format=backend, imgsz=export_size(inference_size), dynamic=True)
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    # Moved in one step, so another process never loads a half-written export
+    temp_target = target + '.tmp'
+    shutil.rmtree(temp_target, ignore_errors=True)
+    shutil.move(str(exported).rstrip('\\/'), temp_target)
+    os.replace(temp_target, target)
+    return target
+
+
+def prepare_backend(model_name, backend='pytorch', inference_size=0):
+    """Return the model file to load for backend, exporting it first if needed.
+
+    Falls back to the PyTorch model (with a message) when the export can't
+    be made, e.g. because onnxruntime/openvino is not installed.
+    """
+    if backend == 'pytorch' or is_quantized_model(model_name):
+        return model_name  # INT8 models are already in OpenVINO format
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported backend: {backend}")
+    if not os.path.isfile(model_name):
+        print(f"Model file {model_name} not found locally, using PyTorch instead of {backend}.")
+        return model_name
+    try:
+        return export_model(model_name, backend, inference_size)
+    except Exception as e:
+        print(f"Could not export {model_name} to {backend} ({type(e).__name__}: {e}), using PyTorch instead.")
+        return model_name
+
+
+def load_model(model_name, backend='pytorch', inference_size=0):
+    """Load the YOLO model for the given backend, from the export cache when it is not PyTorch."""
+    from ultralytics import YOLO
+
+    model_path = prepare_backend(model_name, backend, inference_size)
+    if is_quantized_model(model_name):
+        return YOLO(model_name, task='detect')
+    if model_path == model_name:
+        return YOLO(model_name)
+    try:
+        return YOLO(model_path, task='detect')
+    except Exception as e:
+        print(f"Could not load {model_path} ({type(e).__name__}: {e}), using PyTorch instead.")
+        return YOLO(model_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the YOLO models for faster CPU inference.")
+    parser.add_argument('models', nargs='*', default=KNOWN_MODELS, help="Model files (default: the models in the GUI)")
+    parser.add_argument('--backend', choices=BACKENDS[1:], default='onnx', help="Runtime to export for")
+    parser.add_argument('--inference-size', type=int, default=0, help="inference_size the models will run at")
+    args = parser.parse_args(argv)
+
+    for model_name in args.models:
+        if not os.path.isfile(model_name):
+            print(f"Skipping {model_name}, file not found.")
+            continue
+        print(f"{model_name}: {export_model(model_name, args.backend, args.inference_size)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+####################
+# File Name: batch.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Blurs whole folders, globs or manifests of videos with a pool of workers that keep their model loaded.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+
+from segments import init_worker, job_backend, load_job_models
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.m4v')
+OUTPUT_PREFIXES = ('blurred_', 'cut_', 'resized_', 'w_audio_')  # Files written by FaceBlurAI itself
+
+
+@dataclass
+class JobResult:
+    """Status of one video in a batch."""
+    input_path: str
+    status: str  # 'done', 'failed' or 'cancelled'
+    output_path: str = None
+    error: str = None
+    frames_processed: int = 0
+    elapsed_time: float = 0.0  # seconds
+
+
+def is_source_video(path):
+    name = os.path.basename(path)
+    return name.lower().endswith(VIDEO_EXTENSIONS) and not name.startswith(OUTPUT_PREFIXES)
+
+
+def collect_videos(sources):
+    """Expand folders (recursively), glob patterns and manifest files into a sorted list of videos.
+
+    A manifest is a .txt file with one video path per line; empty lines and
+    lines starting with # are skipped. Outputs of earlier runs (blurred_*,
+    cut_*, ...) are left out when scanning folders and globs.
+    """
+    videos = []
+    for source in sources:
+        if os.path.isdir(source):
+            for directory, _, files in os.walk(source):
+                videos.extend(os.path.join(directory, name) for name in files if is_source_video(name))
+        elif source.lower().endswith('.txt') and os.path.isfile(source):
+            with open(source, encoding='utf-8') as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        videos.append(line)
+        elif os.path.isfile(source):
+            videos.append(source)
+        else:
+            videos.extend(path for path in glob.glob(source, recursive=True) if is_source_video(path))
+    # Keep the first occurrence of every video
+    return list(dict.fromkeys(os.path.normpath(video) for video in videos))
+
+
+def output_path_for(input_path, output_dir, source_root):
+    """Output path under output_dir mirroring the folders below source_root.
+
+    Returns None without an output_dir, to let process_video() put the
+    output next to the input. Mirroring the folders keeps camera files with
+    the same name (MVI_0340.MP4 in two folders) apart.
+    """
+    if not output_dir:
+        return None
+    relative_dir = os.path.relpath(os.path.dirname(os.path.abspath(input_path)), source_root)
+    target_dir = os.path.normpath(os.path.join(output_dir, relative_dir))
+    os.makedirs(target_dir, exist_ok=True)
+    return os.path.join(target_dir, 'blurred_' + os.path.basename(input_path))
+
+
+def run_job(input_path, options, output_path=None, model=None, person_model=None):
+    """Blur one video and return its JobResult instead of raising."""
+    from working import process_video
+
+    start_time = time.time()
+    try:
+        result = process_video(input_path, output_path=output_path, model=model, person_model=person_model, **options)
+    except Exception as e:
+        return JobResult(input_path, 'failed', error=f"{type(e).__name__}: {e}", elapsed_time=time.time() - start_time)
+    return JobResult(input_path, 'cancelled' if result.cancelled else 'done',
+                     output_path=result.audio_output_path or result.output_path,
+                     frames_processed=result.frames_processed, elapsed_time=result.elapsed_time)
+
+
+def _run_worker_job(job):
+    """Run a job in a worker process, reusing the model it already loaded."""
+    input_path, options, output_path = job
+    # Jobs running side by side share the CPU, so they neither refine the timings nor print progress lines
+    options = {**options, 'track_runtime': False}
+    model, person_model = load_job_models(options)
+    return run_job(input_path, options, output_path, model, person_model)
+
+
+def run_batch(videos, options, jobs=1, threads_per_job=None, output_dir=None, on_result=None):
+    """Blur every video with `jobs` worker processes and return their JobResults in input order.
+
+    Every worker loads the model once and reuses it for all of its videos.
+    on_result is called with each JobResult as soon as the job finishes.
+    """
+    results = {}
+    source_root = os.path.commonpath([os.path.dirname(os.path.abspath(video)) for video in videos])
+    output_paths = {video: output_path_for(video, output_dir, source_root) for video in videos}
+
+    if jobs <= 1:
+        # One job at a time in this process, with a single model load
+        model, person_model = load_job_models(options)
+        for video in videos:
+            results[video] = run_job(video, options, output_paths[video], model, person_model)
+            if on_result:
+                on_result(results[video])
+    else:
+        threads_per_job = threads_per_job or max(1, (os.cpu_count() or 1) // jobs)
+        options = {**options, 'backend': job_backend(options)}
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=init_worker,
+                                 initargs=(threads_per_job,)) as pool:
+            futures = {pool.submit(_run_worker_job, (video, options, output_paths[video])): video for video in videos}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if on_result:
+                    on_result(results[futures[future]])
+
+    return [results[video] for video in videos]
+
+
+def print_job_result(job_result):
+    if job_result.status == 'failed':
+        print(f"[FAILED] {job_result.input_path}: {job_result.error}")
+    else:
+        print(f"[{job_result.status.upper()}] {job_result.input_path} -> {job_result.output_path} "
+              f"({job_result.frames_processed} frames in {round(job_result.elapsed_time / 60, 2)} minutes)")
+
+
+def main(argv=None):
+    from working import DEFAULT_CONFIG_PATH, load_config
+
+    parser = argparse.ArgumentParser(description="Blur every video in folders, glob patterns or manifest files.")
+    parser.add_argument('sources', nargs='+', help="Folders, glob patterns, video files or .txt manifests")
+    parser.add_argument('--config', default=DEFAULT_CONFIG_PATH, help="Path to config.ini (default: next to working.py)")
+    parser.add_argument('--model', dest='model_name', help="YOLO model file (overrides yolo_model)")
+    parser.add_argument('--jobs', type=int, default=1, help="Videos processed at the same time, each in its own worker")
+    parser.add_argument('--threads-per-job', type=int, help="CPU threads per worker (default: split the cores evenly)")
+    parser.add_argument('--output-dir', help="Write all outputs here instead of next to each video")
+    parser.add_argument('--report', help="Write the status of every job to this JSON file")
+    parser.add_argument('--cut', nargs=2, metavar=('START', 'END'), help="Cut every video from START to END (MM:SS)")
+    args = parser.parse_args(argv)
+
+    options = load_config(args.config, model_name=args.model_name)
+    # The input path, cut and segment settings in config.ini are for single videos
+    for key in ('input_path', 'workers', 'threads_per_worker', 'daemon'):
+        options.pop(key)
+    options['cut_video'] = False
+    if args.cut:
+        options.update(cut_video=True, start_time=args.cut[0], end_time=args.cut[1])
+
+    videos = collect_videos(args.sources)
+    if not videos:
+        print("No videos found.")
+        return 1
+    print(f"Found {len(videos)} videos, processing {args.jobs} at a time...\n")
+
+    results = run_batch(videos, options, args.jobs, args.threads_per_job, args.output_dir, on_result=print_job_result)
+
+    done = sum(result.status == 'done' for result in results)
+    print(f"\nFinished {done} of {len(results)} videos.")
+    for result in results:
+        if result.status != 'done':
+            print_job_result(result)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report:
+            json.dump([asdict(result) for result in results], report, indent=2)
+        print(f"Job report saved as: {args.report}")
+    return 0 if done == len(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+####################
+# File Name: benchmark.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Measures how long the parts of the FaceBlurAI pipeline take on this machine.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from backends import KNOWN_MODELS
+from blurring import BLUR_METHODS, kernel_size_for
+from metrics import STAGES
+
+
+# Face/head region sizes (width, height) seen at 480p, 1080p and 4K
+KERNEL_ROI_SIZES = [(96, 128), (320, 400), (640, 800), (1200, 1500)]
+
+# Sizes of the synthetic clips
+CLIP_SIZES = {'480p': (854, 480), '1080p': (1920, 1080), '4k': (3840, 2160)}
+CLIP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_clips')
+
+# config.ini settings the pipeline benchmark runs with, the rest is fixed so runs compare
+PIPELINE_SETTINGS = ('ffmpeg_path', 'confidence_threshold', 'encoder', 'video_codec', 'crf', 'preset', 'batch_size',
+                     'detect_every', 'inference_size', 'backend', 'tile_size', 'tile_overlap', 'tile_region',
+                     'motion_threshold', 'motion_force_every', 'blur_method', 'blur_scale', 'blur_buffer')
+
+REGRESSION_TOLERANCE = 0.10  # Slower than the baseline by more than this counts as a regression
+MIN_STAGE_CHANGE_MS = 1.0  # Smaller changes of a stage are noise
+
+
+def benchmark_kernels(roi_sizes=KERNEL_ROI_SIZES, repeats=20, seed=0):
+    """Time every blur method on random regions of each size.
+
+    Returns a list of {'method', 'width', 'height', 'ms'} rows, where ms is
+    the mean time of one call.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for width, height in roi_sizes:
+        roi = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        kernel_size = kernel_size_for(width, height)
+        for method, blur in BLUR_METHODS.items():
+            blur(roi, kernel_size)  # Warm up
+            start = time.perf_counter()
+            for _ in range(repeats):
+                blur(roi, kernel_size)
+            elapsed_ms = (time.perf_counter() - start) / repeats * 1000
+            rows.append({'method': method, 'width': width, 'height': height, 'ms': elapsed_ms})
+    return rows
+
+
+def print_kernel_table(rows):
+    sizes = sorted({(row['width'], row['height']) for row in rows})
+    methods = list(dict.fromkeys(row['method'] for row in rows))
+    times = {(row['method'], row['width'], row['height']): row['ms'] for row in rows}
+
+    print(f"{'method':<12}" + ''.join(f"{f'{w}x{h}':>14}" for w, h in sizes))
+    for method in methods:
+        print(f"{method:<12}" + ''.join(f"{times[(method, w, h)]:>11.2f} ms" for w, h in sizes))
+
+
+def bounce(start, velocity, index, limit):
+    """Position after index steps of a point moving back and forth between 0 and limit."""
+    position = (start + velocity * index) % (2 * limit)
+    return position if position <= limit else 2 * limit - position
+
+
+def draw_face(frame, center, axes):
+    """Draw a simple face: hair, skin-coloured ellipse, eyes and mouth."""
+    x, y = center
+    width, height = axes
+    cv2.ellipse(frame, (x, y - height // 5), (width + width // 8, height), 0, 180, 360, (30, 40, 60), -1)
+    cv2.ellipse(frame, (x, y), (width, height), 0, 0, 360, (120, 160, 215), -1)
+    for eye_x in (x - width // 2.5, x + width // 2.5):
+        cv2.ellipse(frame, (int(eye_x), y - height // 5), (max(1, width // 6), max(1, height // 12)), 0, 0, 360,
+                    (40, 30, 30), -1)
+    cv2.ellipse(frame, (x, y + height // 2), (max(1, width // 3), max(1, height // 10)), 0, 0, 180, (60, 60, 150), -1)
+
+
+def make_synthetic_clip(path, width, height, frames=120, faces=4, fps=30, seed=0):
+    """Write a clip of face-like patches moving over a textured background, the same for the same arguments."""
+    rng = np.random.default_rng(seed)
+    # A smooth random texture, so the encoder has about as much work as with real footage
+    texture = rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    background = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    # Faces between a tenth and a fifth of the frame height, crossing the frame in 2-6 seconds
+    axes = [(int(size * 0.75), int(size)) for size in rng.uniform(height / 20, height / 10, faces)]
+    starts = rng.uniform(0, 1, (faces, 2))
+    velocities = rng.uniform(-1, 1, (faces, 2)) / (fps * rng.uniform(2, 6, (faces, 1)))
+
+    # Written under another name first, so an interrupted run doesn't leave a broken clip behind
+    temp_path = path[:-4] + '.partial.mp4'
+    writer = cv2.VideoWriter(temp_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for index in range(frames):
+        frame = background.copy()
+        for (axis_x, axis_y), start, velocity in zip(axes, starts, velocities):
+            x = axis_x + bounce(start[0], velocity[0], index, 1.0) * (width - 2 * axis_x)
+            y = axis_y + bounce(start[1], velocity[1], index, 1.0) * (height - 2 * axis_y)
+            draw_face(frame, (int(x), int(y)), (axis_x, axis_y))
+        writer.write(frame)
+    writer.release()
+    os.replace(temp_path, path)
+    return path
+
+
+def synthetic_clip(resolution, frames=120, faces=4, seed=0, clip_dir=CLIP_DIR):
+    """Path of the synthetic clip for these arguments, made the first time it is needed."""
+    width, height = CLIP_SIZES[resolution]
+    path = os.path.join(clip_dir, f'synthetic_{resolution}_{faces}faces_{frames}frames_seed{seed}.mp4')
+    if not os.path.exists(path):
+        print(f"Making the {resolution} test clip...")
+        os.makedirs(clip_dir, exist_ok=True)
+        make_synthetic_clip(path, width, height, frames, faces, seed=seed)
+    return path
+
+
+def peak_memory_mb():
+    """Peak memory use of this process so far, in MB."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, kB elsewhere
+
+
+def _run_pipeline_case(case):
+    """Blur one clip with one model in a fresh worker process and return its timings.
+
+    A fresh process per case keeps the peak memory of one case from
+    showing up in the next.
+    """
+    from backends import load_model
+    from detection import Detector
+    from metrics import RunMetrics
+    from working import process_video
+
+    options = case['options']
+    model = load_model(case['model'], options['backend'], options['inference_size'])
+    # The first call sets up the model, which is not part of the pipeline's speed
+    width, height = CLIP_SIZES[case['resolution']]
+    Detector(model, inference_size=options['inference_size']).detect([np.zeros((height, width, 3), np.uint8)])
+
+    metrics = RunMetrics()
+    result = process_video(case['clip'], output_path=case['output_path'], model=model, metrics=metrics,
+                           track_runtime=False, save_detections=False, checkpoint_interval=0, **options)
+    os.remove(case['output_path'])
+    return {'model': case['model'], 'resolution': case['resolution'], 'frames': result.frames_processed,
+            'frames_detected': result.frames_detected, 'frames_skipped': result.frames_skipped,
+            'boxes_detected': result.boxes_detected,
+            'elapsed_seconds': result.elapsed_time, 'fps': result.fps,
+            'stages': metrics.as_dict(result.frames_processed), 'counters': dict(metrics.counters),
+            'peak_memory_mb': peak_memory_mb()}
+
+
+def benchmark_pipeline(models, resolutions, options_for, frames=120, faces=4, seed=0):
+    """Run the whole pipeline for every model on the synthetic clip of every resolution.
+
+    options_for(model) returns the process_video() settings of the model.
+    Returns one result dict per (model, resolution).
+    """
+    rows = []
+    context = multiprocessing.get_context('spawn')
+    for resolution in resolutions:
+        clip = synthetic_clip(resolution, frames, faces, seed)
+        for model in models:
+            print(f"Running {model} on {resolution}...")
+            case = {'model': model, 'resolution': resolution, 'clip': clip, 'options': options_for(model),
+                    'output_path': os.path.join(CLIP_DIR, f'blurred_{os.getpid()}_{os.path.basename(clip)}')}
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                rows.append(pool.submit(_run_pipeline_case, case).result())
+    return rows
+
+
+def print_pipeline_table(rows):
+    print(f"{'model':<20}{'clip':<8}{'fps':>8}" + ''.join(f"{stage:>13}" for stage in STAGES) + f"{'peak':>10}")
+    for row in rows:
+        stage_ms = ''.join(f"{row['stages'].get(stage, {}).get('ms_per_frame', 0.0):>10.2f} ms" for stage in STAGES)
+        print(f"{row['model']:<20}{row['resolution']:<8}{row['fps']:>8.2f}{stage_ms}{row['peak_memory_mb']:>7.0f} MB")
+    print("(ms per output frame; stages run in parallel threads, so they add up to more than 1000 / fps)")
+
+
+def compare_results(rows, baseline_rows, tolerance=REGRESSION_TOLERANCE):
+    """Compare pipeline results with a baseline run and return the regressions found, as text lines."""
+    baseline = {(row['model'], row['resolution']): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        old = baseline.get((row['model'], row['resolution']))
+        if old is None:
+            continue
+        name = f"{row['model']} {row['resolution']}"
+        change = row['fps'] / old['fps'] - 1 if old['fps'] else 0.0
+        print(f"{name:<28} fps {old['fps']:.2f} -> {row['fps']:.2f} ({change:+.1%})")
+        if change < -tolerance:
+            regressions.append(f"{name}: fps dropped {-change:.1%}")
+        for stage, timing in row['stages'].items():
+            old_ms = old['stages'].get(stage, {}).get('ms_per_frame')
+            if old_ms is None:
+                continue
+            new_ms = timing['ms_per_frame']
+            if new_ms - old_ms > MIN_STAGE_CHANGE_MS and new_ms > old_ms * (1 + tolerance):
+                regressions.append(f"{name}: {stage} {old_ms:.2f} -> {new_ms:.2f} ms per frame")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the FaceBlurAI pipeline on this machine.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    kernels_parser = subparsers.add_parser('kernels', help="Time each blur method on regions of typical face sizes")
+    kernels_parser.add_argument('--repeats', type=int, default=20, help="Calls per measurement")
+
+    pipeline_parser = subparsers.add_parser('pipeline', help="Time every stage of the pipeline on synthetic clips")
+    pipeline_parser.add_argument('--config', help="Path to config.ini (default: next to working.py)")
+    pipeline_parser.add_argument('--models', nargs='+', help="Model files (default: the GUI models that are present)")
+    pipeline_parser.add_argument('--resolutions', nargs='+', choices=list(CLIP_SIZES), default=list(CLIP_SIZES))
+    pipeline_parser.add_argument('--frames', type=int, default=120, help="Length of each clip in frames")
+    pipeline_parser.add_argument('--faces', type=int, default=4, help="Moving face-like patches in each clip")
+    pipeline_parser.add_argument('--seed', type=int, default=0, help="Seed of the clips, the same seed gives the same clips")
+    pipeline_parser.add_argument('--output', default='benchmark_results.json', help="JSON file for the results")
+    pipeline_parser.add_argument('--baseline', help="Results of an earlier run to compare with")
+    pipeline_parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                                 help="Slowdown that counts as a regression, e.g. 0.1 for 10%%")
+
+    args = parser.parse_args(argv)
+    if args.command == 'kernels':
+        print("Blur method timings per region (mean of one call):\n")
+        print_kernel_table(benchmark_kernels(repeats=args.repeats))
+    elif args.command == 'pipeline':
+        return run_pipeline_command(args)
+    return 0
+
+
+def run_pipeline_command(args):
+    from working import DEFAULT_CONFIG_PATH, load_config
+
+    models = args.models or [model for model in KNOWN_MODELS if os.path.isfile(model)]
+    if not models:
+        print("No model files found, pass them with --models.")
+        return 1
+
+    def options_for(model):
+        # The blur method etc. are looked up for each model, like a normal run does
+        config = load_config(args.config or DEFAULT_CONFIG_PATH, model_name=model)
+        return {key: config[key] for key in PIPELINE_SETTINGS}
+
+    rows = benchmark_pipeline(models, args.resolutions, options_for, args.frames, args.faces, args.seed)
+    print()
+    print_pipeline_table(rows)
+
+    report = {'machine': platform.node(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+              'python': platform.python_version(), 'opencv': cv2.__version__,
+              'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'clips': {'frames': args.frames, 'faces': args.faces, 'seed': args.seed},
+              'settings': {model: options_for(model) for model in models}, 'results': rows}
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"\nResults saved as: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\nCompared with {args.baseline} ({baseline['created']}):\n")
+        if baseline['machine'] != report['machine'] or baseline['clips'] != report['clips']:
+            print("NOTE: the baseline was made on another machine or with other clips, the numbers may not compare.\n")
+        regressions = compare_results(rows, baseline['results'], args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
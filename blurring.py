@@ -0,0 +1,205 @@
+####################
+# File Name: blurring.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Blurs the detected boxes onto a frame in a single compositing pass.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from tracker import box_iou
+
+
+def kernel_size_for(width, height):
+    """Gaussian kernel size for a region, growing with the region size."""
+    return int(max(51, int(min(width, height) / 10) * 4 + 1))
+
+
+def gaussian_blur(roi, kernel_size):
+    """Full-resolution Gaussian blur, the original (and most expensive) method."""
+    return cv2.GaussianBlur(roi, (kernel_size, kernel_size), 0)
+
+
+def box_blur(roi, kernel_size):
+    """Box blur, whose cost does not grow with the kernel size."""
+    return cv2.blur(roi, (kernel_size, kernel_size))
+
+
+def pixelate(roi, kernel_size):
+    """Mosaic of blocks about a quarter of the kernel size."""
+    height, width = roi.shape[:2]
+    block = max(2, kernel_size // 4)
+    small = cv2.resize(roi, (max(1, width // block), max(1, height // block)), interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def downscale_blur(roi, kernel_size):
+    """Gaussian blur on a downscaled copy, scaled back up.
+
+    Looks like gaussian_blur, but the blur runs on a fraction of the pixels
+    with a proportionally smaller kernel.
+    """
+    height, width = roi.shape[:2]
+    factor = max(1, kernel_size // 8)
+    small_width, small_height = max(1, width // factor), max(1, height // factor)
+    small = cv2.resize(roi, (small_width, small_height), interpolation=cv2.INTER_AREA)
+    small_kernel = max(3, (kernel_size // factor) | 1)
+    small = cv2.GaussianBlur(small, (small_kernel, small_kernel), 0)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def solid_fill(roi, kernel_size):
+    """Fill the region with its mean colour."""
+    return np.full_like(roi, cv2.mean(roi)[:roi.shape[2]])
+
+
+# Anonymization methods selectable with 'method' in config.ini
+BLUR_METHODS = {
+    'gaussian': gaussian_blur,
+    'box': box_blur,
+    'pixelate': pixelate,
+    'downscale': downscale_blur,
+    'fill': solid_fill,
+}
+
+
+@lru_cache(maxsize=512)
+def ellipse_template(width, height):
+    """Filled ellipse mask for a box of the given size, shared between frames."""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, (width // 2, height // 2), (width // 2, height // 2), 0, 0, 360, 255, -1)
+    mask.setflags(write=False)
+    return mask
+
+
+def scale_box(box, scale_factor, frame_width, frame_height):
+    """Grow a box around its center by scale_factor and clip it to the frame.
+
+    Returns None if the box ends up empty.
+    """
+    x1, y1, x2, y2 = box
+    new_width = int((x2 - x1) * scale_factor)
+    new_height = int((y2 - y1) * scale_factor)
+
+    # Ensure new_width and new_height are positive
+    if new_width <= 0 or new_height <= 0:
+        return None
+
+    new_x1 = max(0, x1 - (new_width - (x2 - x1)) // 2)
+    new_y1 = max(0, y1 - (new_height - (y2 - y1)) // 2)
+    new_x2 = min(frame_width, new_x1 + new_width)
+    new_y2 = min(frame_height, new_y1 + new_height)
+    if new_x2 <= new_x1 or new_y2 <= new_y1:
+        return None
+    return (new_x1, new_y1, new_x2, new_y2)
+
+
+def merge_boxes(boxes, iou_threshold):
+    """Merge boxes that overlap by at least iou_threshold into their common bounding box.
+
+    The buffer holds the same face from several consecutive frames, and those
+    boxes overlap heavily, so each face ends up as a single box.
+    """
+    merged = []
+    for box in sorted(boxes, key=lambda b: (b[2] - b[0]) * (b[3] - b[1]), reverse=True):
+        for index, existing in enumerate(merged):
+            if box_iou([existing], [box])[0, 0] >= iou_threshold:
+                merged[index] = (min(existing[0], box[0]), min(existing[1], box[1]),
+                                 max(existing[2], box[2]), max(existing[3], box[3]))
+                break
+        else:
+            merged.append(tuple(box))
+    return merged
+
+
+def group_overlapping(boxes):
+    """Split boxes into groups whose regions touch, returning (group_box, members) pairs."""
+    groups = []
+    for box in boxes:
+        group_box, members = box, [box]
+        # Absorb every existing group the growing region overlaps, until none is left
+        absorbed = True
+        while absorbed:
+            absorbed = False
+            remaining = []
+            for other_box, other_members in groups:
+                if (other_box[0] < group_box[2] and group_box[0] < other_box[2]
+                        and other_box[1] < group_box[3] and group_box[1] < other_box[3]):
+                    group_box = (min(group_box[0], other_box[0]), min(group_box[1], other_box[1]),
+                                 max(group_box[2], other_box[2]), max(group_box[3], other_box[3]))
+                    members.extend(other_members)
+                    absorbed = True
+                else:
+                    remaining.append((other_box, other_members))
+            groups = remaining
+        groups.append((group_box, members))
+    return groups
+
+
+class BlurCompositor:
+    """Blur the buffered boxes onto a frame once per frame.
+
+    The boxes of all buffered frames are scaled, merged so each face is one
+    box, and grouped into regions that touch. Each region is blurred once
+    from the original pixels with the chosen method from BLUR_METHODS and
+    composited back in place through a union of the boxes' ellipse (or
+    rectangle) masks.
+    """
+
+    def __init__(self, shape='ellipse', scale_factor=1.6, merge_iou=0.5, method='gaussian'):
+        if shape not in ('ellipse', 'rect'):
+            raise ValueError(f"Unsupported blur shape: {shape}")
+        if method not in BLUR_METHODS:
+            raise ValueError(f"Unsupported blur method: {method}")
+        self.shape = shape
+        self.method = method
+        self.blur = BLUR_METHODS[method]
+        self.scale_factor = scale_factor
+        self.merge_iou = merge_iou
+        self._mask = None  # Scratch union mask, reused between frames
+
+    def apply(self, frame, boxes):
+        """Blur the boxes onto the frame in place and return the number of blurred pixels."""
+        frame_height, frame_width = frame.shape[:2]
+        scaled = [scale_box(box, self.scale_factor, frame_width, frame_height) for box in boxes]
+        scaled = merge_boxes([box for box in scaled if box is not None], self.merge_iou)
+        if not scaled:
+            return 0
+
+        if self._mask is None or self._mask.shape != (frame_height, frame_width):
+            self._mask = np.zeros((frame_height, frame_width), dtype=np.uint8)
+
+        blurred_pixels = 0
+        for (gx1, gy1, gx2, gy2), members in group_overlapping(scaled):
+            roi = frame[gy1:gy2, gx1:gx2]
+            kernel_size = max(kernel_size_for(x2 - x1, y2 - y1) for x1, y1, x2, y2 in members)
+            blurred_roi = self.blur(roi, kernel_size)
+
+            if self.shape == 'rect' and len(members) == 1:
+                # A lone rectangle covers the whole region, no mask needed
+                roi[:] = blurred_roi
+                blurred_pixels += roi.shape[0] * roi.shape[1]
+                continue
+
+            # Build the union mask of every box in the region
+            mask = self._mask[gy1:gy2, gx1:gx2]
+            for x1, y1, x2, y2 in members:
+                box_mask = mask[y1 - gy1:y2 - gy1, x1 - gx1:x2 - gx1]
+                if self.shape == 'rect':
+                    box_mask[:] = 255
+                else:
+                    np.bitwise_or(box_mask, ellipse_template(x2 - x1, y2 - y1), out=box_mask)
+
+            # Composite the blurred region through the mask and clear it for the next region
+            inside = mask.astype(bool)
+            np.copyto(roi, blurred_roi, where=inside[..., None])
+            blurred_pixels += int(np.count_nonzero(inside))
+            mask[:] = 0
+
+        return blurred_pixels
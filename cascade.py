@@ -0,0 +1,99 @@
+####################
+# File Name: cascade.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Two-stage detection: a fast person model finds people, the head/face model only looks inside them.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import cv2
+
+from detection import Detector, append_detections, extract_detections, merge_and_log, round_to_stride
+from metrics import timed
+
+
+PERSON_CLASS = 0  # 'person' in the COCO classes of yolov8s.pt
+# Low on purpose: a missed person means missed heads, a false one only costs a crop
+PERSON_THRESHOLD = 0.2
+CROP_BATCH = 32  # Crops per call of the head model
+MERGE_IOU = 0.5  # Heads found in two overlapping person crops are merged above this IoU
+
+
+def pad_box(box, padding, frame_width, frame_height):
+    """Grow a box by padding times its size on every side, kept inside the frame."""
+    x1, y1, x2, y2 = box
+    pad_x, pad_y = int((x2 - x1) * padding), int((y2 - y1) * padding)
+    return max(0, x1 - pad_x), max(0, y1 - pad_y), min(frame_width, x2 + pad_x), min(frame_height, y2 + pad_y)
+
+
+class CascadeDetector:
+    """Detector that runs the head/face model only on crops of the persons a person model finds.
+
+    The person model runs on the whole frames (at inference_size), then the
+    padded person crops of the whole batch go through the head model
+    together, each shrunk to fit crop_size. The head boxes are mapped back
+    to frame coordinates and duplicates from overlapping crops are merged.
+    When people fill a small part of the frame this costs little more than
+    the person model. Has the same detect()/detect_with_scores() as
+    Detector, and logs the head boxes in the detection_log.
+    """
+
+    def __init__(self, person_model, head_model, confidence_threshold=0.3, desired_class=0, inference_size=None,
+                 crop_size=320, padding=0.15, detection_log=None, metrics=None):
+        self.person_detector = Detector(person_model, PERSON_THRESHOLD, PERSON_CLASS, inference_size, metrics=metrics)
+        self.head_model = head_model
+        self.confidence_threshold = confidence_threshold
+        self.desired_class = desired_class
+        self.crop_size = round_to_stride(crop_size)
+        self.padding = padding
+        self.detection_log = detection_log
+        self.metrics = metrics
+
+    def detect(self, frames, frame_indices=None):
+        return [bboxes for bboxes, _, _ in self.detect_with_scores(frames, frame_indices)]
+
+    def detect_with_scores(self, frames, frame_indices=None):
+        if not frames:
+            return []
+        persons = self.person_detector.detect(frames)
+
+        # Crops of every person in the batch, with the frame and offset they came from
+        crops, origins = [], []
+        for frame_number, (frame, boxes) in enumerate(zip(frames, persons)):
+            frame_height, frame_width = frame.shape[:2]
+            for box in boxes:
+                x1, y1, x2, y2 = pad_box(box, self.padding, frame_width, frame_height)
+                if x2 > x1 and y2 > y1:
+                    crops.append(frame[y1:y2, x1:x2])
+                    origins.append((frame_number, x1, y1))
+
+        found = []
+        for start in range(0, len(crops), CROP_BATCH):
+            found.extend(self._detect_crops(crops[start:start + CROP_BATCH]))
+
+        with timed(self.metrics, 'postprocess'):
+            per_frame = [([], [], []) for _ in frames]
+            for (frame_number, offset_x, offset_y), detection in zip(origins, found):
+                append_detections(per_frame[frame_number], detection, offset_x, offset_y)
+            return merge_and_log(per_frame, frame_indices, self.detection_log, MERGE_IOU)
+
+    def _detect_crops(self, crops):
+        """Run the head model once on crops of different sizes and return each crop's detections."""
+        if not crops:
+            return []
+        with timed(self.metrics, 'inference'):
+            scales = []
+            resized = []
+            for crop in crops:
+                # Each crop is shrunk on its own, so a large person doesn't cost more than a small one
+                scale = max(1.0, max(crop.shape[:2]) / self.crop_size)
+                if scale > 1.0:
+                    size = (max(1, round(crop.shape[1] / scale)), max(1, round(crop.shape[0] / scale)))
+                    crop = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+                scales.append(scale)
+                resized.append(crop)
+            results = list(self.head_model(resized, stream=True, conf=self.confidence_threshold,
+                                           imgsz=self.crop_size))
+        return [extract_detections(result, self.desired_class, scale) for result, scale in zip(results, scales)]
@@ -0,0 +1,173 @@
+####################
+# File Name: checkpoint.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Saves the encoded output in chunks together with the pipeline state, so a crashed run can resume.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import os
+import pickle
+import shutil
+from dataclasses import dataclass, field
+
+
+CHECKPOINT_VERSION = 2  # Bump when the saved state changes, old checkpoints are then started over
+STATE_FILE = 'state.pkl'
+
+
+def checkpoint_dir_for(output_path):
+    """Folder next to the output that holds its checkpoint: .checkpoint_<output name>."""
+    directory, name = os.path.split(os.path.abspath(output_path))
+    return os.path.join(directory, '.checkpoint_' + name)
+
+
+def atomic_write(path, data):
+    """Write data to path so that a crash leaves either the old or the new file, never a partial one."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def fsync_file(path):
+    """Make sure a file written by another process (ffmpeg, OpenCV) is on disk."""
+    with open(path, 'ab') as file:  # Windows can only flush files opened for writing
+        os.fsync(file.fileno())
+
+
+def job_fingerprint(input_path, **settings):
+    """Identify a job by its input file and settings, so a checkpoint is only resumed by the same job."""
+    stat = os.stat(input_path)
+    return {'input_path': os.path.abspath(input_path), 'input_size': stat.st_size,
+            'input_mtime': stat.st_mtime, **settings}
+
+
+@dataclass
+class ResumeState:
+    """Everything process_video() needs to carry on after the frames that are already encoded."""
+    frame_index: int = 0  # Input frames handled so far, counting warm-up frames
+    tracker: object = None
+    bbox_buffer: list = field(default_factory=list)
+    frames_processed: int = 0
+    boxes_detected: int = 0
+    frames_detected: int = 0
+    elapsed_time: float = 0.0  # seconds spent before the checkpoint
+    detections: object = None  # Rows of the detection log so far
+    frames_skipped: int = 0
+    motion_gate: object = None
+
+
+class Checkpoint:
+    """Finished output chunks of a job plus the state to resume from after them.
+
+    Everything lives in a .checkpoint_ folder next to the output. The state
+    file is only replaced (atomically) after a chunk is completely written,
+    so after a crash it always points at chunks that are whole, and at the
+    frame the next chunk starts with. state is any picklable object.
+    """
+
+    def __init__(self, output_path, fingerprint):
+        self.directory = checkpoint_dir_for(output_path)
+        self.state_path = os.path.join(self.directory, STATE_FILE)
+        self.fingerprint = fingerprint
+        self.chunks = []  # File names of the finished chunks, in order
+        self.state = None
+
+    def load(self):
+        """Read the saved checkpoint. Returns False if there is none for this job."""
+        try:
+            with open(self.state_path, 'rb') as file:
+                saved = pickle.load(file)
+        except FileNotFoundError:
+            return False
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return False  # Written by another version of FaceBlurAI
+
+        if saved.get('version') != CHECKPOINT_VERSION or saved.get('fingerprint') != self.fingerprint:
+            return False
+        if not all(os.path.exists(os.path.join(self.directory, name)) for name in saved['chunks']):
+            return False
+        self.chunks, self.state = saved['chunks'], saved['state']
+        return True
+
+    def start(self, initial_state, resume=True):
+        """Resume the saved checkpoint if resume is set, otherwise (or without one) start over from initial_state.
+
+        The new checkpoint is saved right away, so anything written into its
+        folder before the first commit is kept on a restart too. Returns True
+        if the job resumes.
+        """
+        if resume and self.load():
+            return True
+        self.discard()
+        os.makedirs(self.directory)
+        self.commit(initial_state)
+        return False
+
+    def chunk_path(self, index):
+        return os.path.join(self.directory, f'chunk_{index:05d}.mp4')
+
+    def chunk_paths(self):
+        return [os.path.join(self.directory, name) for name in self.chunks]
+
+    def commit(self, state, chunk_path=None):
+        """Add a finished chunk (if any) and save state as the point to resume from."""
+        if chunk_path is not None:
+            fsync_file(chunk_path)
+            self.chunks.append(os.path.basename(chunk_path))
+        self.state = state
+        saved = {'version': CHECKPOINT_VERSION, 'fingerprint': self.fingerprint, 'chunks': self.chunks,
+                 'state': state}
+        atomic_write(self.state_path, pickle.dumps(saved, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def discard(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ChunkedWriter:
+    """Video writer that splits the output into chunk files and commits a checkpoint after each one.
+
+    open_writer(path) creates the writer of one chunk (an FFmpegWriter or a
+    cv2.VideoWriter). commit() is called by the encode thread in frame order,
+    so the state it saves matches exactly the frames written before it.
+    Implements the parts of cv2.VideoWriter the pipeline uses.
+    """
+
+    def __init__(self, checkpoint, open_writer):
+        self.checkpoint = checkpoint
+        self.open_writer = open_writer
+        self._open_next_chunk()
+
+    def _open_next_chunk(self):
+        # A chunk left half-written by a crash has the same index and is overwritten
+        self.current_path = self.checkpoint.chunk_path(len(self.checkpoint.chunks))
+        self.writer = self.open_writer(self.current_path)
+        self.frames_in_chunk = 0
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self, frame):
+        self.writer.write(frame)
+        self.frames_in_chunk += 1
+
+    def commit(self, state):
+        """Finish the current chunk, save state as the point to resume from and start the next chunk."""
+        self.writer.release()
+        self.checkpoint.commit(state, self.current_path if self.frames_in_chunk else None)
+        self._open_next_chunk()
+
+    def release(self):
+        self.writer.release()
+
+    def chunk_paths(self):
+        """All chunks of the output in order, including the last one that was never committed."""
+        paths = self.checkpoint.chunk_paths()
+        if self.frames_in_chunk or not paths:
+            paths.append(self.current_path)
+        return paths
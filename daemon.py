@@ -0,0 +1,359 @@
+####################
+# File Name: daemon.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Background process that keeps the YOLO models loaded and blurs the videos the GUI and CLI send it.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import argparse
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from dataclasses import asdict
+from multiprocessing.connection import Client, Listener
+
+from checkpoint import atomic_write
+from runtime_estimate import format_duration
+
+
+# Port and key of the running daemon, readable only by the user that started it
+DAEMON_INFO_PATH = os.path.join(os.path.expanduser('~'), '.faceblurai_daemon.json')
+DAEMON_LOG_PATH = os.path.join(os.path.expanduser('~'), '.faceblurai_daemon.log')
+DAEMON_SCRIPT = os.path.abspath(__file__)
+START_TIMEOUT = 180  # Seconds to wait for a new daemon to load its models
+
+
+class DaemonNotRunning(ConnectionError):
+    pass
+
+
+def read_daemon_info():
+    import json
+
+    try:
+        with open(DAEMON_INFO_PATH, encoding='utf-8') as info_file:
+            return json.load(info_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def connect():
+    """Open a connection to the running daemon, or raise DaemonNotRunning."""
+    info = read_daemon_info()
+    if info is None:
+        raise DaemonNotRunning("The FaceBlurAI daemon is not running")
+    try:
+        return Client(('127.0.0.1', info['port']), authkey=bytes.fromhex(info['authkey']))
+    except OSError as e:
+        raise DaemonNotRunning(f"The FaceBlurAI daemon is not answering ({e})") from e
+
+
+def ping():
+    """Status of the running daemon ({'pid', 'models', 'jobs'}), or None if it is not running."""
+    try:
+        with connect() as connection:
+            connection.send({'command': 'status'})
+            return connection.recv()
+    except (DaemonNotRunning, EOFError, OSError):
+        return None
+
+
+def start_daemon(config_path=None, timeout=START_TIMEOUT):
+    """Start a daemon in the background (if none is running) and wait until its models are loaded."""
+    if ping() is not None:
+        return
+    command = [sys.executable, DAEMON_SCRIPT, 'serve']
+    if config_path:
+        command += ['--config', os.path.abspath(config_path)]
+    # Detached from this console, so closing the GUI or the console leaves the models loaded
+    options = {}
+    if sys.platform == 'win32':
+        options['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        options['start_new_session'] = True
+    with open(DAEMON_LOG_PATH, 'a', encoding='utf-8') as log:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(DAEMON_SCRIPT), **options)
+    print("Starting the FaceBlurAI daemon and loading the model...")
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise DaemonNotRunning(f"The daemon stopped while starting, see {DAEMON_LOG_PATH}")
+        if ping() is not None:
+            return
+        time.sleep(0.5)
+    raise DaemonNotRunning(f"The daemon did not start within {timeout} seconds, see {DAEMON_LOG_PATH}")
+
+
+def stop_daemon():
+    try:
+        with connect() as connection:
+            connection.send({'command': 'stop'})
+            connection.recv()
+        return True
+    except (DaemonNotRunning, EOFError, OSError):
+        return False
+
+
+def submit_job(options, confirm=None, cancel_event=None, on_progress=None, on_preview=None, workers=1,
+               threads_per_worker=0):
+    """Blur a video in the daemon and return its ProcessingResult, like process_video() would.
+
+    options are process_video() keyword arguments. Jobs from several clients
+    run one after the other. confirm is asked here with the estimated
+    time; setting cancel_event stops the job in the daemon and keeps what
+    is blurred so far. on_progress gets the progress dicts the job reports,
+    on_preview (if given) a thumbnail of the output now and then. Errors
+    of the job are raised here again, DaemonNotRunning if the daemon stops
+    in the middle of it.
+    """
+    from working import ProcessingResult
+
+    # The daemon runs in another folder, so paths relative to this one are made absolute. The model names
+    # are left as they are: the daemon runs in the script folder where they are found, the models it
+    # preloaded are cached under these names, and the blur shape is chosen by name
+    options = dict(options)
+    for key in ('input_path', 'output_path', 'render_from'):
+        if options.get(key):
+            options[key] = os.path.abspath(options[key])
+
+    with connect() as connection:
+        connection.send({'command': 'run', 'options': options, 'confirm': confirm is not None,
+                         'preview': on_preview is not None, 'workers': workers,
+                         'threads_per_worker': threads_per_worker})
+        cancel_sent = False
+        while True:
+            try:
+                if cancel_event is not None and cancel_event.is_set() and not cancel_sent:
+                    connection.send({'command': 'cancel'})
+                    cancel_sent = True
+                if not connection.poll(0.2):
+                    continue
+                message = connection.recv()
+            except (EOFError, OSError) as e:
+                # The connection closes when the daemon exits or crashes
+                raise DaemonNotRunning(f"The daemon stopped during the job, see {DAEMON_LOG_PATH}") from e
+            if message['type'] == 'progress':
+                if on_progress is not None:
+                    on_progress(message['progress'])
+            elif message['type'] == 'preview':
+                on_preview(message['frame'])
+            elif message['type'] == 'confirm':
+                # The estimate is printed in the daemon's console, so it is shown here too
+                if message['estimated_time'] is not None:
+                    print(f"Estimated time is {format_duration(message['estimated_time'] * 60)}")
+                if message['ask']:
+                    connection.send({'command': 'confirm', 'accept': bool(confirm(message['estimated_time']))})
+            elif message['type'] == 'result':
+                return ProcessingResult(**message['result'])
+            elif message['type'] == 'error':
+                raise message['error']
+            elif message['type'] == 'queued':
+                print(f"Waiting for {message['ahead']} job(s) in the daemon to finish...")
+
+
+class JobConnection:
+    """The daemon's side of one job's connection.
+
+    A reader thread takes the client's messages while the job runs: cancel
+    sets cancel_event, confirm answers go to a queue. A client that goes
+    away cancels its job, so nothing keeps running that nobody waits for.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cancel_event = threading.Event()
+        self.answers = queue.Queue()
+        self.send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        try:
+            while True:
+                message = self.connection.recv()
+                if message.get('command') == 'cancel':
+                    self.cancel_event.set()
+                elif message.get('command') == 'confirm':
+                    self.answers.put(message['accept'])
+        except (EOFError, OSError):
+            self.cancel_event.set()
+            self.answers.put(False)
+
+    def send(self, message):
+        """Send a message, ignoring a client that has gone away."""
+        try:
+            with self.send_lock:
+                self.connection.send(message)
+        except (OSError, ValueError):
+            self.cancel_event.set()
+
+    def confirm(self, estimated_time, ask=True):
+        """Pass the estimate to the client and, if ask, wait for its answer."""
+        self.send({'type': 'confirm', 'estimated_time': estimated_time, 'ask': ask})
+        return self.answers.get() if ask else not self.cancel_event.is_set()
+
+
+class Daemon:
+    """Accepts jobs on a local port and runs them one at a time with models that stay loaded."""
+
+    def __init__(self):
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener(('127.0.0.1', 0), authkey=self.authkey)
+        self.jobs_done = 0
+        self.waiting = 0  # Connections accepted but not handled yet
+        self.running = True
+        self.lock = threading.Lock()
+        self.job_lock = threading.Lock()  # One job at a time, the others wait in order
+
+    def preload(self, model_names, backend='pytorch', inference_size=0):
+        """Load the models and run them once, so the first job starts as fast as the next ones."""
+        import numpy as np
+        from detection import Detector
+        from segments import worker_model
+
+        for model_name in model_names:
+            print(f"Loading {model_name} ({backend})...", flush=True)
+            model = worker_model(model_name, backend, inference_size)
+            Detector(model, inference_size=inference_size).detect([np.zeros((720, 1280, 3), np.uint8)])
+
+    def write_info(self):
+        import json
+
+        info = {'port': self.listener.address[1], 'authkey': self.authkey.hex(), 'pid': os.getpid()}
+        atomic_write(DAEMON_INFO_PATH, json.dumps(info).encode('utf-8'))
+        if sys.platform != 'win32':
+            os.chmod(DAEMON_INFO_PATH, 0o600)
+
+    def serve(self):
+        self.write_info()
+        print(f"FaceBlurAI daemon {os.getpid()} listening on port {self.listener.address[1]}", flush=True)
+        try:
+            while self.running:
+                try:
+                    connection = self.listener.accept()
+                except OSError:
+                    continue  # A client that failed the authentication
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        finally:
+            info = read_daemon_info()
+            if info is not None and info.get('pid') == os.getpid():
+                os.remove(DAEMON_INFO_PATH)
+
+    def handle(self, connection):
+        from segments import _worker_models
+
+        with connection:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                return
+            command = message.get('command')
+            if command == 'status':
+                connection.send({'pid': os.getpid(), 'models': [key[0] for key in _worker_models],
+                                 'jobs': self.jobs_done, 'waiting': self.waiting})
+            elif command == 'stop':
+                self.running = False
+                connection.send({'stopped': True})
+                # Wake up accept() so the serve loop sees running is False
+                try:
+                    Client(self.listener.address, authkey=self.authkey).close()
+                except OSError:
+                    pass
+            elif command == 'run':
+                with self.lock:
+                    self.waiting += 1
+                    ahead = self.waiting - 1
+                if ahead:
+                    connection.send({'type': 'queued', 'ahead': ahead})
+                with self.job_lock:
+                    with self.lock:
+                        self.waiting -= 1
+                    self.run_job(JobConnection(connection), message)
+
+    def run_job(self, job, message):
+        from segments import load_job_models
+        from working import preview_thumbnail, process_video
+
+        options = dict(message['options'])
+        print(f"Job: {options.get('input_path')}", flush=True)
+        try:
+            if message.get('workers', 1) > 1:
+                # The segments run in fresh worker processes, only the main process is warm
+                from segments import process_video_parallel
+                result = process_video_parallel(workers=message['workers'],
+                                                threads_per_worker=message.get('threads_per_worker'),
+                                                cancel_event=job.cancel_event, **options)
+            else:
+                model, person_model = load_job_models(options)
+                result = process_video(model=model, person_model=person_model, cancel_event=job.cancel_event,
+                                       confirm=lambda estimated_time: job.confirm(estimated_time,
+                                                                                  message.get('confirm')),
+                                       progress_callback=lambda progress: job.send({'type': 'progress',
+                                                                                     'progress': progress}),
+                                       # Shrunk here, a full frame is too much to send every few seconds
+                                       preview_callback=lambda frame: job.send({'type': 'preview',
+                                                                                'frame': preview_thumbnail(frame)})
+                                       if message.get('preview') else None,
+                                       **options)
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                job.send({'type': 'error', 'error': e})
+            except Exception:  # Not every exception can be pickled
+                job.send({'type': 'error', 'error': RuntimeError(f"{type(e).__name__}: {e}")})
+        else:
+            job.send({'type': 'result', 'result': asdict(result)})
+        self.jobs_done += 1
+        sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep the YOLO models loaded in the background and run blurring jobs.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="Run the daemon in this console")
+    serve_parser.add_argument('--config', help="config.ini whose models are loaded up front (default: next to working.py)")
+    serve_parser.add_argument('--models', nargs='*', help="Models to load up front instead of the ones in config.ini")
+    subparsers.add_parser('start', help="Start the daemon in the background")
+    subparsers.add_parser('stop', help="Stop the running daemon")
+    subparsers.add_parser('status', help="Show if the daemon is running and which models it has loaded")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        from working import DEFAULT_CONFIG_PATH, load_config
+
+        if ping() is not None:
+            print("A FaceBlurAI daemon is already running.")
+            return 1
+        options = load_config(args.config or DEFAULT_CONFIG_PATH)
+        models = args.models
+        if models is None:
+            models = [options['model_name']] + ([options['cascade_model']] if options['cascade_model'] else [])
+        daemon = Daemon()
+        daemon.preload(models, options['backend'], options['inference_size'])
+        daemon.serve()
+    elif args.command == 'start':
+        start_daemon()
+        print("The FaceBlurAI daemon is running.")
+    elif args.command == 'stop':
+        print("Stopped the daemon." if stop_daemon() else "The daemon is not running.")
+    elif args.command == 'status':
+        status = ping()
+        if status is None:
+            print("The daemon is not running.")
+            return 1
+        print(f"Daemon {status['pid']}: {status['jobs']} jobs done, {status['waiting']} waiting, "
+              f"models loaded: {', '.join(status['models']) or 'none'}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+####################
+# File Name: detection.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Runs the YOLO model on batches of frames and returns the boxes to blur.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import cv2
+
+from metrics import timed
+from tracker import box_iou
+
+
+def round_to_stride(size, stride=32):
+    """size rounded to the nearest multiple of stride, at least one stride. YOLO works on multiples of 32 pixels."""
+    return max(stride, int(round(size / stride)) * stride)
+
+
+def inference_scale(frame_shape, inference_size):
+    """Factor the frame is shrunk by so its longest side fits inference_size (1.0 = no resize)."""
+    if not inference_size:
+        return 1.0
+    return max(1.0, max(frame_shape[:2]) / inference_size)
+
+
+def extract_bboxes(result, desired_class=0, scale=1.0):
+    """Return the (x1, y1, x2, y2) boxes of the desired class from one YOLO result.
+
+    Coordinates are multiplied by scale to map them back to the full-size frame.
+    """
+    return extract_detections(result, desired_class, scale)[0]
+
+
+def extract_detections(result, desired_class=0, scale=1.0):
+    """Like extract_bboxes(), but also return the confidence and class of every box."""
+    bboxes, confidences, classes = [], [], []
+    for box in result.boxes:
+        if box.cls == desired_class:  # Filter by desired class
+            x1, y1, x2, y2 = (int(value * scale) for value in box.xyxy[0])
+            bboxes.append((x1, y1, x2, y2))
+            confidences.append(float(box.conf))
+            classes.append(int(box.cls))
+    return bboxes, confidences, classes
+
+
+def non_max_suppression(boxes, confidences, iou_threshold=0.5):
+    """Indices of the boxes to keep, highest confidence first, dropping boxes that overlap a kept one too much.
+
+    Used to merge the boxes of image parts that overlap, where the same
+    object can be found twice.
+    """
+    order = sorted(range(len(boxes)), key=lambda index: confidences[index], reverse=True)
+    if not order:
+        return []
+    iou = box_iou(boxes, boxes)
+    keep = []
+    for index in order:
+        if all(iou[index, kept] < iou_threshold for kept in keep):
+            keep.append(index)
+    return keep
+
+
+def append_detections(target, detection, offset_x=0, offset_y=0):
+    """Add the (boxes, confidences, classes) of an image part to those of its frame, moving the boxes by its offset."""
+    bboxes, confidences, classes = detection
+    target[0].extend((x1 + offset_x, y1 + offset_y, x2 + offset_x, y2 + offset_y) for x1, y1, x2, y2 in bboxes)
+    target[1].extend(confidences)
+    target[2].extend(classes)
+
+
+def merge_and_log(per_frame, frame_indices, detection_log, iou_threshold=0.5):
+    """Merge the boxes found twice in each frame's (boxes, confidences, classes) and log what is left.
+
+    frame_indices (0, 1, ... if not given) are the frames' positions in the
+    video the log records. Returns the merged detections of every frame, in
+    frame order.
+    """
+    detections = []
+    for bboxes, confidences, classes in per_frame:
+        keep = non_max_suppression(bboxes, confidences, iou_threshold)
+        detections.append(([bboxes[i] for i in keep], [confidences[i] for i in keep], [classes[i] for i in keep]))
+    if detection_log is not None:
+        if frame_indices is None:
+            frame_indices = range(len(detections))
+        for frame_index, (bboxes, confidences, classes) in zip(frame_indices, detections):
+            detection_log.add(frame_index, bboxes, confidences, classes)
+    return detections
+
+
+class Detector:
+    """Run a YOLO model on batches of full-resolution frames.
+
+    With inference_size set (e.g. 640, 960 or 1280) every frame is shrunk so
+    its longest side matches it before it goes through the model, and the
+    boxes are mapped back to full-resolution coordinates. The output video
+    keeps its resolution while inference costs what a small video would.
+    With a detection_log (detection_log.DetectionLog) every box is also
+    recorded with its confidence and class under the frame index it was
+    found in. With a metrics.StageTimer the model call is timed as
+    'inference' and reading the boxes out of its results as 'postprocess'.
+    """
+
+    def __init__(self, model, confidence_threshold=0.3, desired_class=0, inference_size=None, detection_log=None,
+                 metrics=None):
+        self.model = model
+        self.metrics = metrics
+        self.confidence_threshold = confidence_threshold
+        self.desired_class = desired_class
+        self.detection_log = detection_log
+        self.inference_size = round_to_stride(inference_size) if inference_size else None
+
+    def detect(self, frames, frame_indices=None):
+        """Run the model once on a batch of frames and return each frame's boxes in frame order.
+
+        frame_indices are the frames' positions in the video, used for the detection log
+        (0, 1, ... if not given).
+        """
+        return [bboxes for bboxes, _, _ in self.detect_with_scores(frames, frame_indices)]
+
+    def detect_with_scores(self, frames, frame_indices=None):
+        """Like detect(), but return (boxes, confidences, classes) for every frame."""
+        if not frames:
+            return []
+
+        with timed(self.metrics, 'inference'):
+            scale = inference_scale(frames[0].shape, self.inference_size)
+            if scale > 1.0:
+                height, width = frames[0].shape[:2]
+                size = (max(1, round(width / scale)), max(1, round(height / scale)))
+                frames = [cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames]
+
+            # Process the whole batch with YOLO model in streaming mode with confidence threshold.
+            # The results are collected here, so the model's time is not mixed with reading the boxes.
+            options = {'conf': self.confidence_threshold}
+            if self.inference_size:
+                options['imgsz'] = self.inference_size
+            results = list(self.model(frames, stream=True, **options))
+
+        with timed(self.metrics, 'postprocess'):
+            # Results are yielded in the same order as the frames were passed in
+            detections = [extract_detections(result, self.desired_class, scale) for result in results]
+            if self.detection_log is not None:
+                if frame_indices is None:
+                    frame_indices = range(len(detections))
+                for frame_index, (bboxes, confidences, classes) in zip(frame_indices, detections):
+                    self.detection_log.add(frame_index, bboxes, confidences, classes)
+        return detections
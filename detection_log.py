@@ -0,0 +1,105 @@
+####################
+# File Name: detection_log.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Saves the model's detections of every frame next to the output, so the blur can be rendered again without the model.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import io
+import json
+import os
+
+import numpy as np
+
+from checkpoint import atomic_write
+
+
+DETECTION_LOG_VERSION = 1
+
+# One row per detected box, sorted by frame. frame counts the output video's frames from 0.
+DETECTION_DTYPE = np.dtype([('frame', '<i4'), ('box', '<f4', (4,)), ('conf', '<f4'), ('cls', '<i2')])
+
+
+def detection_log_paths(output_path):
+    """Paths of the detection array and its settings file: <output name>.detections.npy/.json."""
+    base = os.path.splitext(output_path)[0] + '.detections'
+    return base + '.npy', base + '.json'
+
+
+class DetectionLog:
+    """Collects the detections of a run and saves them as a memory-mappable array.
+
+    Only frames that went through the model get rows, so replaying the log
+    gives the same input to the tracker as the original run.
+    """
+
+    def __init__(self, rows=None):
+        self.rows = [] if rows is None else rows.tolist()
+
+    def add(self, frame_index, boxes, confidences, classes):
+        for box, confidence, class_id in zip(boxes, confidences, classes):
+            self.rows.append((frame_index, tuple(box), confidence, class_id))
+
+    def to_array(self):
+        rows = np.array(self.rows, dtype=DETECTION_DTYPE)
+        # Early detections of the tracker can come after a keyframe of the same batch
+        return rows[np.argsort(rows['frame'], kind='stable')]
+
+    def save(self, output_path, metadata):
+        """Write the array and the settings of the run next to output_path, each atomically."""
+        array_path, metadata_path = detection_log_paths(output_path)
+        save_detections(array_path, metadata_path, self.to_array(), metadata)
+        return array_path
+
+
+def save_detections(array_path, metadata_path, rows, metadata):
+    buffer = io.BytesIO()
+    np.save(buffer, rows)
+    atomic_write(array_path, buffer.getvalue())
+    metadata = {**metadata, 'version': DETECTION_LOG_VERSION, 'rows': len(rows)}
+    atomic_write(metadata_path, json.dumps(metadata, indent=2).encode('utf-8'))
+
+
+def read_detection_settings(array_path):
+    """Settings of the run that saved a .detections.npy array, from the .json file next to it."""
+    metadata_path = os.path.splitext(array_path)[0] + '.json'
+    with open(metadata_path, encoding='utf-8') as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata.get('version') != DETECTION_LOG_VERSION:
+        raise ValueError(f"Unsupported detection file version in {metadata_path}")
+    return metadata
+
+
+def load_detections(array_path):
+    """Memory-map a saved .detections.npy array and read the settings saved next to it."""
+    metadata = read_detection_settings(array_path)
+    rows = np.load(array_path, mmap_mode='r')
+    if rows.dtype != DETECTION_DTYPE:
+        raise ValueError(f"Unexpected detection array format in {array_path}")
+    return rows, metadata
+
+
+class RecordedDetector:
+    """Stand-in for Detector that replays the detections saved by an earlier run.
+
+    Boxes below confidence_threshold are left out, so the threshold can be
+    raised (but not lowered) without running the model again.
+    """
+
+    def __init__(self, rows, confidence_threshold=0.0, desired_class=0):
+        self.rows = rows
+        self.frames = rows['frame']
+        self.confidence_threshold = confidence_threshold
+        self.desired_class = desired_class
+
+    def detect(self, frames, frame_indices):
+        detections = []
+        for frame_index in frame_indices:
+            first, last = np.searchsorted(self.frames, [frame_index, frame_index + 1])
+            rows = self.rows[first:last]
+            keep = (rows['conf'] >= self.confidence_threshold) & (rows['cls'] == self.desired_class)
+            detections.append([tuple(int(value) for value in box) for box in rows['box'][keep]])
+        return detections
@@ -0,0 +1,337 @@
+####################
+# File Name: live.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Blurs a live camera stream in near real time, dropping frames to stay within a latency budget.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import argparse
+import configparser
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from dataclasses import asdict
+
+import numpy as np
+
+from metrics import Histogram, LATENCY_BUCKETS_MS, RunMetrics, run_report_paths, timed
+from runtime_estimate import PROGRESS_INTERVAL
+from tracker import BoxTracker
+from video_io import FFmpegWriter, LiveReader
+
+
+LATENCY_BUDGET = 1.0  # Seconds from reading a frame to handing it to the encoder
+SKIP_DETECTION_AT = 0.5  # Part of the budget a frame may wait before its detection is skipped
+MAX_SKIPPED = 5  # Frames in a row that may skip detection, after that frames are dropped instead
+SEGMENT_TIME = 10  # Seconds per output segment
+SOURCE_QUEUE_SIZE = 32  # Frames buffered between the stream and the model, the oldest is dropped when full
+STREAM_SCHEMES = ('udp://', 'tcp://', 'rtp://', 'srt://', 'rtmp://', 'rtsp://')
+
+
+def load_live_config(config_path):
+    """The [Live] settings of config.ini."""
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return {
+        'latency_budget': config.getfloat('Live', 'latency', fallback=LATENCY_BUDGET),
+        'max_skipped': config.getint('Live', 'max_skipped', fallback=MAX_SKIPPED),
+        'segment_time': config.getfloat('Live', 'segment_time', fallback=SEGMENT_TIME),
+    }
+
+
+def writes_to_stdout(output):
+    return output in ('-', 'pipe:', 'pipe:1')
+
+
+def output_options(output, segment_time=SEGMENT_TIME):
+    """ffmpeg arguments for the kind of output: HLS playlist, numbered segments, a stream/pipe or one file."""
+    # Keyframes at the segment boundaries, so every segment starts cleanly
+    options = ['-force_key_frames', f'expr:gte(t,n_forced*{segment_time})']
+    if output.endswith('.m3u8'):
+        # A playlist that lists every segment, playable while it grows
+        return options + ['-f', 'hls', '-hls_time', str(segment_time), '-hls_list_size', '0']
+    if '%' in output:
+        # blurred_%05d.mp4: a new file every segment_time seconds
+        return options + ['-f', 'segment', '-segment_time', str(segment_time), '-reset_timestamps', '1']
+    if writes_to_stdout(output) or output.startswith(STREAM_SCHEMES):
+        return options + ['-f', 'flv' if output.startswith('rtmp://') else 'mpegts']
+    if output.endswith('.mp4'):
+        # Fragmented, so a stream that stops without warning still leaves a playable file
+        return options + ['-movflags', '+frag_keyframe+empty_moov']
+    return options
+
+
+def open_live_writer(output, width, height, fps, ffmpeg_path='ffmpeg', video_codec='libx264', crf=23,
+                     preset='veryfast', segment_time=SEGMENT_TIME):
+    output_path = 'pipe:1' if writes_to_stdout(output) else output
+    codec_options = ['-tune', 'zerolatency'] if video_codec in ('libx264', 'libx265') else []
+    # Frames are stamped when they arrive at ffmpeg, so dropped frames leave a gap instead of speeding up the video
+    return FFmpegWriter(output_path, width, height, fps, ffmpeg_path, video_codec, crf, preset,
+                        input_options=['-use_wallclock_as_timestamps', '1'],
+                        output_options=codec_options + output_options(output, segment_time))
+
+
+def read_live_frames(reader, frame_queue, stop_event, errors, counts, metrics=None):
+    """Read the stream as fast as it comes, dropping the oldest waiting frame when the queue is full.
+
+    A live source has to be read in real time, a stalled reader only moves
+    the delay into ffmpeg's or the camera's buffers. Each frame is queued
+    with the time it arrived.
+    """
+    from working import PIPELINE_END
+
+    try:
+        while not stop_event.is_set():
+            with timed(metrics, 'decode'):
+                ret, frame = reader.read()
+            if not ret:
+                break
+            counts['read'] += 1
+            while True:
+                try:
+                    frame_queue.put_nowait((time.monotonic(), frame))
+                    break
+                except queue.Full:
+                    try:
+                        frame_queue.get_nowait()
+                        counts['dropped'] += 1
+                    except queue.Empty:
+                        pass
+    except Exception as e:
+        if not stop_event.is_set():  # Stopping closes the stream under a waiting read
+            errors.append(e)
+    finally:
+        while True:
+            try:
+                frame_queue.put_nowait(PIPELINE_END)
+                break
+            except queue.Full:
+                frame_queue.get_nowait()
+                counts['dropped'] += 1
+
+
+def process_stream(source, output, model_name='YOLOv8n-face.pt', confidence_threshold=0.3, latency_budget=LATENCY_BUDGET,
+                   max_skipped=MAX_SKIPPED, segment_time=SEGMENT_TIME, ffmpeg_path='ffmpeg', resize_video=False,
+                   resolution='480p', video_codec='libx264', crf=23, preset='veryfast', batch_size=1,
+                   detect_every=1, inference_size=0, backend='pytorch', cascade_model=None, cascade_crop_size=320,
+                   cascade_padding=0.15, tile_size=0, tile_overlap=0.2, tile_region=None, blur_method='gaussian',
+                   blur_scale=None, run_report=False, model=None, person_model=None, cancel_event=None,
+                   progress_callback=None, **unused_options):
+    """Blur a live stream into output until the stream ends or cancel_event is set, and return a ProcessingResult.
+
+    source is anything ffmpeg reads live: an rtsp://, http(s):// or udp://
+    URL, a named pipe, or a video file, which is played at its own frame
+    rate. output is an HLS playlist (.m3u8), a numbered segment pattern
+    (blurred_%05d.mp4, a new file every segment_time seconds), a stream
+    URL or pipe:1 (MPEG-TS) or a single file.
+
+    Every frame is blurred within latency_budget seconds of arriving, or
+    not written at all. While frames wait longer than half the budget
+    (SKIP_DETECTION_AT), the model is skipped and the tracker moves the
+    last boxes instead, for at most max_skipped frames in a row; after
+    that the model runs again and frames that are too old are dropped, so
+    a face never goes unblurred for long. Up to batch_size waiting frames
+    go through the model together. The other settings are the ones of
+    working.process_video(), unused ones (input_path, checkpoints, ...)
+    are ignored.
+    """
+    from working import (PIPELINE_END, RESOLUTIONS, ProcessingResult, create_compositor, create_detector,
+                         get_until_stopped)
+    from backends import load_model
+
+    detect_every = max(1, int(detect_every))
+    result = ProcessingResult(input_path=source, output_path=output)
+    metrics = RunMetrics()
+    latency = Histogram(LATENCY_BUCKETS_MS)  # Of the frames written, for the summary
+
+    if model is None:
+        model = load_model(model_name, backend, inference_size)
+    if cascade_model and person_model is None:
+        person_model = load_model(cascade_model, backend, inference_size)
+    detector = create_detector(model, confidence_threshold, inference_size, person_model if cascade_model else None,
+                               cascade_crop_size, cascade_padding, tile_size, tile_overlap, tile_region,
+                               metrics=metrics)
+    compositor = create_compositor(model_name, blur_method, blur_scale)
+    # Skipped and dropped frames leave the boxes behind, the tracker moves them along
+    tracker = BoxTracker()
+
+    print(f"Connecting to {source}...")
+    reader = LiveReader(source, ffmpeg_path, RESOLUTIONS[resolution] if resize_video else None)
+    print(f"Receiving {reader.width}x{reader.height} at {reader.fps:.2f} fps, writing to {output}\n")
+    # The first call sets up the model, it should not count against the budget of the first frames
+    detector.detect([np.zeros((reader.height, reader.width, 3), np.uint8)])
+    writer = open_live_writer(output, reader.width, reader.height, reader.fps, ffmpeg_path, video_codec, crf, preset,
+                              segment_time)
+
+    frame_queue = queue.Queue(maxsize=SOURCE_QUEUE_SIZE)
+    stop_event = threading.Event()
+    errors = []
+    counts = {'read': 0, 'dropped': 0}
+    read_thread = threading.Thread(target=read_live_frames,
+                                   args=(reader, frame_queue, stop_event, errors, counts, metrics), daemon=True)
+    read_thread.start()
+
+    start_time = time.time()
+    last_update = 0.0
+    skipped_in_row = 0
+    frame_number = 0  # Frames that reached the model stage, for detect_every
+    late_dropped = 0
+    frame_cost = 0.0  # Seconds the last batch took per frame, from the model to the writer
+    stream_ended = False
+    try:
+        while not stream_ended and not (cancel_event is not None and cancel_event.is_set()):
+            item = get_until_stopped(frame_queue, stop_event)
+            if item is PIPELINE_END:
+                stream_ended = True
+                break
+            # Take what is waiting, up to a batch, without waiting for more
+            batch = [item]
+            while len(batch) < batch_size:
+                try:
+                    item = frame_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is PIPELINE_END:
+                    stream_ended = True
+                    break
+                batch.append(item)
+
+            # Frames that will miss the budget anyway, counting the time this batch
+            # still takes, could only add to the delay
+            now = time.monotonic()
+            batch_cost = frame_cost * len(batch)
+            fresh = [(arrival, frame) for arrival, frame in batch if now - arrival + batch_cost <= latency_budget]
+            late_dropped += len(batch) - len(fresh)
+            if not fresh:
+                continue
+
+            behind = now - fresh[0][0] > latency_budget * SKIP_DETECTION_AT
+            detect_positions = []
+            for position in range(len(fresh)):
+                wanted = (frame_number + position) % detect_every == 0 or tracker.needs_detection
+                if wanted and behind and skipped_in_row < max_skipped:
+                    skipped_in_row += 1
+                    result.frames_skipped += 1
+                    continue
+                if wanted:
+                    skipped_in_row = 0
+                    detect_positions.append(position)
+            detections = dict(zip(detect_positions, detector.detect([fresh[position][1]
+                                                                      for position in detect_positions])))
+            result.frames_detected += len(detect_positions)
+
+            for position, (arrival, frame) in enumerate(fresh):
+                with timed(metrics, 'postprocess'):
+                    if position in detections:
+                        boxes = tracker.update(frame, detections[position])
+                    else:
+                        boxes = tracker.predict(frame)
+                with timed(metrics, 'blur'):
+                    compositor.apply(frame, boxes)
+                with timed(metrics, 'encode'):
+                    writer.write(frame)
+                delay_ms = (time.monotonic() - arrival) * 1000
+                latency.add(delay_ms)
+                metrics.observe('latency_ms', delay_ms, LATENCY_BUCKETS_MS)
+                result.boxes_detected += len(boxes)
+                result.frames_processed += 1
+            frame_number += len(fresh)
+            frame_cost = (time.monotonic() - now) / len(fresh)
+
+            if time.time() - last_update >= PROGRESS_INTERVAL:
+                last_update = time.time()
+                progress = {'frames_processed': result.frames_processed, 'frames_read': counts['read'],
+                            'frames_dropped': counts['dropped'] + late_dropped,
+                            'frames_skipped': result.frames_skipped,
+                            'fps': result.frames_processed / max(last_update - start_time, 1e-6),
+                            'latency_ms': latency.quantile(0.95)}  # 95% of the frames were written within this
+                sys.stdout.write(f"\rFrame {progress['frames_processed']}, {progress['fps']:.1f} fps, "
+                                 f"delay < {progress['latency_ms']} ms, {progress['frames_dropped']} dropped, "
+                                 f"{progress['frames_skipped']} not detected".ljust(75))
+                sys.stdout.flush()
+                if progress_callback is not None:
+                    progress_callback(progress)
+                metrics.tick(result.frames_processed)
+        result.cancelled = not stream_ended
+    except KeyboardInterrupt:
+        result.cancelled = True
+    finally:
+        stop_event.set()
+        reader.release()  # Also ends a read that waits for the stream
+        read_thread.join()
+        writer.release()
+    if errors:
+        raise errors[0]
+
+    result.total_frames = counts['read']
+    result.frames_dropped = counts['dropped'] + late_dropped
+    result.elapsed_time = time.time() - start_time
+    print(f"\n\nStopped after {round(result.elapsed_time / 60, 2)} minutes: {result.frames_processed} of "
+          f"{result.total_frames} frames written ({result.frames_dropped} dropped to stay within "
+          f"{latency_budget} seconds, {result.frames_skipped} without detection)")
+    if latency.count:
+        print(f"Delay per frame: median below {latency.quantile(0.5)} ms, 95% below {latency.quantile(0.95)} ms, "
+              f"longest {round(latency.max)} ms")
+
+    metrics.tick(result.frames_processed, force=True)
+    metrics.count('frames_dropped', result.frames_dropped)
+    if run_report and not writes_to_stdout(output) and not output.startswith(STREAM_SCHEMES):
+        report_path = run_report_paths(output.replace('%', ''))[0]
+        run_result = {**asdict(result), 'fps': result.fps}
+        del run_result['metrics']
+        metrics.save_report(report_path, result.frames_processed, result=run_result,
+                            settings={'model_name': model_name, 'backend': backend, 'latency_budget': latency_budget,
+                                      'max_skipped': max_skipped, 'batch_size': batch_size,
+                                      'detect_every': detect_every, 'inference_size': inference_size,
+                                      'width': reader.width, 'height': reader.height, 'fps': reader.fps})
+        print(f"Run report saved as: {os.path.basename(report_path)}")
+    result.metrics = metrics.report(result.frames_processed)
+    return result
+
+
+def main(argv=None):
+    from working import DEFAULT_CONFIG_PATH, load_config, watch_for_quit
+
+    parser = argparse.ArgumentParser(description="Blur a live stream (RTSP/HTTP/UDP, a named pipe or a file played "
+                                                 "in real time) while it is received.")
+    parser.add_argument('source', help="Stream URL, named pipe or video file")
+    parser.add_argument('output', help="HLS playlist (.m3u8), segment pattern (blurred_%%05d.mp4), stream URL, "
+                                       "pipe:1 or a file")
+    parser.add_argument('--config', default=DEFAULT_CONFIG_PATH, help="Path to config.ini (default: next to working.py)")
+    parser.add_argument('--model', dest='model_name', help="YOLO model file (overrides yolo_model)")
+    parser.add_argument('--latency', dest='latency_budget', type=float,
+                        help="Seconds a frame may take from arriving to being written (overrides latency)")
+    parser.add_argument('--segment-time', type=float, help="Seconds per output segment (overrides segment_time)")
+    args = parser.parse_args(argv)
+
+    options = load_config(args.config, model_name=args.model_name)
+    options.update(load_live_config(args.config))
+    for key in ('latency_budget', 'segment_time'):
+        if getattr(args, key) is not None:
+            options[key] = getattr(args, key)
+    # Cutting a live stream has no meaning, and every frame is needed as it comes
+    for key in ('input_path', 'cut_video', 'workers', 'threads_per_worker', 'daemon'):
+        options.pop(key)
+
+    # Ctrl+C would also stop the ffmpeg processes mid-write, 'q' lets them finish the output
+    cancel_event = threading.Event()
+    threading.Thread(target=watch_for_quit, args=(cancel_event, threading.Event()), daemon=True).start()
+    # With the video on stdout, the messages go to stderr
+    with redirect_stdout(sys.stderr if writes_to_stdout(args.output) else sys.stdout):
+        print("Type 'q' and press 'Enter' to stop.")
+        try:
+            process_stream(args.source, args.output, cancel_event=cancel_event, **options)
+        except (IOError, ValueError) as e:
+            print(f"Error: {e}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
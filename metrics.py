@@ -0,0 +1,179 @@
+####################
+# File Name: metrics.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Measures how much time each stage of the blurring pipeline takes during a run, and writes it as a report.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from checkpoint import atomic_write
+
+
+# Stages of process_video(), in pipeline order
+STAGES = ('decode', 'inference', 'postprocess', 'blur', 'encode')
+
+# Upper bounds of the histogram buckets, for stage latencies (ms) and for counts like boxes per frame
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 60000)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+
+TIMELINE_INTERVAL = 10.0  # Seconds between the fps samples of the timeline (and lines of the metrics file)
+
+
+def run_report_paths(output_path):
+    """Paths of the run report and the streamed metrics: <output name>.report.json/.metrics.jsonl."""
+    base = os.path.splitext(output_path)[0]
+    return base + '.report.json', base + '.metrics.jsonl'
+
+
+class StageTimer:
+    """Wall-clock time spent in each pipeline stage, summed over all calls.
+
+    Decoding and encoding run in their own threads, so adding is locked.
+    The stages overlap in time, so their sum can be larger than the run.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds, calls=1):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def as_dict(self, frames=0):
+        """{stage: {'seconds', 'calls', 'ms_per_frame'}}, ms_per_frame spread over frames output frames."""
+        stages = [stage for stage in STAGES if stage in self.seconds]
+        stages += sorted(stage for stage in self.seconds if stage not in STAGES)
+        return {stage: {'seconds': self.seconds[stage], 'calls': self.calls[stage],
+                        'ms_per_frame': self.seconds[stage] / frames * 1000 if frames else 0.0}
+                for stage in stages}
+
+
+class Histogram:
+    """Number of values up to each bound, plus a last bucket for everything larger."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket the given fraction of the values falls in (None if it is the last one)."""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def as_dict(self):
+        buckets = {f'<={bound}': count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f'>{self.bounds[-1]}'] = self.counts[-1]
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0, 'max': self.max,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'buckets': buckets}
+
+
+class RunMetrics(StageTimer):
+    """StageTimer that also keeps counters, histograms and the fps over time of a run.
+
+    Every timed call goes into a '<stage>_ms' latency histogram. tick() is
+    called with the frames processed so far and samples the fps every
+    interval seconds; with stream_to() each sample is also appended to a
+    JSON-lines file as it happens, so a long (or crashed) run can be
+    followed while it works. report() gathers everything for the JSON report.
+    """
+
+    def __init__(self, interval=TIMELINE_INTERVAL):
+        super().__init__()
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.last = {}  # Latest value of every histogram, e.g. the current queue depths
+        self.timeline = []
+        self.interval = interval
+        self.start_time = time.time()
+        self._last_tick = (self.start_time, 0)
+        self._stream = None
+
+    def add(self, stage, seconds, calls=1):
+        super().add(stage, seconds, calls)
+        self.observe(stage + '_ms', seconds * 1000 / calls, LATENCY_BUCKETS_MS)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value, bounds=COUNT_BUCKETS):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(bounds)
+            self.histograms[name].add(value)
+            self.last[name] = value
+
+    def stream_to(self, path):
+        """Append a line with the counters, stage times and fps to path at every timeline sample."""
+        self._stream = open(path, 'a', encoding='utf-8')
+
+    def tick(self, frames_processed, force=False):
+        """Sample the fps since the last sample if interval seconds have passed (or with force)."""
+        now = time.time()
+        last_time, last_frames = self._last_tick
+        if not force and now - last_time < self.interval:
+            return
+        self._last_tick = (now, frames_processed)
+        point = {'time': round(now - self.start_time, 1), 'frames': frames_processed,
+                 'fps': (frames_processed - last_frames) / max(now - last_time, 1e-6)}
+        self.timeline.append(point)
+        if self._stream is not None:
+            with self._lock:
+                line = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), **point, 'counters': dict(self.counters),
+                        'seconds': dict(self.seconds), 'last': dict(self.last)}
+            self._stream.write(json.dumps(line) + '\n')
+            self._stream.flush()
+
+    def report(self, frames=0, **extra):
+        with self._lock:
+            return {**extra, 'stages': self.as_dict(frames), 'counters': dict(self.counters),
+                    'histograms': {name: histogram.as_dict() for name, histogram in sorted(self.histograms.items())},
+                    'timeline': list(self.timeline)}
+
+    def save_report(self, path, frames=0, **extra):
+        atomic_write(path, json.dumps(self.report(frames, **extra), indent=2).encode('utf-8'))
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+def timed(timer, stage):
+    """timer.time(stage), or a context that does nothing when no timer is used."""
+    return timer.time(stage) if timer is not None else nullcontext()
@@ -0,0 +1,84 @@
+####################
+# File Name: motion_gate.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Skips the YOLO model on frames that barely changed since the last frame it ran on, for tripod footage.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import cv2
+import numpy as np
+
+
+GATE_WIDTH = 160  # Frames are compared as grayscale copies downscaled to this width
+PIXEL_DELTA = 20  # A pixel counts as changed when its gray value moved more than this
+
+
+def motion_signature(frame):
+    """Small blurred grayscale copy of the frame that is compared between frames."""
+    height, width = frame.shape[:2]
+    size = (GATE_WIDTH, max(1, round(height * GATE_WIDTH / width)))
+    gray = cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    # Smooths out sensor noise and compression artifacts, which would otherwise count as motion
+    return cv2.GaussianBlur(gray, (3, 3), 0)
+
+
+def changed_percent(signature_a, signature_b):
+    """Percentage of pixels that differ noticeably between two motion signatures."""
+    return np.count_nonzero(cv2.absdiff(signature_a, signature_b) > PIXEL_DELTA) * 100.0 / signature_a.size
+
+
+class MotionGate:
+    """Reuse the boxes of the last detected frame while the picture stays still.
+
+    Each frame the detector would get is compared to the last frame the
+    model actually ran on (not to the previous frame, so slow changes add up
+    until they count). If less than threshold percent of it changed, the
+    model is skipped and the frame gets the boxes of that frame, also in the
+    detection log. Every force_every frames the model runs anyway, so a
+    face that appears without changing much of the picture is still found.
+    Holds no model, so it can be saved in a checkpoint.
+    """
+
+    def __init__(self, threshold=0.3, force_every=30):
+        self.threshold = threshold
+        self.force_every = max(1, int(force_every))
+        self.reference = None  # Motion signature of the last frame the model ran on
+        self.frames_since_detection = 0
+        self.last_detection = ([], [], [])  # (boxes, confidences, classes) of that frame
+        self.frames_skipped = 0
+
+    def is_static(self, frame):
+        """Decide if the model can be skipped for frame; if not, frame becomes the new reference."""
+        signature = motion_signature(frame)
+        if (self.reference is not None and self.reference.shape == signature.shape
+                and self.frames_since_detection < self.force_every - 1
+                and changed_percent(signature, self.reference) < self.threshold):
+            self.frames_since_detection += 1
+            self.frames_skipped += 1
+            return True
+        self.reference = signature
+        self.frames_since_detection = 0
+        return False
+
+    def detect(self, detector, frames, frame_indices):
+        """Like detector.detect(), but only the frames that moved go through the model (in one batch)."""
+        moving = [position for position, frame in enumerate(frames) if not self.is_static(frame)]
+        detections = [None] * len(frames)
+        found = detector.detect_with_scores([frames[position] for position in moving],
+                                            [frame_indices[position] for position in moving])
+        for position, detection in zip(moving, found):
+            detections[position] = detection
+
+        # A static frame gets the boxes of the last frame before it that went through the model
+        previous = self.last_detection
+        for position, detection in enumerate(detections):
+            if detection is None:
+                detections[position] = previous
+                if detector.detection_log is not None:
+                    detector.detection_log.add(frame_indices[position], *previous)
+            previous = detections[position]
+        self.last_detection = previous
+        return [bboxes for bboxes, _, _ in detections]
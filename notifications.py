@@ -0,0 +1,71 @@
+####################
+# File Name: notifications.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Flashes the console icon and plays a sound when a video is done. Only on Windows, elsewhere nothing happens.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import sys
+
+
+FLASHW_STOP = 0
+FLASHW_CAPTION = 0x00000001
+FLASHW_TRAY = 0x00000002
+FLASHW_ALL = 0x00000003
+FLASHW_TIMER = 0x00000004
+FLASHW_TIMERNOFG = 0x0000000C
+
+# The Windows API and winsound only exist on Windows
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+    import winsound
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    user32 = ctypes.WinDLL('user32', use_last_error=True)
+
+    class FLASHWINFO(ctypes.Structure):
+        _fields_ = (('cbSize', wintypes.UINT),
+                    ('hwnd', wintypes.HWND),
+                    ('dwFlags', wintypes.DWORD),
+                    ('uCount', wintypes.UINT),
+                    ('dwTimeout', wintypes.DWORD))
+
+        def __init__(self, hwnd, flags=FLASHW_TRAY, count=5, timeout_ms=0):
+            self.cbSize = ctypes.sizeof(self)
+            self.hwnd = hwnd
+            self.dwFlags = flags
+            self.uCount = count
+            self.dwTimeout = timeout_ms
+
+    kernel32.GetConsoleWindow.restype = wintypes.HWND
+    user32.FlashWindowEx.argtypes = (ctypes.POINTER(FLASHWINFO),)
+
+
+def play_notification_sound():
+    if sys.platform == 'win32':
+        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
+
+
+def flash_console_icon(count=5):
+    """Flash the taskbar icon of the console window count times. Off Windows it does nothing and returns False."""
+    if sys.platform != 'win32':
+        return False
+    hwnd = kernel32.GetConsoleWindow()
+    if not hwnd:
+        raise ctypes.WinError(ctypes.get_last_error())
+    winfo = FLASHWINFO(hwnd, count=count)
+    previous_state = user32.FlashWindowEx(ctypes.byref(winfo))
+    return previous_state
+
+
+def notify_finished(count=10):
+    """Flash the console icon and play a sound. A notification that fails (e.g. no console window) is skipped."""
+    try:
+        flash_console_icon(count=count)
+    except OSError:
+        pass
+    play_notification_sound()
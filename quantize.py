@@ -0,0 +1,203 @@
+####################
+# File Name: quantize.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Builds INT8 versions of the YOLO models, calibrated on frames of our own videos, and reports their recall and speed.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from backends import export_model, export_size, load_model, model_hash, quantized_model_name
+from batch import collect_videos
+from detection import Detector
+from tracker import match_boxes
+
+
+MAX_SAMPLE_SIDE = 1280  # Sampled frames are shrunk to this longest side to keep memory use down
+LETTERBOX_COLOR = 114  # Padding value YOLO uses around letterboxed frames
+RECALL_IOU = 0.5  # A box of the INT8 model counts as found when it overlaps a PyTorch box this much
+REPORT_FILE = 'quantization_report.json'
+
+
+def sample_frames(videos, count):
+    """Read count frames spread evenly over all the videos."""
+    captures = [cv2.VideoCapture(video) for video in videos]
+    lengths = [int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) for capture in captures]
+    total = sum(lengths)
+    frames = []
+    for position in np.linspace(0, total, count, endpoint=False).astype(int):
+        # Find the video the position falls in
+        for capture, length in zip(captures, lengths):
+            if position < length:
+                break
+            position -= length
+        capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+        ret, frame = capture.read()
+        if not ret:
+            continue
+        scale = MAX_SAMPLE_SIDE / max(frame.shape[:2])
+        if scale < 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        frames.append(frame)
+    for capture in captures:
+        capture.release()
+    return frames
+
+
+def letterbox_input(frame, size):
+    """Frame as the 1x3xSIZExSIZE float input YOLO expects: scaled to fit, padded, RGB, 0-1."""
+    height, width = frame.shape[:2]
+    scale = size / max(height, width)
+    resized = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((size, size, 3), LETTERBOX_COLOR, dtype=np.uint8)
+    top = (size - resized.shape[0]) // 2
+    left = (size - resized.shape[1]) // 2
+    canvas[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return np.ascontiguousarray(canvas[:, :, ::-1].transpose(2, 0, 1))[None].astype(np.float32) / 255.0
+
+
+def quantize_model(model_name, calibration_frames, inference_size=0):
+    """Build the INT8 OpenVINO model of model_name, calibrated on the given frames, and return its folder.
+
+    The model is exported to OpenVINO first and then quantized with NNCF.
+    The box decoding at the end of the detection head stays in floating
+    point, like Ultralytics' own INT8 export does, so the box coordinates
+    keep their precision.
+    """
+    import nncf
+    import openvino as ov
+    from ultralytics import YOLO
+
+    size = export_size(inference_size)
+    fp32_dir = export_model(model_name, 'openvino', inference_size)
+    ov_model = ov.Core().read_model(glob.glob(os.path.join(fp32_dir, '*.xml'))[0])
+
+    head = '.'.join(list(YOLO(model_name).model.named_modules())[-1][0].split('.')[:2])
+    ignored_scope = nncf.IgnoredScope(
+        patterns=[f'.*{head}/.*/Add', f'.*{head}/.*/Sub*', f'.*{head}/.*/Mul*', f'.*{head}/.*/Div*',
+                  f'.*{head}\\.dfl.*'],
+        types=['Sigmoid'])
+    dataset = nncf.Dataset(calibration_frames, lambda frame: letterbox_input(frame, size))
+    quantized = nncf.quantize(ov_model, dataset, preset=nncf.QuantizationPreset.MIXED,
+                              subset_size=len(calibration_frames), ignored_scope=ignored_scope)
+
+    # Written to a temporary folder first, so a half-written model is never picked up
+    target = quantized_model_name(model_name)
+    temp_target = target + '.tmp'
+    shutil.rmtree(temp_target, ignore_errors=True)
+    os.makedirs(temp_target)
+    ov.save_model(quantized, os.path.join(temp_target, os.path.splitext(os.path.basename(model_name))[0] + '.xml'),
+                  compress_to_fp16=False)
+    shutil.copy(os.path.join(fp32_dir, 'metadata.yaml'), temp_target)  # Class names and input size for Ultralytics
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(temp_target, target)
+    return target
+
+
+def run_detector(model, frames, confidence_threshold=0.3, inference_size=0, batch_size=4):
+    """Detect on all frames and return (boxes per frame, milliseconds per frame)."""
+    detector = Detector(model, confidence_threshold, inference_size=inference_size)
+    detector.detect(frames[:batch_size])  # Warm up
+    detections = []
+    start = time.perf_counter()
+    for index in range(0, len(frames), batch_size):
+        detections.extend(detector.detect(frames[index:index + batch_size]))
+    return detections, (time.perf_counter() - start) / len(frames) * 1000
+
+
+def compare_detections(reference, candidate):
+    """Recall of the candidate boxes against the reference boxes, and the number of extra candidate boxes."""
+    reference_count = sum(len(boxes) for boxes in reference)
+    candidate_count = sum(len(boxes) for boxes in candidate)
+    found = sum(len(match_boxes(ref, cand, RECALL_IOU)) for ref, cand in zip(reference, candidate))
+    recall = found / reference_count if reference_count else 1.0
+    return recall, candidate_count - found
+
+
+def evaluate(model_name, quantized_name, frames, confidence_threshold=0.3, inference_size=0, batch_size=4):
+    """Time PyTorch FP32, OpenVINO FP32 and OpenVINO INT8 on the frames and compare their boxes."""
+    reference, pytorch_ms = run_detector(load_model(model_name), frames, confidence_threshold, inference_size,
+                                         batch_size)
+    rows = [{'variant': 'pytorch fp32', 'ms_per_frame': pytorch_ms, 'recall': 1.0, 'extra_boxes': 0}]
+    for variant, model in (('openvino fp32', load_model(model_name, 'openvino', inference_size)),
+                           ('openvino int8', load_model(quantized_name))):
+        detections, ms = run_detector(model, frames, confidence_threshold, inference_size, batch_size)
+        recall, extra = compare_detections(reference, detections)
+        rows.append({'variant': variant, 'ms_per_frame': ms, 'recall': recall, 'extra_boxes': extra})
+    for row in rows:
+        row['speedup'] = pytorch_ms / row['ms_per_frame']
+    return {'reference_boxes': sum(len(boxes) for boxes in reference), 'rows': rows}
+
+
+def print_report(model_name, report):
+    print(f"\n{model_name}: {report['evaluation_frames']} frames, {report['reference_boxes']} boxes found by PyTorch\n")
+    print(f"{'variant':<16}{'ms/frame':>10}{'speedup':>10}{'recall':>10}{'extra':>8}")
+    for row in report['rows']:
+        print(f"{row['variant']:<16}{row['ms_per_frame']:>10.1f}{row['speedup']:>9.2f}x"
+              f"{row['recall']:>10.1%}{row['extra_boxes']:>8}")
+
+
+def main(argv=None):
+    from working import DEFAULT_CONFIG_PATH, load_config
+
+    parser = argparse.ArgumentParser(description="Build INT8 models calibrated on our own videos and report recall and speed.")
+    parser.add_argument('videos', nargs='+', help="Folders, glob patterns or video files to sample frames from")
+    parser.add_argument('--config', default=DEFAULT_CONFIG_PATH, help="Path to config.ini (default: next to working.py)")
+    parser.add_argument('--models', nargs='+', help="Model files to quantize (default: yolo_model in config.ini)")
+    parser.add_argument('--calibration-frames', type=int, default=300, help="Frames used to calibrate the INT8 ranges")
+    parser.add_argument('--evaluation-frames', type=int, default=100, help="Other frames used for the recall and speed report")
+    parser.add_argument('--inference-size', type=int, help="inference_size the models will run at (default: from config.ini)")
+    parser.add_argument('--report', help="Also write the reports of all models to this JSON file")
+    args = parser.parse_args(argv)
+
+    options = load_config(args.config)
+    models = args.models or [options['model_name']]
+    inference_size = options['inference_size'] if args.inference_size is None else args.inference_size
+
+    videos = collect_videos(args.videos)
+    if not videos:
+        print("No videos found.")
+        return 1
+    frames = sample_frames(videos, args.calibration_frames + args.evaluation_frames)
+    # Evaluation frames are spread out like the calibration frames, so both sets cover all videos
+    evaluation_indices = set(np.linspace(0, len(frames), args.evaluation_frames, endpoint=False).astype(int))
+    evaluation_frames = [frame for index, frame in enumerate(frames) if index in evaluation_indices]
+    calibration_frames = [frame for index, frame in enumerate(frames) if index not in evaluation_indices]
+    print(f"Sampled {len(calibration_frames)} calibration and {len(evaluation_frames)} evaluation frames "
+          f"from {len(videos)} videos.")
+
+    reports = {}
+    for model_name in models:
+        print(f"\nQuantizing {model_name}...")
+        quantized_name = quantize_model(model_name, calibration_frames, inference_size)
+        report = evaluate(model_name, quantized_name, evaluation_frames, options['confidence_threshold'],
+                          inference_size, options['batch_size'])
+        report.update(model=model_name, model_hash=model_hash(model_name), quantized_model=quantized_name,
+                      inference_size=inference_size, calibration_frames=len(calibration_frames),
+                      evaluation_frames=len(evaluation_frames), videos=videos)
+        with open(os.path.join(quantized_name, REPORT_FILE), 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+        print_report(model_name, report)
+        print(f"\nSelect it with yolo_model = {quantized_name} in config.ini, or in the GUI.")
+        reports[model_name] = report
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(reports, report_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+####################
+# File Name: runtime_estimate.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Estimates processing time from timings measured on this machine, and shows fps and ETA while a video is processed.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import json
+import os
+import platform
+import sys
+import time
+
+from checkpoint import atomic_write
+
+
+# Timings of all machines are kept next to this script, under the name of the machine
+TIMINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime_timings.json')
+
+CALIBRATION_FRAMES = 8  # Frames timed through the model when there is no timing for it yet
+MIN_RECORD_FRAMES = 30  # Shorter runs are too noisy to refine the timings with
+RUN_WEIGHT = 0.5  # How much a finished run moves the stored timing towards what it measured
+PROGRESS_INTERVAL = 1.0  # Seconds between updates of the progress line
+
+
+def machine_name():
+    """Name of this machine in the timings file, e.g. WS-042 (AMD64, 16 threads)."""
+    return f"{platform.node()} ({platform.machine()}, {os.cpu_count()} threads)"
+
+
+def detection_key(model_name, backend, width, height, inference_size, batch_size, cascade_model=None, tile_size=0,
+                  tile_count=0):
+    """Key of the model timing: it depends on the model, the runtime and the size and number of frames per call."""
+    model = os.path.basename(model_name.rstrip('\\/'))
+    if os.path.isfile(model_name):
+        from backends import model_hash
+        model += '@' + model_hash(model_name)  # A retrained model with the same name is timed again
+    if cascade_model:
+        model = os.path.basename(cascade_model) + ' > ' + model
+    key = f"{model}|{backend}|{width}x{height}|{inference_size or 'full'}|batch {batch_size}"
+    if tile_size and not cascade_model:
+        key += f"|{tile_count} tiles of {tile_size}"
+    return key
+
+
+def overhead_key(width, height, encoder, preset, tracking):
+    """Key of the time per frame spent outside the model: decoding, tracking, blurring and encoding."""
+    return f"{width}x{height}|{encoder}|{preset if encoder == 'ffmpeg' else 'mp4v'}|{'tracking' if tracking else 'no tracking'}"
+
+
+def format_duration(seconds):
+    if seconds >= 2 * 60 * 60:
+        return f"{round(seconds / (60 * 60), 1)} hours"
+    if seconds >= 60:
+        return f"{round(seconds / 60, 1)} minutes"
+    return f"{round(seconds)} seconds"
+
+
+class TimingStore:
+    """Seconds per frame measured on this machine, saved in a JSON file shared by all machines.
+
+    'detection' timings are per frame that goes through the model, 'overhead'
+    timings per output frame. Each entry keeps the number of finished runs
+    it was refined with (0 = only the calibration benchmark).
+    """
+
+    def __init__(self, path=TIMINGS_PATH, machine=None):
+        self.path = path
+        self.machine = machine or machine_name()
+
+    def _read_all(self):
+        try:
+            with open(self.path, encoding='utf-8') as timings_file:
+                return json.load(timings_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, kind, key):
+        """Stored seconds per frame, or None if it was never measured on this machine."""
+        entry = self._read_all().get(self.machine, {}).get(kind, {}).get(key)
+        return entry['seconds'] if entry else None
+
+    def put(self, kind, key, seconds, from_run=False):
+        """Store a measurement. A run's measurement is blended with the stored one, a benchmark replaces it."""
+        # Read again right before writing, so timings saved by other runs in the meantime are kept
+        timings = self._read_all()
+        entries = timings.setdefault(self.machine, {}).setdefault(kind, {})
+        entry = entries.get(key)
+        if from_run and entry and entry['runs']:
+            seconds = entry['seconds'] * (1 - RUN_WEIGHT) + seconds * RUN_WEIGHT
+        runs = (entry['runs'] if entry else 0) + 1 if from_run else 0
+        entries[key] = {'seconds': seconds, 'runs': runs, 'updated': time.strftime('%Y-%m-%d %H:%M')}
+        atomic_write(self.path, json.dumps(timings, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def read_calibration_frames(video_path, count=CALIBRATION_FRAMES, size=None):
+    """Read count consecutive frames from the middle of the video, resized to size if given."""
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, max(0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) // 2 - count))
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA) if size else frame)
+    cap.release()
+    return frames
+
+
+def calibrate_detection(detector, frames, batch_size=1):
+    """Seconds per frame the detector needs, timed on frames after one warm-up batch."""
+    detector.detect(frames[:batch_size])  # The first call sets up the model
+    start = time.perf_counter()
+    for index in range(0, len(frames), batch_size):
+        detector.detect(frames[index:index + batch_size])
+    return (time.perf_counter() - start) / len(frames)
+
+
+def estimate_seconds(store, frames, detected_frames, detect_key=None, other_key=None):
+    """Estimated seconds to process frames of which detected_frames go through the model, or None without timings.
+
+    Without a model timing (detect_key is None) only the overhead counts,
+    as when rendering from saved detections.
+    """
+    detect_seconds = store.get('detection', detect_key) if detect_key else 0.0
+    if detect_seconds is None:
+        return None
+    # The overhead is only known after the first run with these frames and encoder
+    other_seconds = store.get('overhead', other_key) or 0.0
+    if not detect_key and not other_seconds:
+        return None
+    return detected_frames * detect_seconds + frames * other_seconds
+
+
+def record_run(store, frames, detected_frames, elapsed_time, detect_time, detect_key=None, other_key=None):
+    """Refine the stored timings with what a finished run measured.
+
+    detect_time is the time the run spent in the model; the rest of
+    elapsed_time is spread over the frames as overhead.
+    """
+    if frames < MIN_RECORD_FRAMES:
+        return
+    if detect_key and detected_frames:
+        store.put('detection', detect_key, detect_time / detected_frames, from_run=True)
+    store.put('overhead', other_key, max(0.0, elapsed_time - detect_time) / frames, from_run=True)
+
+
+def format_progress(progress):
+    """One line like 'Frame 1200/5000 (24%), 23.5 fps, ETA 2.7 minutes' from a progress dict."""
+    line = f"Frame {progress['frames_processed']}/{progress['total_frames']}"
+    if progress['total_frames']:
+        line += f" ({progress['frames_processed'] / progress['total_frames']:.0%})"
+    line += f", {progress['fps']:.1f} fps"
+    if progress['eta_seconds'] is not None:
+        line += f", ETA {format_duration(progress['eta_seconds'])}"
+    return line
+
+
+class ProgressMeter:
+    """Keeps one console line up to date with the frames done, the fps and the ETA.
+
+    The fps is measured over this run only, so frames of a resumed
+    checkpoint don't make it look faster than it is. callback, if given, is
+    called with the same numbers as a dict (see progress()); with show=False
+    nothing is printed.
+    """
+
+    def __init__(self, total_frames, done_frames=0, stream=None, interval=PROGRESS_INTERVAL, callback=None,
+                 show=True):
+        self.total_frames = total_frames
+        self.first_frames = done_frames
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.callback = callback
+        self.show = show
+        self.start_time = time.time()
+        self.last_update = 0.0
+
+    def progress(self, done_frames, boxes_detected=0):
+        """frames_processed, total_frames, fps, eta_seconds (None when unknown) and boxes_per_frame."""
+        fps = (done_frames - self.first_frames) / max(time.time() - self.start_time, 1e-6)
+        eta = (self.total_frames - done_frames) / fps if fps > 0 and self.total_frames > done_frames else None
+        return {'frames_processed': done_frames, 'total_frames': self.total_frames, 'fps': fps, 'eta_seconds': eta,
+                'boxes_per_frame': boxes_detected / done_frames if done_frames else 0.0}
+
+    def update(self, done_frames, boxes_detected=0, force=False):
+        now = time.time()
+        if not force and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        progress = self.progress(done_frames, boxes_detected)
+        if self.show:
+            self.stream.write('\r' + format_progress(progress).ljust(60))
+            self.stream.flush()
+        if self.callback is not None:
+            self.callback(progress)
+
+    def finish(self, done_frames, boxes_detected=0):
+        self.update(done_frames, boxes_detected, force=True)
+        if self.show:
+            self.stream.write('\n')
+            self.stream.flush()
@@ -0,0 +1,383 @@
+####################
+# File Name: segments.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Splits a video into segments, blurs them in parallel worker processes and joins the result.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+from backends import load_model, prepare_backend
+from checkpoint import Checkpoint, job_fingerprint
+from detection_log import detection_log_paths, load_detections, save_detections
+from metrics import RunMetrics, StageTimer, run_report_paths, timed
+from runtime_estimate import format_duration
+from video_io import frames_before, keyframe_times
+
+
+OVERLAP_FRAMES = 15  # Frames before each segment that only prime the tracker and box buffer
+CANCEL_POLL = 0.5  # Seconds between checks of the cancel event while the segments run
+
+# Models loaded by this worker process, reused for every segment it gets
+_worker_models = {}
+
+
+def plan_segments(input_path, segment_count, ffmpeg_path='ffmpeg', start=0.0, end=None):
+    """Split [start, end) into about segment_count (start, end) ranges in seconds.
+
+    Boundaries are moved to the nearest keyframe so every worker can seek
+    without decoding from far back. If the keyframes can't be read, the
+    boundaries are placed evenly instead, which is still frame-accurate.
+    """
+    try:
+        keyframes = keyframe_times(input_path, ffmpeg_path)
+    except (OSError, subprocess.CalledProcessError):
+        keyframes = []
+
+    boundaries = [start]
+    for index in range(1, segment_count):
+        ideal = start + index * (end - start) / segment_count
+        candidates = [t for t in keyframes if boundaries[-1] < t < end]
+        boundary = min(candidates, key=lambda t: abs(t - ideal)) if candidates else ideal
+        if boundaries[-1] < boundary < end:
+            boundaries.append(boundary)
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def init_worker(threads):
+    """Give a worker process its share of the CPU before torch is loaded."""
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    cv2.setNumThreads(threads)
+    import torch
+    torch.set_num_threads(threads)
+
+
+def worker_model(model_name, backend='pytorch', inference_size=0):
+    """The YOLO model for model_name, loaded once per worker process.
+
+    Torch is first imported here, after init_worker has set the thread budget.
+    """
+    key = (model_name, backend, inference_size)
+    if key not in _worker_models:
+        _worker_models[key] = load_model(model_name, backend, inference_size)
+    return _worker_models[key]
+
+
+def worker_backend(model_name, backend='pytorch', inference_size=0):
+    """Export the model once before the workers start, and return the backend they should use.
+
+    Returns 'pytorch' when the export is not possible, so the workers
+    don't each try (and fail) again.
+    """
+    if prepare_backend(model_name, backend, inference_size) == model_name:
+        return 'pytorch'
+    return backend
+
+
+def job_backend(options):
+    """Backend the workers of a job should use, with the exports of its model and person model made beforehand."""
+    backend, inference_size = options.get('backend', 'pytorch'), options.get('inference_size', 0)
+    if backend == 'pytorch' or options.get('render_from'):
+        return backend
+    backend = worker_backend(options['model_name'], backend, inference_size)
+    if options.get('cascade_model') and backend != 'pytorch':
+        prepare_backend(options['cascade_model'], backend, inference_size)
+    return backend
+
+
+def load_job_models(options):
+    """(model, person model) for a job's options, loaded once per process; None for what the job doesn't need."""
+    if options.get('render_from'):
+        return None, None  # The boxes come from saved detections
+    backend, inference_size = options.get('backend', 'pytorch'), options.get('inference_size', 0)
+    model = worker_model(options['model_name'], backend, inference_size)
+    person_model = None
+    if options.get('cascade_model'):
+        person_model = worker_model(options['cascade_model'], backend, inference_size)
+    return model, person_model
+
+
+def _process_segment(job):
+    """Blur one segment in a worker process and return its ProcessingResult."""
+    from working import process_video
+
+    # Segments are always cut while decoding, whatever stream_input is set to. The workers share
+    # the CPU, so their speed says nothing about a single run and they don't print progress lines.
+    options = {**job['options'], 'stream_input': True, 'track_runtime': False}
+    # The metrics come back in the result, the report of the whole video is written by the main process
+    metrics = RunMetrics() if job['collect_metrics'] else None
+    model, person_model = load_job_models(options)
+    return process_video(job['input_path'], output_path=job['output_path'], cut_video=True,
+                         start_time=job['read_start'], end_time=job['read_end'], warmup_frames=job['warmup_frames'],
+                         keep_audio=False, metrics=metrics, model=model, person_model=person_model,
+                         cancel_event=job.get('cancel_event'), **options)
+
+
+def concat_segments(segment_paths, output_path, ffmpeg_path='ffmpeg', audio_source=None, audio_start=None,
+                    audio_duration=None):
+    """Join the segment files without re-encoding, muxing the original audio in the same pass."""
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+    with open(list_path, 'w', encoding='utf-8') as list_file:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace('\\', '/').replace("'", "'\\''")
+            list_file.write(f"file '{escaped}'\n")
+
+    command = [ffmpeg_path, '-v', 'error', '-nostdin', '-y', '-f', 'concat', '-safe', '0', '-i', list_path]
+    if audio_source:
+        if audio_start:
+            command += ['-ss', str(audio_start)]
+        if audio_duration is not None:
+            command += ['-t', str(audio_duration)]
+        command += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?']
+    command += ['-c', 'copy', output_path]
+    subprocess.run(command, check=True)
+
+
+def merge_detection_logs(jobs, output_path, settings):
+    """Join the detection logs of the segments into one log numbered by the frames of the whole output."""
+    parts = []
+    for job in jobs:
+        rows, _ = load_detections(detection_log_paths(job['output_path'])[0])
+        rows = np.array(rows[rows['frame'] >= 0])  # Warm-up frames were logged by the previous segment too
+        rows['frame'] += job['output_offset']
+        parts.append(rows)
+    array_path, metadata_path = detection_log_paths(output_path)
+    save_detections(array_path, metadata_path, np.concatenate(parts), settings)
+
+
+def merge_segment_metrics(segment_results):
+    """Add up the stage times and counters the segments measured."""
+    stages, counters = {}, {}
+    for segment_result in segment_results:
+        if not segment_result.metrics:
+            continue  # Finished before a restart that asked for a report
+        for stage, timing in segment_result.metrics['stages'].items():
+            total = stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            total['seconds'] += timing['seconds']
+            total['calls'] += timing['calls']
+        for name, value in segment_result.metrics['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    return stages, counters
+
+
+def process_video_parallel(input_path, workers=None, threads_per_worker=None, output_path=None, cut_video=False,
+                           start_time='0:00', end_time=None, keep_audio=False, ffmpeg_path='ffmpeg',
+                           overlap_frames=OVERLAP_FRAMES, checkpoint_interval=0, resume=True, cancel_event=None,
+                           **options):
+    """Blur a video in keyframe-aligned segments across a pool of worker processes.
+
+    Each worker loads its own YOLO model and gets threads_per_worker CPU
+    threads (all cores split evenly by default). Every segment starts
+    overlap_frames early so tracking and the box buffer carry across the
+    boundary. The segments are joined losslessly with ffmpeg's concat
+    demuxer. With checkpoint_interval set, finished segments are kept (and
+    every segment checkpoints itself), so running the same job again only
+    redoes the unfinished parts. With run_report, the report of the whole
+    video has the stage times and counters of all segments added up and
+    each segment's own report. Setting cancel_event stops the workers
+    after their current batch and drops the segments that have not
+    started; the output then has the segments from the start up to the
+    first one that was stopped, as far as it got. The remaining options
+    are passed on to process_video(). Returns one ProcessingResult for the
+    whole video.
+    """
+    from working import ProcessingResult, VideoCutter, streamed_video_name
+
+    options.pop('recalibrate', None)  # Segment workers don't estimate their time
+    run_report = options.pop('run_report', False)
+    options.pop('stream_metrics', None)  # Not supported across worker processes
+    metrics = RunMetrics() if run_report else None
+    workers = workers or os.cpu_count() or 1
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    result = ProcessingResult(input_path=input_path)
+
+    probe = cv2.VideoCapture(input_path)
+    if not probe.isOpened():
+        raise IOError(f"Invalid path, could not open video: {input_path}")
+    fps = probe.get(cv2.CAP_PROP_FPS)
+    frame_count = int(probe.get(cv2.CAP_PROP_FRAME_COUNT))
+    probe.release()
+    if fps <= 0 or frame_count <= 0:
+        # Streams and some containers report neither, and the segments are planned from them
+        raise ValueError(f"Can't split {input_path} into segments, it reports no frame rate or frame count. "
+                         "Process it with workers = 1 instead.")
+    video_duration = frame_count / fps
+
+    start = VideoCutter.convert_to_seconds(start_time) if cut_video else 0.0
+    # Without a cut, end one frame late so the last frame isn't lost to rounding
+    end = VideoCutter.convert_to_seconds(end_time) if cut_video else video_duration + 1 / fps
+
+    if output_path is None:
+        video_name = streamed_video_name(input_path, cut_video, options.get('resize_video', False),
+                                         options.get('resolution', '480p'))
+        output_path = os.path.join(os.path.dirname(input_path), 'blurred_' + video_name)
+    result.output_path = output_path
+
+    options['backend'] = job_backend(options)
+
+    elapsed_start_time = time.time()
+    segments = plan_segments(input_path, workers, ffmpeg_path, start, end)
+    print(f"Processing {len(segments)} segments with {workers} workers, {threads_per_worker} threads each...\n")
+
+    # ProcessingResults of the segments that are done, and of those stopped part way, by segment index
+    finished = {}
+    stopped = {}
+    checkpoint = None
+    if checkpoint_interval > 0:
+        # Keep the segments in the checkpoint folder, so a restart only redoes the unfinished ones
+        checkpoint = Checkpoint(output_path, job_fingerprint(
+            input_path, segments=segments, overlap_frames=overlap_frames, keep_audio=keep_audio,
+            ffmpeg_path=ffmpeg_path, **options))
+        if checkpoint.start({}, resume):
+            finished = checkpoint.state
+            print(f"Resuming, {len(finished)} of {len(segments)} segments are already done.\n")
+        segment_dir = checkpoint.directory
+    else:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        segment_dir = tempfile.mkdtemp(prefix='.segments_', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        jobs = []
+        for index, (segment_start, segment_end) in enumerate(segments):
+            # Cut half a frame before each boundary, so every frame lands in exactly one segment
+            boundary = segment_start - 0.5 / fps if index > 0 else segment_start
+            read_start = max(0.0, boundary - overlap_frames / fps) if index > 0 else segment_start
+            read_end = segment_end - 0.5 / fps if index < len(segments) - 1 else segment_end
+            jobs.append({
+                'input_path': input_path,
+                'output_path': os.path.join(segment_dir, f'segment_{index:04d}.mp4'),
+                'read_start': read_start,
+                'read_end': read_end,
+                'warmup_frames': frames_before(boundary, fps) - frames_before(read_start, fps),
+                'output_offset': frames_before(boundary, fps) - frames_before(start, fps),
+                'collect_metrics': run_report,
+                'options': {'ffmpeg_path': ffmpeg_path, 'checkpoint_interval': checkpoint_interval,
+                            'resume': resume, **options},
+            })
+
+        pending = [index for index in range(len(jobs)) if index not in finished]
+        if pending:
+            context = multiprocessing.get_context('spawn')
+            # The workers can't see a threading.Event of this process, so it is passed on through a manager
+            manager = context.Manager() if cancel_event is not None else None
+            worker_cancel = manager.Event() if manager is not None else None
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                       initargs=(threads_per_worker,))
+            try:
+                with timed(metrics, 'segments'), pool:
+                    futures = {pool.submit(_process_segment, {**jobs[index], 'cancel_event': worker_cancel}): index
+                               for index in pending}
+                    running, done = set(futures), 0
+                    while running:
+                        completed, running = wait(running, timeout=CANCEL_POLL, return_when=FIRST_COMPLETED)
+                        if worker_cancel is not None and cancel_event.is_set() and not worker_cancel.is_set():
+                            print("Stopping the workers, the frames blurred so far are kept...")
+                            worker_cancel.set()
+                            for future in running:
+                                future.cancel()  # Only segments that have not started
+                        for future in completed:
+                            if future.cancelled():
+                                continue
+                            segment_result = future.result()
+                            if segment_result.cancelled:
+                                stopped[futures[future]] = segment_result
+                                continue
+                            finished[futures[future]] = segment_result
+                            if checkpoint is not None:
+                                checkpoint.commit(finished)
+                            done += 1
+                            # The segments are about equally long, so the rest takes as long per segment as these did
+                            eta = (time.time() - elapsed_start_time) / done * (len(pending) - done)
+                            print(f"{len(finished)} of {len(segments)} segments done"
+                                  + (f", ETA {format_duration(eta)}" if done < len(pending) else ""))
+            finally:
+                if manager is not None:
+                    manager.shutdown()
+
+        kept = list(range(len(jobs)))
+        if len(finished) < len(jobs):
+            # Stopped: keep the segments up to the first one that isn't done, and that one as far as it got
+            result.cancelled = True
+            result.total_frames = min(frame_count, frames_before(end, fps) - frames_before(start, fps))
+            kept = []
+            for index in range(len(jobs)):
+                if index in finished or (index in stopped and stopped[index].frames_processed):
+                    kept.append(index)
+                if index not in finished:
+                    break
+            finished.update(stopped)
+            if not kept:
+                print("\nStopped before any frames were blurred.")
+                result.output_path = None
+                result.elapsed_time = time.time() - elapsed_start_time
+                return result
+            jobs = [jobs[index] for index in kept]
+
+        for segment_result in (finished[index] for index in kept):
+            if not result.cancelled:
+                result.total_frames += segment_result.total_frames
+            result.frames_processed += segment_result.frames_processed
+            result.frames_detected += segment_result.frames_detected
+            result.frames_skipped += segment_result.frames_skipped
+            result.boxes_detected += segment_result.boxes_detected
+
+        print("\nJoining the segments...\n")
+        audio_source = input_path if keep_audio else None
+        audio_duration = end - start if cut_video else None
+        if result.cancelled:
+            audio_duration = result.frames_processed / fps  # Only the audio of the frames that were kept
+        with timed(metrics, 'concat'):
+            concat_segments([job['output_path'] for job in jobs], output_path, ffmpeg_path, audio_source,
+                            start if cut_video else None, audio_duration)
+        if keep_audio:
+            result.audio_output_path = output_path
+
+        if options.get('save_detections', True) and not options.get('render_from'):
+            # The log describes the whole video, as if it was blurred in one piece
+            _, settings = load_detections(detection_log_paths(jobs[0]['output_path'])[0])
+            settings.update(input_path=os.path.abspath(input_path), cut_video=cut_video, start_time=start_time,
+                            end_time=end_time, stream_input=options.get('stream_input', False),
+                            frames=result.frames_processed)
+            merge_detection_logs(jobs, output_path, settings)
+
+        if checkpoint is not None:
+            checkpoint.discard()
+    finally:
+        if checkpoint is None:
+            shutil.rmtree(segment_dir, ignore_errors=True)
+
+    result.elapsed_time = time.time() - elapsed_start_time
+
+    if metrics is not None:
+        segment_results = [finished[index] for index in kept]
+        stages, counters = merge_segment_metrics(segment_results)
+        for stage, timing in stages.items():
+            # Only the totals, the latency histograms of the segments are in their own reports
+            StageTimer.add(metrics, stage, timing['seconds'], timing['calls'])
+        for name, value in counters.items():
+            metrics.count(name, value)
+        report_path = run_report_paths(output_path)[0]
+        metrics.save_report(report_path, result.frames_processed,
+                            result={'input_path': input_path, 'output_path': output_path,
+                                    'total_frames': result.total_frames, 'frames_processed': result.frames_processed,
+                                    'frames_detected': result.frames_detected, 'frames_skipped': result.frames_skipped,
+                                    'boxes_detected': result.boxes_detected,
+                                    'elapsed_time': result.elapsed_time, 'fps': result.fps},
+                            settings={'workers': workers, 'threads_per_worker': threads_per_worker, **options},
+                            segments=[segment_result.metrics for segment_result in segment_results])
+        print(f"Run report saved as: {os.path.basename(report_path)}")
+    return result
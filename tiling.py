@@ -0,0 +1,106 @@
+####################
+# File Name: tiling.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Runs the YOLO model on overlapping tiles of high-resolution frames, so small faces keep their pixels.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+from detection import Detector, append_detections, extract_detections, merge_and_log, round_to_stride
+from metrics import timed
+
+
+TILE_BATCH = 16  # Tiles per call of the model
+MERGE_IOU = 0.5  # Boxes of overlapping tiles (and of the whole frame) are merged above this IoU
+
+
+def parse_region(text):
+    """Region of interest from config.ini, 'x1, y1, x2, y2' as parts (0-1) of the frame, or None when empty."""
+    if not text or not text.strip():
+        return None
+    region = tuple(float(value) for value in text.split(','))
+    if len(region) != 4 or not 0 <= region[0] < region[2] <= 1 or not 0 <= region[1] < region[3] <= 1:
+        raise ValueError(f"Invalid tile region '{text}', expected x1, y1, x2, y2 between 0 and 1")
+    return region
+
+
+def tile_grid(frame_width, frame_height, tile_size, overlap=0.2, region=None):
+    """(x1, y1, x2, y2) of the tiles that cover the frame, or only the region of interest.
+
+    Neighbouring tiles overlap by overlap times tile_size, so a face on the
+    seam between two tiles is whole in at least one of them if it is smaller
+    than the overlap. The last tile of a row or column is moved back to end
+    at the edge instead of sticking out.
+    """
+    x_start, y_start, x_end, y_end = 0, 0, frame_width, frame_height
+    if region is not None:
+        x_start, x_end = int(region[0] * frame_width), int(region[2] * frame_width)
+        y_start, y_end = int(region[1] * frame_height), int(region[3] * frame_height)
+    tile_width, tile_height = min(tile_size, x_end - x_start), min(tile_size, y_end - y_start)
+
+    def positions(start, end, size):
+        stride = max(1, int(size * (1 - overlap)))
+        return list(range(start, end - size, stride)) + [end - size]
+
+    return [(x, y, x + tile_width, y + tile_height)
+            for y in positions(y_start, y_end, tile_height) for x in positions(x_start, x_end, tile_width)]
+
+
+class TiledDetector:
+    """Detector that also runs the model on overlapping full-resolution tiles of every frame.
+
+    Shrinking a 4K frame to the model's input size leaves a distant face a
+    few pixels wide. Here the frame is cut into tiles of tile_size pixels
+    (multiples of 32, overlapping by overlap), the tiles of the whole batch
+    go through the model together, and their boxes are mapped back to the
+    frame. The whole frame still goes through the model as well (at
+    inference_size), for faces too large for one tile. Boxes found twice, in
+    two tiles or in a tile and the whole frame, are merged with NMS. With
+    region (parts of the frame, see parse_region()) only that area is
+    tiled, e.g. to leave out the sky. Has the same detect()/detect_with_scores()
+    as Detector, and logs the merged boxes in the detection_log.
+    """
+
+    def __init__(self, model, confidence_threshold=0.3, desired_class=0, inference_size=None, tile_size=640,
+                 overlap=0.2, region=None, detection_log=None, metrics=None):
+        self.frame_detector = Detector(model, confidence_threshold, desired_class, inference_size, metrics=metrics)
+        self.model = model
+        self.confidence_threshold = confidence_threshold
+        self.desired_class = desired_class
+        self.tile_size = round_to_stride(tile_size)
+        self.overlap = overlap
+        self.region = region
+        self.detection_log = detection_log
+        self.metrics = metrics
+
+    def detect(self, frames, frame_indices=None):
+        return [bboxes for bboxes, _, _ in self.detect_with_scores(frames, frame_indices)]
+
+    def detect_with_scores(self, frames, frame_indices=None):
+        if not frames:
+            return []
+        per_frame = [tuple(list(values) for values in detection)
+                     for detection in self.frame_detector.detect_with_scores(frames)]
+
+        # All frames of a batch have the same size, so they share the tiles
+        frame_height, frame_width = frames[0].shape[:2]
+        grid = tile_grid(frame_width, frame_height, self.tile_size, self.overlap, self.region)
+        tiles = [(frame_number, tile) for frame_number in range(len(frames)) for tile in grid]
+        for start in range(0, len(tiles), TILE_BATCH):
+            chunk = tiles[start:start + TILE_BATCH]
+            found = self._detect_tiles([frames[frame_number][y1:y2, x1:x2]
+                                        for frame_number, (x1, y1, x2, y2) in chunk])
+            with timed(self.metrics, 'postprocess'):
+                for (frame_number, (offset_x, offset_y, _, _)), detection in zip(chunk, found):
+                    append_detections(per_frame[frame_number], detection, offset_x, offset_y)
+
+        with timed(self.metrics, 'postprocess'):
+            return merge_and_log(per_frame, frame_indices, self.detection_log, MERGE_IOU)
+
+    def _detect_tiles(self, tiles):
+        """Run the model once on a list of tiles and return each tile's detections."""
+        with timed(self.metrics, 'inference'):
+            results = list(self.model(tiles, stream=True, conf=self.confidence_threshold, imgsz=self.tile_size))
+        return [extract_detections(result, self.desired_class) for result in results]
@@ -0,0 +1,179 @@
+####################
+# File Name: tracker.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Lightweight box tracker that carries detections through the frames the YOLO model skips.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import cv2
+import numpy as np
+
+
+FLOW_WIDTH = 640  # Optical flow runs on a copy downscaled to this width
+MIN_FLOW_POINTS = 4  # Fewer tracked corners than this and the box falls back to its velocity
+
+
+def box_iou(boxes_a, boxes_b):
+    """Return the IoU matrix between two arrays of (x1, y1, x2, y2) boxes."""
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+
+def match_boxes(boxes_a, boxes_b, iou_threshold):
+    """Greedily pair boxes by highest IoU and return a list of (index_a, index_b)."""
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return []
+    iou = box_iou(boxes_a, boxes_b)
+    matches = []
+    while True:
+        a, b = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[a, b] < iou_threshold:
+            break
+        matches.append((int(a), int(b)))
+        iou[a, :] = -1
+        iou[:, b] = -1
+    return matches
+
+
+class Track:
+    def __init__(self, track_id, box):
+        self.track_id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)  # Change of each coordinate per frame
+        self.last_detected_box = self.box.copy()
+        self.frames_since_detection = 0
+        self.missed = 0  # Detection frames in a row without a matching box
+
+
+class BoxTracker:
+    """Follow detected boxes from one detection frame to the next.
+
+    update() is called with the detector's boxes on detection frames. Boxes
+    are associated to existing tracks by IoU, and tracks that go unmatched for
+    more than max_missed detection frames are dropped. predict() moves every
+    track on the frames in between, using the median sparse optical flow of
+    the corners inside the box, or the track's velocity when there is too
+    little texture to follow. needs_detection is set when most tracks could
+    not be followed, so the caller can run the detector early.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=1):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 0
+        self.prev_gray = None
+        self.flow_scale = 1.0
+        self.needs_detection = False
+
+    def _to_gray(self, frame):
+        """Grayscale copy of the frame, downscaled to FLOW_WIDTH for cheap optical flow."""
+        height, width = frame.shape[:2]
+        self.flow_scale = min(1.0, FLOW_WIDTH / width)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.flow_scale < 1.0:
+            gray = cv2.resize(gray, (int(width * self.flow_scale), int(height * self.flow_scale)), interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _boxes(self, frame):
+        height, width = frame.shape[:2]
+        boxes = []
+        for track in self.tracks:
+            x1, y1, x2, y2 = track.box
+            x1, x2 = int(max(0, x1)), int(min(width, x2))
+            y1, y2 = int(max(0, y1)), int(min(height, y2))
+            if x2 > x1 and y2 > y1:
+                boxes.append((x1, y1, x2, y2))
+        return boxes
+
+    def update(self, frame, detections):
+        """Associate this frame's detections with the tracks and return the boxes to blur."""
+        self.prev_gray = self._to_gray(frame)
+        self.needs_detection = False
+
+        track_boxes = [track.box for track in self.tracks]
+        matches = match_boxes(track_boxes, detections, self.iou_threshold)
+        matched_tracks = set()
+        matched_detections = set()
+        for track_index, detection_index in matches:
+            track = self.tracks[track_index]
+            box = np.asarray(detections[detection_index], dtype=np.float32)
+            if track.frames_since_detection > 0:
+                # Blend the measured motion into the velocity to smooth out detector jitter
+                measured = (box - track.last_detected_box) / track.frames_since_detection
+                track.velocity = 0.5 * track.velocity + 0.5 * measured
+            track.box = box
+            track.last_detected_box = box.copy()
+            track.frames_since_detection = 0
+            track.missed = 0
+            matched_tracks.add(track_index)
+            matched_detections.add(detection_index)
+
+        # Keep unmatched tracks for a few detection frames so a flickering detection stays blurred
+        kept_tracks = []
+        for index, track in enumerate(self.tracks):
+            if index not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    continue
+            kept_tracks.append(track)
+        self.tracks = kept_tracks
+
+        for index, box in enumerate(detections):
+            if index not in matched_detections:
+                self.tracks.append(Track(self.next_id, box))
+                self.next_id += 1
+
+        return self._boxes(frame)
+
+    def predict(self, frame):
+        """Move every track onto a frame the detector skipped and return the boxes to blur."""
+        gray = self._to_gray(frame)
+        lost = 0
+        for track in self.tracks:
+            shift = self._flow_shift(gray, track.box * self.flow_scale)
+            if shift is None:
+                track.box = track.box + track.velocity
+                lost += 1
+            else:
+                dx, dy = shift / self.flow_scale
+                track.box = track.box + np.array([dx, dy, dx, dy], dtype=np.float32)
+            track.frames_since_detection += 1
+
+        self.prev_gray = gray
+        self.needs_detection = bool(self.tracks) and lost * 2 > len(self.tracks)
+        return self._boxes(frame)
+
+    def _flow_shift(self, gray, box):
+        """Median optical flow (dx, dy) of the corners inside a box, or None if it can't be followed."""
+        if self.prev_gray is None or self.prev_gray.shape != gray.shape:
+            return None
+        height, width = gray.shape
+        x1, y1 = int(max(0, box[0])), int(max(0, box[1]))
+        x2, y2 = int(min(width, box[2])), int(min(height, box[3]))
+        if x2 - x1 < 4 or y2 - y1 < 4:
+            return None
+
+        points = cv2.goodFeaturesToTrack(self.prev_gray[y1:y2, x1:x2], maxCorners=20, qualityLevel=0.01, minDistance=3)
+        if points is None or len(points) < MIN_FLOW_POINTS:
+            return None
+        points = points + np.array([x1, y1], dtype=np.float32)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None)
+        if next_points is None:
+            return None
+        good = status.reshape(-1) == 1
+        if good.sum() < MIN_FLOW_POINTS:
+            return None
+        return np.median((next_points - points).reshape(-1, 2)[good], axis=0)
@@ -0,0 +1,265 @@
+####################
+# File Name: video_io.py
+# Author: Philiph Lundberg
+# Date Created: 2024-08
+# Description: Frame sources and sinks that stream video through ffmpeg pipes instead of intermediate files.
+# Version: 1.0
+# License: MIT License
+####################
+
+
+import math
+import os
+import subprocess
+
+import cv2
+import numpy as np
+
+
+def frames_before(seconds, fps):
+    """Number of frames with a timestamp before the given time, assuming the video starts at 0."""
+    return max(0, math.ceil(seconds * fps - 1e-6))
+
+
+class FFmpegReader:
+    """Decode a video with ffmpeg and read raw BGR frames from its stdout.
+
+    Seeking (start), cutting (duration) and resizing (size) are done by
+    ffmpeg while decoding, so no cut_/resized_ file is written first and
+    the cut is frame-accurate rather than keyframe-accurate. skip_frames
+    drops that many frames from the start of the cut, to resume a run
+    exactly where it stopped. Frames are read
+    straight into a ring of buffer_count preallocated arrays. A frame stays
+    valid until buffer_count more frames have been read, so buffer_count
+    must be larger than the number of frames the caller keeps in flight.
+
+    Implements the parts of cv2.VideoCapture the pipeline uses.
+    """
+
+    def __init__(self, input_path, ffmpeg_path='ffmpeg', start=0, duration=None, size=None, buffer_count=16,
+                 skip_frames=0):
+        # Let OpenCV read the stream properties, it is already a dependency
+        probe = cv2.VideoCapture(input_path)
+        if not probe.isOpened():
+            raise IOError(f"Invalid path, could not open video: {input_path}")
+        source_width = int(probe.get(cv2.CAP_PROP_FRAME_WIDTH))
+        source_height = int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = probe.get(cv2.CAP_PROP_FPS)
+        source_frames = int(probe.get(cv2.CAP_PROP_FRAME_COUNT))
+        probe.release()
+
+        self.width, self.height = size if size else (source_width, source_height)
+        first_frame = frames_before(start, self.fps) + skip_frames
+        self.frame_count = max(0, source_frames - first_frame)
+        if duration is not None:
+            # ffmpeg's -t can be off by a frame, so the cut end is given as a frame count
+            frame_limit = max(0, frames_before(start + duration, self.fps) - first_frame)
+            self.frame_count = min(self.frame_count, frame_limit)
+        if skip_frames:
+            # Seek half a frame early, ffmpeg then starts at the first frame at or after that time
+            start = (first_frame - 0.5) / self.fps
+
+        command = [ffmpeg_path, '-v', 'error', '-nostdin']
+        if start:
+            command += ['-ss', str(start)]  # Input seeking, accurate because the video is decoded
+        command += ['-i', input_path]
+        if duration is not None:
+            command += ['-frames:v', str(frame_limit)]
+        if size:
+            command += ['-vf', f'scale={self.width}:{self.height}']
+        # Pass the decoded frames through as they are, ffmpeg would otherwise repeat the
+        # first frame to fill the gap between a seek time and the next frame
+        command += ['-fps_mode', 'passthrough']
+        command += ['-an', '-sn', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+
+        self.frame_bytes = self.width * self.height * 3
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=self.frame_bytes)
+        self.buffers = [np.empty((self.height, self.width, 3), dtype=np.uint8) for _ in range(max(2, buffer_count))]
+        self.frames_read = 0
+
+    def isOpened(self):
+        return self.process is not None
+
+    def read(self):
+        """Read the next frame, returning (ret, frame) like cv2.VideoCapture.read()."""
+        if self.process is None:
+            return False, None
+        frame = self.buffers[self.frames_read % len(self.buffers)]
+        view = memoryview(frame).cast('B')
+        filled = 0
+        while filled < self.frame_bytes:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                return False, None  # End of the stream (a partial frame is dropped)
+            filled += count
+        self.frames_read += 1
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.frame_count
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.frames_read
+        return 0
+
+    def release(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()  # Stopped early, ffmpeg may still be writing
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
+
+
+class LiveReader:
+    """Decode a live source (RTSP/HTTP/UDP URL, named pipe, or a file played at its frame rate) with ffmpeg.
+
+    ffmpeg sends the frames as a YUV4MPEG stream, whose header gives the
+    size and frame rate, so the source is opened only once: a camera or a
+    UDP port often takes only one reader, and a pipe can't be read twice.
+    Every frame is a new array, so the caller can keep or drop frames
+    freely. A regular file is read in real time (-re), to test with a
+    recording as if it were a camera. size resizes while decoding.
+    """
+
+    def __init__(self, source, ffmpeg_path='ffmpeg', size=None):
+        self.source = source
+        command = [ffmpeg_path, '-v', 'error', '-nostdin']
+        if os.path.isfile(source):
+            command += ['-re']
+        else:
+            # Streams and pipes are read without buffering ahead; on a file that loses a frame
+            command += ['-fflags', 'nobuffer', '-flags', 'low_delay']
+        if source.startswith('rtsp://'):
+            command += ['-rtsp_transport', 'tcp']  # UDP loses packets, which shows up as smeared frames
+        command += ['-i', source]
+        if size:
+            command += ['-vf', f'scale={size[0]}:{size[1]}']
+        command += ['-an', '-sn', '-f', 'yuv4mpegpipe', '-pix_fmt', 'yuv420p', 'pipe:1']
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+        # Stream header, e.g. YUV4MPEG2 W1280 H720 F25:1 Ip A1:1 C420jpeg
+        header = self.process.stdout.readline().decode('ascii', 'replace').split()
+        if not header or header[0] != 'YUV4MPEG2':
+            self.release()
+            raise IOError(f"Could not open the stream: {source}")
+        fields = {field[0]: field[1:] for field in header[1:]}
+        self.width, self.height = int(fields['W']), int(fields['H'])
+        numerator, _, denominator = fields.get('F', '25:1').partition(':')
+        self.fps = int(numerator) / int(denominator or 1)
+        self.frame_bytes = self.width * self.height * 3 // 2
+        self.frames_read = 0
+
+    def isOpened(self):
+        return self.process is not None
+
+    def read(self):
+        """Wait for the next frame, returning (ret, frame) like cv2.VideoCapture.read()."""
+        if self.process is None or not self.process.stdout.readline():  # The FRAME line before every frame
+            return False, None
+        data = self.process.stdout.read(self.frame_bytes)
+        if len(data) < self.frame_bytes:
+            return False, None  # The stream ended
+        self.frames_read += 1
+        yuv = np.frombuffer(data, dtype=np.uint8).reshape(self.height * 3 // 2, self.width)
+        return True, cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.frames_read
+        return 0
+
+    def release(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
+
+
+class FFmpegWriter:
+    """Encode BGR frames by piping them into a single ffmpeg process.
+
+    The video is compressed with codec/crf/preset (x264 by default), which
+    gives much smaller files than cv2.VideoWriter's mp4v. When audio_source
+    is given, its audio stream (from audio_start, for audio_duration seconds)
+    is stream-copied into the same file in the same pass, cut to the length
+    of the video if fewer frames are written. input_options and
+    output_options are extra ffmpeg arguments for the frames coming in and
+    the output, e.g. a segment or stream format.
+
+    Implements the parts of cv2.VideoWriter the pipeline uses.
+    """
+
+    def __init__(self, output_path, width, height, fps, ffmpeg_path='ffmpeg', codec='libx264', crf=23,
+                 preset='veryfast', audio_source=None, audio_start=None, audio_duration=None, input_options=(),
+                 output_options=()):
+        self.output_path = output_path
+        command = [ffmpeg_path, '-v', 'error', '-nostdin', '-y', *input_options,
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0']
+        if audio_source:
+            if audio_start:
+                command += ['-ss', str(audio_start)]
+            if audio_duration is not None:
+                command += ['-t', str(audio_duration)]
+            # -shortest ends the audio with the video when a run is stopped early
+            command += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'copy', '-shortest']
+        command += ['-c:v', codec, '-pix_fmt', 'yuv420p']
+        if codec in ('libx264', 'libx265'):
+            command += ['-crf', str(crf), '-preset', preset]
+        command += [*output_options, output_path]
+
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame):
+        self.process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+
+    def release(self):
+        """Close the pipe and wait for ffmpeg to finish the file."""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass  # ffmpeg already exited, its return code tells why
+        return_code = self.process.wait()
+        self.process = None
+        if return_code != 0:
+            raise IOError(f"ffmpeg failed to encode {self.output_path} (exit code {return_code})")
+
+
+def ffprobe_path_for(ffmpeg_path):
+    """Path of the ffprobe that ships next to the given ffmpeg executable."""
+    directory, name = os.path.split(ffmpeg_path)
+    return os.path.join(directory, name.replace('ffmpeg', 'ffprobe'))
+
+
+def keyframe_times(input_path, ffmpeg_path='ffmpeg'):
+    """Return the timestamps (seconds) of the video keyframes, read from the packets without decoding."""
+    command = [ffprobe_path_for(ffmpeg_path), '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_path]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    times = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return sorted(times)
@@ -9,32 +9,39 @@
 
 
 
-import cv2
-from ultralytics import YOLO
-import numpy as np
 import time
 import configparser
 import os
 import subprocess
-# from win10toast import ToastNotifier
-import tkinter as tk
-from tkinter import font as tkFont
-import ctypes
-from ctypes import wintypes
-import winsound
-
-
-
-TIME_PER_FRAME_FACE = 0.0031355378818845 #minutes
-TIME_PER_FRAME_HEAD = 0.02867874396 #minutes
-TIME_PER_FRAME_FACE2 = 0.030292887 #minutes
-
-FLASHW_STOP = 0
-FLASHW_CAPTION = 0x00000001
-FLASHW_TRAY = 0x00000002
-FLASHW_ALL = 0x00000003
-FLASHW_TIMER = 0x00000004
-FLASHW_TIMERNOFG = 0x0000000C
+import sys
+import argparse
+import copy
+import threading
+import queue
+from dataclasses import asdict, dataclass
+# Only modules without OpenCV, NumPy or the model runtime are imported here, so cutting and resizing
+# start at once; the rest is imported where the frames are processed
+from backends import base_model_name, load_model
+from checkpoint import Checkpoint, ChunkedWriter, ResumeState, job_fingerprint
+from metrics import RunMetrics, run_report_paths, timed
+from runtime_estimate import (ProgressMeter, TimingStore, calibrate_detection, detection_key, estimate_seconds,
+                              format_duration, format_progress, overhead_key, read_calibration_frames,
+                              record_run)
+
+
+
+PIPELINE_QUEUE_SIZE = 4  # Batches buffered between pipeline stages
+PIPELINE_END = object()  # Marks the end of the frame stream between stages
+BBOX_BUFFER_SIZE = 3  # Frames whose boxes are blurred onto each frame
+PREVIEW_INTERVAL = 2.0  # Seconds between the frames handed to preview_callback
+PREVIEW_WIDTH = 320  # Width of the preview thumbnails
+
+# Define common resolution presets
+RESOLUTIONS = {
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080)
+}
 
 
 class VideoCutter:
@@ -80,8 +87,11 @@ class VideoCutter:
         if not os.path.exists(self.output_path):
             raise FileNotFoundError(f"Output file {self.output_path} was not created.")
 
-    def convert_to_seconds(self, time_str):
-        """Convert MM:SS format to seconds."""
+    @staticmethod
+    def convert_to_seconds(time_str):
+        """Convert MM:SS format to seconds. Numbers are taken as seconds already."""
+        if isinstance(time_str, (int, float)):
+            return time_str
         minutes, seconds = map(int, time_str.split(':'))
         return minutes * 60 + seconds
 
@@ -89,17 +99,10 @@ class VideoCutter:
         import subprocess
         import os
 
-        # Define common resolution presets
-        resolutions = {
-            '480p': (854, 480),
-            '720p': (1280, 720),
-            '1080p': (1920, 1080)
-        }
-
         # Get the dimensions for the requested resolution
-        if resolution not in resolutions:
+        if resolution not in RESOLUTIONS:
             raise ValueError(f"Unsupported resolution: {resolution}")
-        width, height = resolutions[resolution]
+        width, height = RESOLUTIONS[resolution]
 
         # Generate output path based on input path
         output_dir, input_filename = os.path.split(self.input_path)
@@ -125,303 +128,942 @@ class VideoCutter:
             raise FileNotFoundError(f"Output file {self.output_path} was not created.")
 
         return self.output_path
-    
-kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
-user32 = ctypes.WinDLL('user32', use_last_error=True)
-
-def play_notification_sound():
-    winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
-
-class FLASHWINFO(ctypes.Structure):
-    _fields_ = (('cbSize', wintypes.UINT),
-                ('hwnd', wintypes.HWND),
-                ('dwFlags', wintypes.DWORD),
-                ('uCount', wintypes.UINT),
-                ('dwTimeout', wintypes.DWORD))
-    def __init__(self, hwnd, flags=FLASHW_TRAY, count=5, timeout_ms=0):
-        self.cbSize = ctypes.sizeof(self)
-        self.hwnd = hwnd
-        self.dwFlags = flags
-        self.uCount = count
-        self.dwTimeout = timeout_ms
-
-kernel32.GetConsoleWindow.restype = wintypes.HWND
-user32.FlashWindowEx.argtypes = (ctypes.POINTER(FLASHWINFO),)
-
-def flash_console_icon(count=5):
-    hwnd = kernel32.GetConsoleWindow()
-    if not hwnd:
-        raise ctypes.WinError(ctypes.get_last_error())
-    winfo = FLASHWINFO(hwnd, count=count)
-    previous_state = user32.FlashWindowEx(ctypes.byref(winfo))
-    return previous_state
-
-####### Read the config file to get the user inputs ########
-config = configparser.ConfigParser()
-config.sections()
-config.read('config.ini')
-settings = config['VideoSettings']
-input_path = settings['input_path']
-ffmpeg_path = settings['ffmpeg_path']
-cut_video = settings['cut_video']
-start_time = settings['start_time']  # Read as MM:SS
-end_time = settings['duration']  # Read as MM:SS
-keep_audio = settings['keep_audio']
-resize_video = settings.getboolean('resize_video')  # Read as boolean
-resolution = settings['resolution']  # Read resolution
-
-blur = config['Blurring']
-confidence_threshold = float(blur['threshold'])
-
-mod = config['ModelSettings']
-model_name = mod['yolo_model']
-
-# Used to override to try custom videos
-video_path = input_path
-
-###### THIS IS THE START OF THE PROGRAM #######
-print("\n\nLoading video... \n\n")
-
-if cut_video == 'true':
-    print("Cutting video...\n")
-    cutter = VideoCutter(video_path, ffmpeg_path)
-    cutter.cut_video(start_time, end_time)  # Pass start_time and end_time
-    video_path = cutter.output_path
-    
-    print("\nThe video was successfully cut.\n")
-
-# Check if resize_video is true and call resize_video method
-if resize_video:
-    print(f"Resizing video to {resolution}...")
-    cutter = VideoCutter(video_path, ffmpeg_path)
-    video_path = cutter.resize_video(resolution)
-    print("Video resized successfully.")
-
-# YOLO model
-model = YOLO(model_name)
-
-# Create a VideoCapture object
-cap = cv2.VideoCapture(video_path)
-file_size = os.path.getsize(video_path)  # Get file size in bytes
-
-# Check if the video opened successfully
-if not cap.isOpened():
-    print("Error: Invalid path, could not open video.")
-    exit()
-
-# Get the width and height of the frames
-frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-time_per_frame_face = TIME_PER_FRAME_FACE
-time_per_frame_head = TIME_PER_FRAME_HEAD
-time_per_frame_face2 = TIME_PER_FRAME_FACE2
-fps = int(cap.get(cv2.CAP_PROP_FPS))
-total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))  # Ensure this is after reinitializing cap
-print(f"File size: {os.path.getsize(video_path) * 0.001} kB")
-print(f"Total frames in the video: {total_frames}")
-
-# Define a mapping of model names to their respective time calculations
-model_time_estimations = {
-    'YOLOv8n-face.pt': (time_per_frame_face, 'minutes'),
-    'yolov8m-face.pt': (time_per_frame_face2, 'minutes'),
-    'best_re_final.pt': (time_per_frame_head, 'minutes'),
-    'yolov8s.pt': (time_per_frame_head, 'minutes')
-}
-
-# Get the time per frame and unit based on the model name
-time_per_frame, unit = model_time_estimations.get(model_name, (None, None))
-
-if time_per_frame is not None:
-    estimated_time = round(time_per_frame * total_frames, 2)
-    if estimated_time > 120:
-        print(f"Estimated time is {round(estimated_time / 60, 1)} hours")
-    else:
-        print(f"Estimated time is {estimated_time} minutes")
-else:
-    print("Model name does not match a known choice...")
-    print("Terminating the program...")
-    exit()
-
-
-# Ask user if they want to continue
-# Clear any previous output before asking for input
-print("\n")  # Optional: Add a newline for clarity
-user_input = input("Tap 'Enter' three times to accept or exit the program").strip().lower()
-if user_input != '':
-    print("Exiting the program.")
-    exit()
-else: 
-    print("\nInitializing inference...\n")
-
 
-# Generate output path based on input path
-video_output_dir, video_filename = os.path.split(video_path)
-video_filename = 'blurred_' + video_filename
-
-# Check if the video filename already exists, in that case, remove it
-if os.path.exists(os.path.join(video_output_dir, video_filename)):
-    os.remove(os.path.join(video_output_dir, video_filename))
-
-# Create the new video path
-video_output_path = os.path.join(video_output_dir, video_filename)
-
-
-# Define the codec and create a VideoWriter object
-out = cv2.VideoWriter(video_output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_width, frame_height))
+# Config file next to this script, so runs don't depend on the current directory
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
 
 # Define the class you want to filter (e.g., class 0)
 desired_class = 0
 
-# Create a buffer to store bounding boxes for consecutive frames
-bbox_buffer = []
-
-# Initialize a variable to store the start time
-elapsed_start_time = time.time()
-
-# Read until the video is completed
-while cap.isOpened():
-    # Capture frame-by-frame
-    ret, frame = cap.read()
-    
-    if ret:
-        # Process the frame with YOLO model in streaming mode with confidence threshold
-        results = model(frame, stream=True, conf=confidence_threshold)
-        
-        # Store current frame's bounding boxes
-        current_bboxes = []
-        for result in results:
-            for box in result.boxes:
-                if box.cls == desired_class:  # Filter by desired class
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    current_bboxes.append((x1, y1, x2, y2))
-        
-        # Add current frame's bounding boxes to the buffer
-        bbox_buffer.append(current_bboxes)
-        
-        # Keep only the last 3 frames in the buffer
-        if len(bbox_buffer) > 3:
-            bbox_buffer.pop(0)
-        
-        # Apply blur to bounding boxes from the buffer
-        for bboxes in bbox_buffer:
-            for (x1, y1, x2, y2) in bboxes:
-                # Scale the bounding box dimensions
-                if model_name == "yolov8s.pt":
-                    scale_factor = 1.0
-                else:
-                    scale_factor = 1.6
-                new_width = int((x2 - x1) * scale_factor)
-                new_height = int((y2 - y1) * scale_factor)
-
-                # Ensure new_width and new_height are positive
-                if new_width <= 0 or new_height <= 0:
-                    continue  # Skip this bounding box if dimensions are invalid
-
-                new_x1 = max(0, x1 - (new_width - (x2 - x1)) // 2)
-                new_y1 = max(0, y1 - (new_height - (y2 - y1)) // 2)
-                new_x2 = min(frame.shape[1], new_x1 + new_width)
-                new_y2 = min(frame.shape[0], new_y1 + new_height)
-                bbox = (new_x1, new_y1, new_x2 - new_x1, new_y2 - new_y1)
-                
-                # Extract the region of interest (ROI)
-                roi = frame[new_y1:new_y2, new_x1:new_x2]
-                
-                # Calculate the kernel size based on the bounding box size
-                kernel_size = int(max(51, int(min(bbox[2], bbox[3]) / 10) * 4 + 1))
-                
-                # Apply gaussian blur to the ROI
-                blurred_roi = cv2.GaussianBlur(roi, (kernel_size, kernel_size), 0)
-
-                if model_name == "yolov8s.pt":
-                    # Apply blur to the entire bounding box region
-                    frame[new_y1:new_y2, new_x1:new_x2] = blurred_roi
-                elif model_name == "head accurate":
-                    # Apply Box blur
-                    # kernel_size = 2 * int(max(51, int(min(bbox[2], bbox[3]) / 10) * 4 + 1))
-                    kernel_size = (51,51)
-                    blurred_roi = cv2.blur(roi, (kernel_size, kernel_size))
-                    frame[new_y1:new_y2, new_x1:new_x2] = blurred_roi
-                else:
-                    # Create a mask for the ellipse
-                    mask = np.zeros_like(roi)
-                    center = (bbox[2] // 2, bbox[3] // 2)
-                    axes = (bbox[2] // 2, bbox[3] // 2)
-                    cv2.ellipse(mask, center, axes, 0, 0, 360, (255, 255, 255), -1)
-                    
-                    # Combine the blurred ROI with the original frame using the mask
-                    frame[new_y1:new_y2, new_x1:new_x2] = np.where(mask == 255, blurred_roi, roi)
-        
-        # Write the frame into the output video
-        out.write(frame)
-        
-        # Press Q on keyboard to exit or close the window
-        if cv2.waitKey(25) & 0xFF == ord('q'):
-            break
-    else:
-        break
-
-# When everything done, release the video capture and writer objects
-cap.release()
-out.release()
-
 
-
-# Closes all the frames
-cv2.destroyAllWindows()
-
-if keep_audio == 'true':
-    print("\nExtracting the audio from the original video...\n")
-
-    # Generate output path based on input path
-    audio_dir, audio_filename = os.path.split(video_path)
-    audio_filename = 'w_audio_' + os.path.basename(video_output_path)  # Use basename of video_output_path
+@dataclass
+class ProcessingResult:
+    """Outcome and statistics of one process_video() run."""
+    input_path: str
+    output_path: str = None
+    audio_output_path: str = None
+    total_frames: int = 0
+    frames_processed: int = 0
+    boxes_detected: int = 0
+    frames_detected: int = 0  # Frames that went through the YOLO model
+    frames_skipped: int = 0  # Detection frames given earlier boxes (motion gate, or a live stream falling behind)
+    frames_dropped: int = 0  # Frames of a live stream left out to stay within the latency budget
+    elapsed_time: float = 0.0  # seconds
+    cancelled: bool = False
+    metrics: dict = None  # RunMetrics report of the run, when it was measured
+
+    @property
+    def fps(self):
+        """Processed frames per second of wall-clock time."""
+        if self.elapsed_time <= 0:
+            return 0.0
+        return self.frames_processed / self.elapsed_time
+
+
+def create_compositor(model_name, blur_method='gaussian', blur_scale=None):
+    """BlurCompositor for the boxes of model_name: persons as full rectangles, faces and heads as enlarged ellipses."""
+    from blurring import BlurCompositor
+    if base_model_name(model_name) == "yolov8s.pt":
+        return BlurCompositor(shape='rect', scale_factor=blur_scale or 1.0, method=blur_method)
+    return BlurCompositor(shape='ellipse', scale_factor=blur_scale or 1.6, method=blur_method)
+
+
+def create_detector(model, confidence_threshold=0.3, inference_size=0, person_model=None, cascade_crop_size=320,
+                    cascade_padding=0.15, tile_size=0, tile_overlap=0.2, tile_region=None, detection_log=None,
+                    metrics=None):
+    """The detector for the settings: a cascade with a person_model, tiled with tile_size, or a plain Detector."""
+    from detection import Detector
+    if person_model is not None:
+        from cascade import CascadeDetector
+        return CascadeDetector(person_model, model, confidence_threshold, desired_class, inference_size,
+                               cascade_crop_size, cascade_padding, detection_log, metrics)
+    if tile_size:
+        from tiling import TiledDetector
+        return TiledDetector(model, confidence_threshold, desired_class, inference_size, tile_size, tile_overlap,
+                             tile_region, detection_log, metrics)
+    return Detector(model, confidence_threshold, desired_class, inference_size, detection_log, metrics)
+
+
+def load_config(config_path=DEFAULT_CONFIG_PATH, model_name=None):
+    """Read config.ini and return the settings as keyword arguments.
+
+    workers and threads_per_worker are for segments.process_video_parallel(),
+    the rest are process_video() arguments.
+
+    model_name overrides yolo_model, so the blur method is looked up for the
+    model that will actually run.
+    """
+    config = configparser.ConfigParser()
+    if not config.read(config_path):
+        raise FileNotFoundError(f"Config file not found at {config_path}")
+
+    settings = config['VideoSettings']
+    blur = config['Blurring']
+    mod = config['ModelSettings']
+    model_name = model_name or mod['yolo_model']
+    # Without an [Encoding] section the output is written with OpenCV as before
+    encoding = config['Encoding'] if config.has_section('Encoding') else {}
+
+    # Without a scale_factor the blur shape is chosen for the model in process_video()
+    blur_scale = blur.getfloat('scale_factor', fallback=None)
+
+    tile_region = config.get('Tiling', 'region', fallback='')
+    if tile_region.strip():
+        from tiling import parse_region
+        tile_region = parse_region(tile_region)
+
+    # The blur method can be set per model under [BlurMethods], falling back to [Blurring] method
+    blur_method = blur.get('method', fallback='gaussian')
+    if config.has_section('BlurMethods'):
+        # An INT8 variant uses the method of the model it was made from, unless it has its own
+        blur_method = config['BlurMethods'].get(base_model_name(model_name), fallback=blur_method)
+        blur_method = config['BlurMethods'].get(model_name, fallback=blur_method)
+
+    return {
+        'input_path': settings['input_path'],
+        'ffmpeg_path': settings['ffmpeg_path'],
+        'cut_video': settings.getboolean('cut_video'),
+        'start_time': settings['start_time'],  # Read as MM:SS
+        'end_time': settings['duration'],  # Read as MM:SS
+        'keep_audio': settings.getboolean('keep_audio'),
+        'resize_video': settings.getboolean('resize_video'),
+        'resolution': settings['resolution'],
+        'stream_input': settings.getboolean('stream_input', fallback=False),  # Cut/resize while decoding
+        'confidence_threshold': float(blur['threshold']),
+        'blur_method': blur_method,
+        'blur_scale': blur_scale,
+        'blur_buffer': blur.getint('buffer_frames', fallback=BBOX_BUFFER_SIZE),  # Frames whose boxes blur each frame
+        'model_name': model_name,
+        'batch_size': mod.getint('batch_size', fallback=1),  # Frames per YOLO call
+        'detect_every': mod.getint('detect_every', fallback=1),  # Run YOLO on every Nth frame, track in between
+        'inference_size': mod.getint('inference_size', fallback=0),  # Longest side YOLO sees, 0 = full frame
+        'backend': mod.get('backend', fallback='pytorch'),  # pytorch, onnx or openvino
+        # Person model that finds where yolo_model has to look, empty = yolo_model sees the whole frame
+        'cascade_model': config.get('Cascade', 'person_model', fallback='') or None,
+        'cascade_crop_size': config.getint('Cascade', 'crop_size', fallback=320),
+        'cascade_padding': config.getfloat('Cascade', 'padding', fallback=0.15),
+        # Also run the model on overlapping tiles of this many pixels, for small faces in 4K, 0 = off
+        'tile_size': config.getint('Tiling', 'tile_size', fallback=0),
+        'tile_overlap': config.getfloat('Tiling', 'overlap', fallback=0.2),
+        'tile_region': tile_region or None,
+        # Skip the model while less than this percent of the picture changes, 0 = always run it
+        'motion_threshold': config.getfloat('MotionGate', 'threshold', fallback=0),
+        'motion_force_every': config.getint('MotionGate', 'force_every', fallback=30),
+        'workers': mod.getint('workers', fallback=1),  # Worker processes, each blurring a segment of the video
+        'threads_per_worker': mod.getint('threads_per_worker', fallback=0),  # 0 = split the cores evenly
+        'encoder': encoding.get('encoder', 'opencv'),  # 'ffmpeg' or 'opencv'
+        'video_codec': encoding.get('codec', 'libx264'),
+        'crf': int(encoding.get('crf', 23)),
+        'preset': encoding.get('preset', 'veryfast'),
+        # Minutes between checkpoints a crashed run can resume from, 0 = no checkpoints
+        'checkpoint_interval': config.getfloat('Checkpoints', 'interval', fallback=0),
+        # Stage timings, counters and histograms saved as <output>.report.json / streamed to .metrics.jsonl
+        'run_report': config.getboolean('Metrics', 'report', fallback=False),
+        'stream_metrics': config.getboolean('Metrics', 'stream', fallback=False),
+        # Send the video to the background daemon (daemon.py) that keeps the models loaded between runs
+        'daemon': config.getboolean('Daemon', 'enabled', fallback=False),
+    }
+
+
+def prepare_video(input_path, ffmpeg_path='ffmpeg', cut_video=False, start_time='0:00', end_time=None,
+                  resize_video=False, resolution='480p', metrics=None):
+    """Cut and/or resize the input video as configured and return the path to process.
+
+    With metrics the ffmpeg calls are timed as the 'cut' and 'resize' stages.
+    """
+    video_path = input_path
+
+    if cut_video:
+        print("Cutting video...\n")
+        cutter = VideoCutter(video_path, ffmpeg_path)
+        with timed(metrics, 'cut'):
+            cutter.cut_video(start_time, end_time)  # Pass start_time and end_time
+        video_path = cutter.output_path
+
+        print("\nThe video was successfully cut.\n")
+
+    # Check if resize_video is true and call resize_video method
+    if resize_video:
+        print(f"Resizing video to {resolution}...")
+        cutter = VideoCutter(video_path, ffmpeg_path)
+        with timed(metrics, 'resize'):
+            video_path = cutter.resize_video(resolution)
+        print("Video resized successfully.")
+
+    return video_path
+
+
+def streamed_video_name(input_path, cut_video=False, resize_video=False, resolution='480p'):
+    """Name the cut_/resized_ file would have had, so streamed runs keep the same output names."""
+    video_name = os.path.basename(input_path)
+    if cut_video:
+        video_name = 'cut_' + video_name
+    if resize_video:
+        video_name = f'resized_{resolution}_' + video_name
+    return video_name
+
+
+def put_until_stopped(frame_queue, item, stop_event):
+    """Put an item on a bounded queue, giving up if the pipeline is stopping.
+
+    Blocking while the queue is full is what gives the pipeline back-pressure.
+    """
+    while not stop_event.is_set():
+        try:
+            frame_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_until_stopped(frame_queue, stop_event):
+    """Get an item from a queue, returning PIPELINE_END if the pipeline is stopping."""
+    while not stop_event.is_set():
+        try:
+            return frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return PIPELINE_END
+
+
+def decode_frames(cap, decoded_queue, stop_event, errors, metrics=None):
+    """Decode stage: read frames from the capture and hand them to inference."""
+    try:
+        while cap.isOpened():
+            with timed(metrics, 'decode'):
+                ret, frame = cap.read()
+            if not ret:
+                break
+            if metrics is not None:
+                metrics.count('frames_decoded')
+            if not put_until_stopped(decoded_queue, frame, stop_event):
+                return
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+    finally:
+        put_until_stopped(decoded_queue, PIPELINE_END, stop_event)
+
+
+def encode_frames(out, blurred_queue, stop_event, errors, metrics=None):
+    """Encode stage: write blurred frames to the output video in order.
+
+    A ResumeState in the queue (only sent to a ChunkedWriter) commits a
+    checkpoint after the frames before it.
+    """
+    try:
+        while True:
+            frame = get_until_stopped(blurred_queue, stop_event)
+            if frame is PIPELINE_END:
+                break
+            if isinstance(frame, ResumeState):
+                out.commit(frame)
+                continue
+            with timed(metrics, 'encode'):
+                out.write(frame)
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+
+
+def keep_original_audio(video_path, video_output_path, ffmpeg_path, start=None, duration=None):
+    """Add the audio of the original video to the blurred output and return the new file path.
+
+    start and duration (in seconds) select the part of the audio that belongs
+    to a cut that was made while decoding. Only used with the OpenCV encoder,
+    the ffmpeg encoder muxes the audio while it encodes.
+    """
+    print("\nAdding the audio from the original video...\n")
+
+    # Generate output path based on the blurred video path
+    audio_dir, audio_filename = os.path.split(video_output_path)
+    audio_filename = 'w_audio_' + audio_filename
 
     # Check if the audio filename already exists, in that case, remove it
     if os.path.exists(os.path.join(audio_dir, audio_filename)):
         os.remove(os.path.join(audio_dir, audio_filename))
 
     # Create the new audio output path
-    video_audio_output_path = os.path.join(audio_dir, audio_filename)
-
-    # Extract audio from the original video
-    audio_output_path = 'audio.aac'  # Temporary audio file
-    subprocess.run([ffmpeg_path, '-i', video_path, '-q:a', '0', '-map', 'a', audio_output_path])
+    output_video_with_audio = os.path.join(audio_dir, audio_filename)
+
+    # Combine the blurred video with the original audio, copying both streams
+    command = [ffmpeg_path, '-v', 'error', '-nostdin', '-i', video_output_path]
+    if start:
+        command += ['-ss', str(start)]
+    if duration is not None:
+        command += ['-t', str(duration)]
+    command += ['-i', video_path, '-map', '0:v:0', '-map', '1:a:0?', '-c', 'copy', output_video_with_audio]
+    subprocess.run(command, check=True)
+
+    return output_video_with_audio
+
+
+def process_video(input_path, model_name='YOLOv8n-face.pt', confidence_threshold=0.3, output_path=None,
+                  cut_video=False, start_time='0:00', end_time=None, resize_video=False, resolution='480p',
+                  keep_audio=False, ffmpeg_path='ffmpeg', stream_input=False, encoder='opencv',
+                  video_codec='libx264', crf=23, preset='veryfast', warmup_frames=0, batch_size=1, detect_every=1,
+                  inference_size=0, backend='pytorch', cascade_model=None, cascade_crop_size=320,
+                  cascade_padding=0.15, tile_size=0, tile_overlap=0.2, tile_region=None, motion_threshold=0,
+                  motion_force_every=30, blur_method='gaussian', blur_scale=None, blur_buffer=BBOX_BUFFER_SIZE,
+                  checkpoint_interval=0, resume=True, save_detections=True, render_from=None, track_runtime=True,
+                  recalibrate=False, run_report=False, stream_metrics=False, metrics=None, model=None,
+                  person_model=None, confirm=None, cancel_event=None, progress_callback=None,
+                  preview_callback=None):
+    """Blur the detected objects in a video and return a ProcessingResult.
+
+    What each feature does is described in the README. The arguments:
+    cut_video/start_time/end_time, resize_video/resolution and stream_input
+    choose the part and size of the video, output_path defaults to
+    blurred_<name> next to it. encoder ('opencv', or 'ffmpeg' with
+    video_codec/crf/preset) writes the output and keep_audio adds the
+    original audio. model_name, backend and inference_size choose the model
+    (model and person_model can be passed in already loaded), batch_size and
+    detect_every how often it runs, and the cascade_*, tile_* and motion_*
+    settings how it looks at the frames. blur_method, blur_scale and
+    blur_buffer set the blur. warmup_frames are read but not written, they
+    let a segment of a parallel run pick up the faces of the previous one.
+    checkpoint_interval (minutes) and resume let a stopped run continue,
+    save_detections and render_from save the boxes and blur from them again,
+    and track_runtime, recalibrate, run_report, stream_metrics and metrics
+    time the run. confirm is called with the estimated time in minutes (or
+    None) before inference starts and stops the run if it returns False.
+    cancel_event stops the run early and keeps the frames blurred so far.
+    progress_callback gets a dict of the progress about once a second,
+    preview_callback a copy of the last blurred frame every PREVIEW_INTERVAL
+    seconds (see preview_thumbnail()).
+    """
+    import cv2
+    from tracker import BoxTracker
+    from tiling import tile_grid
+    from video_io import FFmpegReader, FFmpegWriter
+    from detection_log import DetectionLog, RecordedDetector, load_detections
+    from motion_gate import MotionGate
+
+    batch_size = max(1, int(batch_size))
+    detect_every = max(1, int(detect_every))
+    result = ProcessingResult(input_path=input_path)
+    if metrics is None and (run_report or stream_metrics):
+        metrics = RunMetrics()
+
+    compositor = create_compositor(model_name, blur_method, blur_scale)
+
+    frames_per_batch = batch_size * detect_every
+    queue_size = PIPELINE_QUEUE_SIZE * frames_per_batch
+
+    print("\n\nLoading video... \n\n")
+    audio_start, audio_duration = None, None
+    streamed = stream_input and (cut_video or resize_video)
+    start, duration, size = 0, None, None
+    if streamed:
+        # ffmpeg seeks, cuts and scales while decoding, so no intermediate file is written
+        video_path = input_path
+        video_name = streamed_video_name(input_path, cut_video, resize_video, resolution)
+        if cut_video:
+            start = VideoCutter.convert_to_seconds(start_time)
+            duration = VideoCutter.convert_to_seconds(end_time) - start
+            audio_start, audio_duration = start, duration
+        if resize_video:
+            if resolution not in RESOLUTIONS:
+                raise ValueError(f"Unsupported resolution: {resolution}")
+            size = RESOLUTIONS[resolution]
+    else:
+        video_path = prepare_video(input_path, ffmpeg_path, cut_video, start_time, end_time, resize_video, resolution,
+                                   metrics)
+        video_name = os.path.basename(video_path)
 
-    # Combine the processed video with the original audio
-    output_video_with_audio = os.path.join(audio_dir, video_audio_output_path)  # Define the output path
-    subprocess.run([ffmpeg_path, '-i', video_path, '-i', audio_output_path, '-c:v', 'copy', '-c:a', 'aac', output_video_with_audio])
+    # Generate output path based on input path
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(video_path), 'blurred_' + video_name)
+    report_path, metrics_path = run_report_paths(output_path)
+
+    checkpoint, resume_state = None, ResumeState()
+    if checkpoint_interval > 0:
+        checkpoint = Checkpoint(output_path, job_fingerprint(
+            input_path, model_name=model_name, confidence_threshold=confidence_threshold, cut_video=cut_video,
+            start_time=start_time, end_time=end_time, resize_video=resize_video, resolution=resolution,
+            stream_input=stream_input, encoder=encoder, video_codec=video_codec, crf=crf, preset=preset,
+            warmup_frames=warmup_frames, batch_size=batch_size, detect_every=detect_every,
+            inference_size=inference_size, backend=backend, cascade_model=cascade_model,
+            cascade_crop_size=cascade_crop_size, cascade_padding=cascade_padding, tile_size=tile_size,
+            tile_overlap=tile_overlap, tile_region=tile_region, motion_threshold=motion_threshold,
+            motion_force_every=motion_force_every, blur_method=blur_method, blur_scale=blur_scale,
+            blur_buffer=blur_buffer, render_from=render_from))
+        if checkpoint.start(ResumeState(), resume):
+            resume_state = checkpoint.state
+            print(f"Resuming from the checkpoint after frame {resume_state.frame_index}...\n")
+
+    # Every frame in the queues, the batch and the encoder needs its own buffer
+    buffer_count = 2 * queue_size + frames_per_batch + 3
+    if streamed or resume_state.frame_index:
+        # A resumed run lets ffmpeg seek straight to the first frame that is not encoded yet
+        cap = FFmpegReader(video_path, ffmpeg_path, start, duration, size, buffer_count,
+                           skip_frames=resume_state.frame_index)
+    else:
+        # Create a VideoCapture object
+        cap = cv2.VideoCapture(video_path)
+
+    def make_detector(log=None, stage_metrics=None):
+        return create_detector(model, confidence_threshold, inference_size, person_model if cascade_model else None,
+                               cascade_crop_size, cascade_padding, tile_size, tile_overlap, tile_region, log,
+                               stage_metrics)
+
+    detection_log = None
+    if render_from:
+        # Replay the detections of an earlier run instead of loading the model
+        recorded_detections, recorded_settings = load_detections(render_from)
+        detector = RecordedDetector(recorded_detections, confidence_threshold, desired_class)
+    else:
+        # YOLO model
+        if model is None:
+            model = load_model(model_name, backend, inference_size)
+        if cascade_model and person_model is None:
+            person_model = load_model(cascade_model, backend, inference_size)
+        if save_detections:
+            detection_log = DetectionLog(resume_state.detections)
+        detector = make_detector(detection_log, metrics)
+
+    # The recorded detections already contain the boxes the motion gate reused
+    motion_gate = None
+    if motion_threshold > 0 and not render_from:
+        motion_gate = resume_state.motion_gate or MotionGate(motion_threshold, motion_force_every)
+
+    # Check if the video opened successfully
+    if not cap.isOpened():
+        raise IOError(f"Invalid path, could not open video: {video_path}")
+
+    # Get the width and height of the frames
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    remaining_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    result.total_frames = max(0, remaining_frames + resume_state.frame_index - warmup_frames)
+    print(f"File size: {os.path.getsize(video_path) * 0.001} kB")
+    print(f"Total frames in the video: {result.total_frames}")
+    if resume_state.frame_index:
+        print(f"Frames left to process: {remaining_frames}")
+
+    if render_from:
+        if (recorded_settings['width'], recorded_settings['height']) != (frame_width, frame_height):
+            cap.release()
+            raise ValueError(f"The detections in {render_from} were made on {recorded_settings['width']}x"
+                             f"{recorded_settings['height']} frames, not {frame_width}x{frame_height}")
+        print("Rendering from the saved detections, the model is not used.")
+
+    estimated_time = None
+    timing_store, detect_key, other_key = None, None, None
+    if track_runtime:
+        timing_store = TimingStore()
+        other_key = overhead_key(frame_width, frame_height, encoder, preset, detect_every > 1)
+        if not render_from:
+            tile_count = 0
+            if tile_size:
+                tile_count = len(tile_grid(frame_width, frame_height, tile_size, tile_overlap, tile_region))
+            detect_key = detection_key(model_name, backend, frame_width, frame_height, inference_size, batch_size,
+                                       cascade_model, tile_size, tile_count)
+            if recalibrate or timing_store.get('detection', detect_key) is None:
+                print("Timing the model on this machine (only needed once for these settings)...")
+                calibration_frames = read_calibration_frames(video_path, size=size if streamed else None)
+                if calibration_frames:
+                    # A separate detector, so the timed frames don't end up in the detection log
+                    timing_store.put('detection', detect_key, calibrate_detection(make_detector(), calibration_frames,
+                                                                                  batch_size))
+        estimated_seconds = estimate_seconds(timing_store, remaining_frames, -(-remaining_frames // detect_every),
+                                             detect_key, other_key)
+        if estimated_seconds is None:
+            print("No time estimate available yet, it will be measured during this run.")
+        else:
+            estimated_time = round(estimated_seconds / 60, 2)
+            print(f"Estimated time is {format_duration(estimated_seconds)}")
+            if timing_store.get('overhead', other_key) is None:
+                print("(Model time only, decoding and encoding are timed during this first run)")
+
+    if confirm is not None and not confirm(estimated_time):
+        cap.release()
+        if checkpoint is not None and not resume_state.frame_index:
+            checkpoint.discard()
+        result.cancelled = True
+        return result
 
-    # Clean up temporary audio file
-    os.remove(audio_output_path)
+    print("\nInitializing inference...\n")
+    if stream_metrics:
+        metrics.stream_to(metrics_path)
+
+    # Check if the video filename already exists, in that case, remove it. With
+    # checkpoints it is only replaced once the chunks are joined, so a restart keeps it.
+    if os.path.exists(output_path) and checkpoint is None:
+        os.remove(output_path)
+    result.output_path = output_path
+
+    def open_writer(path, audio_source=None):
+        if encoder == 'ffmpeg':
+            # Encode and mux the original audio in one ffmpeg process, no extra passes afterwards
+            return FFmpegWriter(path, frame_width, frame_height, fps, ffmpeg_path, video_codec, crf, preset,
+                                audio_source, audio_start, audio_duration)
+        # Define the codec and create a VideoWriter object
+        return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_width, frame_height))
+
+    if checkpoint is not None:
+        # The audio is added when the chunks are joined
+        out = ChunkedWriter(checkpoint, open_writer)
+    else:
+        out = open_writer(output_path, video_path if keep_audio and encoder == 'ffmpeg' else None)
+
+    # Create a buffer to store bounding boxes for consecutive frames
+    bbox_buffer = resume_state.bbox_buffer
+
+    # Between detection frames the tracker moves the boxes, and it already keeps
+    # faces the detector briefly misses, so only the current frame's boxes are blurred
+    tracker = None
+    if detect_every > 1:
+        tracker = resume_state.tracker or BoxTracker()
+    buffer_size = 1 if tracker is not None else max(1, blur_buffer)
+
+    # Position of the next frame in the input, counting warm-up frames
+    frame_index = resume_state.frame_index
+    result.frames_processed = resume_state.frames_processed
+    result.boxes_detected = resume_state.boxes_detected
+    result.frames_detected = resume_state.frames_detected
+    result.frames_skipped = resume_state.frames_skipped
+
+    # Initialize a variable to store the start time
+    run_start_time = time.time()
+    elapsed_start_time = run_start_time - resume_state.elapsed_time
+    detect_time = 0.0  # Seconds this run spent in the model
+    progress = None
+    if track_runtime or progress_callback is not None:
+        progress = ProgressMeter(result.total_frames, result.frames_processed, callback=progress_callback,
+                                 show=track_runtime)
+    last_checkpoint_time = time.time()
+    last_preview_time = 0.0
+
+    # Decode and encode run in their own threads (OpenCV releases the GIL while it
+    # reads and writes video), linked to inference and blurring by bounded queues.
+    decoded_queue = queue.Queue(maxsize=queue_size)
+    blurred_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    pipeline_errors = []
+
+    decode_thread = threading.Thread(target=decode_frames, args=(cap, decoded_queue, stop_event, pipeline_errors, metrics),
+                                     daemon=True)
+    encode_thread = threading.Thread(target=encode_frames, args=(out, blurred_queue, stop_event, pipeline_errors, metrics),
+                                     daemon=True)
+    decode_thread.start()
+    encode_thread.start()
+
+    def timed_detect(frames, frame_indices, gated=True):
+        """Detect on frames, through the motion gate unless gated is False, and count what the model saw.
+
+        Warm-up frames are not counted, the segment before this one counts them.
+        """
+        nonlocal detect_time
+        warmup = sum(1 for index in frame_indices if index < 0)
+        if 0 < warmup < len(frames):
+            # The warm-up frames come first, split them off so only the rest is counted
+            return (timed_detect(frames[:warmup], frame_indices[:warmup], gated)
+                    + timed_detect(frames[warmup:], frame_indices[warmup:], gated))
+        detect_start = time.perf_counter()
+        skipped = 0
+        if motion_gate is not None and gated:
+            skipped_before = motion_gate.frames_skipped
+            detections = motion_gate.detect(detector, frames, frame_indices)
+            skipped = motion_gate.frames_skipped - skipped_before
+        else:
+            detections = detector.detect(frames, frame_indices)
+        detect_time += time.perf_counter() - detect_start
+        if not warmup:
+            result.frames_detected += len(frames) - skipped
+            result.frames_skipped += skipped
+        return detections
+
+    def process_batch(frames):
+        """Run YOLO once on the batch's detection frames, then blur all frames and pass them on in frame order.
+
+        Returns False if the run was cancelled or the pipeline is stopping.
+        """
+        nonlocal frame_index
+        first_index = frame_index
+        # Positions in the output video, warm-up frames come before 0
+        indices = [first_index + i - warmup_frames for i in range(len(frames))]
+        if tracker is None:
+            keyframes, keyframe_indices = frames, indices
+        else:
+            keyframe_positions = [i for i in range(len(frames)) if (first_index + i) % detect_every == 0]
+            keyframes = [frames[i] for i in keyframe_positions]
+            keyframe_indices = [indices[i] for i in keyframe_positions]
+        detections = iter(timed_detect(keyframes, keyframe_indices))
+
+        for i, frame in enumerate(frames):
+            if tracker is None:
+                current_bboxes = next(detections)
+            else:
+                if (first_index + i) % detect_every == 0:
+                    new_bboxes = next(detections)
+                elif tracker.needs_detection:
+                    # Most faces could not be followed, so detect again instead of guessing
+                    new_bboxes = timed_detect([frame], [indices[i]], gated=False)[0]
+                else:
+                    new_bboxes = None
+                # Following the boxes between detections counts as post-processing them
+                with timed(metrics, 'postprocess'):
+                    if new_bboxes is None:
+                        current_bboxes = tracker.predict(frame)
+                    else:
+                        current_bboxes = tracker.update(frame, new_bboxes)
+
+            # Add current frame's bounding boxes to the buffer
+            bbox_buffer.append(current_bboxes)
+
+            # Keep only the last few frames in the buffer
+            if len(bbox_buffer) > buffer_size:
+                bbox_buffer.pop(0)
+
+            frame_index += 1
+            if frame_index <= warmup_frames:
+                continue  # Only primes the tracker and buffer, the previous segment wrote this frame
+            result.boxes_detected += len(current_bboxes)
+
+            # Apply blur to bounding boxes from the buffer, once per face
+            with timed(metrics, 'blur'):
+                blurred_pixels = compositor.apply(frame, [bbox for bboxes in bbox_buffer for bbox in bboxes])
+            if metrics is not None:
+                metrics.count('blurred_pixels', blurred_pixels)
+                metrics.observe('boxes_per_frame', len(current_bboxes))
+
+            # Hand the frame over to the encoder
+            if not put_until_stopped(blurred_queue, frame, stop_event):
+                return False
+            result.frames_processed += 1
+
+        return not (cancel_event is not None and cancel_event.is_set())
+
+    # Collect frames so several of them go through the model in one call
+    frame_batch = []
+
+    try:
+        # Read until the video is completed
+        while not stop_event.is_set():
+            frame = get_until_stopped(decoded_queue, stop_event)
+
+            if frame is not PIPELINE_END:
+                frame_batch.append(frame)
+                if len(frame_batch) < frames_per_batch:
+                    continue
+            if frame_batch:
+                keep_going = process_batch(frame_batch)
+                if preview_callback is not None and time.time() - last_preview_time >= PREVIEW_INTERVAL:
+                    # A copy, the frame can be a slot of the reader's ring buffer that is read into again
+                    preview_callback(frame_batch[-1].copy())
+                    last_preview_time = time.time()
+                frame_batch = []
+                if progress is not None:
+                    progress.update(result.frames_processed, result.boxes_detected)
+                if metrics is not None:
+                    # Frames waiting between the stages: a full decoded queue means inference is the bottleneck
+                    metrics.observe('decoded_queue_depth', decoded_queue.qsize())
+                    metrics.observe('blurred_queue_depth', blurred_queue.qsize())
+                    metrics.tick(result.frames_processed)
+                if not keep_going:
+                    result.cancelled = True
+                    break
+                if checkpoint is not None and time.time() - last_checkpoint_time >= checkpoint_interval * 60:
+                    # Copied now, the encoder saves it once the frames before it are written
+                    state = ResumeState(frame_index, tracker, bbox_buffer, result.frames_processed,
+                                        result.boxes_detected, result.frames_detected,
+                                        time.time() - elapsed_start_time,
+                                        detection_log.to_array() if detection_log is not None else None,
+                                        result.frames_skipped, motion_gate)
+                    put_until_stopped(blurred_queue, copy.deepcopy(state), stop_event)
+                    last_checkpoint_time = time.time()
+            if frame is PIPELINE_END:
+                break
+    except Exception as e:
+        pipeline_errors.append(e)
+    finally:
+        # Let the encoder drain everything that was blurred, unless something failed
+        if pipeline_errors:
+            stop_event.set()
+        put_until_stopped(blurred_queue, PIPELINE_END, stop_event)
+        encode_thread.join()
+        # The decoder may be blocked on a full queue, so stop it before joining
+        stop_event.set()
+        decode_thread.join()
+
+        # When everything done, release the video capture and writer objects
+        cap.release()
+        out.release()
+
+    if pipeline_errors:
+        if metrics is not None:
+            metrics.close()  # What was streamed so far stays in the metrics file
+        raise pipeline_errors[0]
+    if progress is not None:
+        progress.finish(result.frames_processed, result.boxes_detected)
+
+    if detection_log is not None:
+        # Everything needed to cut, resize and track the same frames again when rendering from it
+        detection_log.save(output_path, {
+            'input_path': os.path.abspath(input_path), 'model_name': model_name, 'cascade_model': cascade_model,
+            'confidence_threshold': confidence_threshold, 'inference_size': inference_size,
+            'tile_size': 0 if cascade_model else tile_size, 'desired_class': desired_class,
+            'detect_every': detect_every, 'cut_video': cut_video, 'start_time': start_time, 'end_time': end_time,
+            'resize_video': resize_video, 'resolution': resolution, 'stream_input': stream_input, 'width': frame_width,
+            'height': frame_height, 'fps': fps, 'frames': result.frames_processed})
+
+    if result.cancelled:
+        audio_duration = result.frames_processed / fps  # Only the audio of the frames that were kept
+
+    if checkpoint is not None:
+        # Join the chunks without re-encoding, with the audio for the ffmpeg encoder
+        from segments import concat_segments
+        audio_source = video_path if keep_audio and encoder == 'ffmpeg' else None
+        with timed(metrics, 'concat'):
+            concat_segments(out.chunk_paths(), output_path, ffmpeg_path, audio_source, audio_start, audio_duration)
+        checkpoint.discard()
+
+    if keep_audio and encoder == 'ffmpeg':
+        result.audio_output_path = output_path
+    elif keep_audio:
+        with timed(metrics, 'audio'):
+            result.audio_output_path = keep_original_audio(video_path, output_path, ffmpeg_path, audio_start,
+                                                           audio_duration)
+
+    if timing_store is not None:
+        # Only this run's frames and time, a resumed checkpoint measured its own
+        record_run(timing_store, result.frames_processed - resume_state.frames_processed,
+                   result.frames_detected - resume_state.frames_detected, time.time() - run_start_time,
+                   detect_time, detect_key, other_key)
 
     # Calculate the elapsed time
-    elapsed_time = time.time() - elapsed_start_time
-    print("\n\n#######################################\n\n")
-    print("\n\nFinished processing video...\n")
-    print("Saving the output files to the same folder as the input video...")
-    print(f"Elapsed time: {round(elapsed_time/60, 2)} minutes")
-    print(f"\nOutput file with audio saved as: {os.path.basename(output_video_with_audio)}\n")
-
-else:
-    # Calculate the elapsed time
-    elapsed_time = time.time() - elapsed_start_time
-    print("\n\nFinished blurring video...\n")
-    print("Saving the output file to the same folder as the input video...")
-    print(f"Output file name: {os.path.basename(video_output_path)}")
-    if elapsed_time/60 > 120:
-        print(f"Elapsed time: {round(elapsed_time/(60*60), 2)} hours")
+    result.elapsed_time = time.time() - elapsed_start_time
+
+    if metrics is not None:
+        metrics.tick(result.frames_processed, force=True)
+        if run_report:
+            run_result = {**asdict(result), 'fps': result.fps}
+            del run_result['metrics']
+            metrics.save_report(report_path, result.frames_processed, result=run_result,
+                                settings={'model_name': model_name, 'backend': backend,
+                                          'confidence_threshold': confidence_threshold, 'batch_size': batch_size,
+                                          'detect_every': detect_every, 'inference_size': inference_size,
+                                          'blur_method': blur_method, 'encoder': encoder, 'video_codec': video_codec,
+                                          'crf': crf, 'preset': preset, 'width': frame_width,
+                                          'height': frame_height, 'fps': fps, 'resumed_from_frame':
+                                          resume_state.frame_index})
+            print(f"Run report saved as: {os.path.basename(report_path)}")
+        result.metrics = metrics.report(result.frames_processed)
+        metrics.close()
+    return result
+
+
+def preview_thumbnail(frame, width=PREVIEW_WIDTH):
+    """Copy of a frame shrunk to width, for showing the progress of a run."""
+    import cv2
+    height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def watch_for_quit(cancel_event, finished_event):
+    """Set cancel_event when 'q' is entered on the console.
+
+    This thread owns the console input while a video is processed, so it also
+    returns on the first line entered after finished_event is set, which is
+    used as the final 'press Enter' pause.
+    """
+    for line in sys.stdin:
+        if finished_event.is_set():
+            return
+        if line.strip().lower() == 'q' and not cancel_event.is_set():
+            print("\nStopping after the current batch...\n")
+            cancel_event.set()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Blur faces, heads or persons in a video using a YOLO model.")
+    parser.add_argument('--config', default=DEFAULT_CONFIG_PATH, help="Path to config.ini (default: next to this script)")
+    parser.add_argument('--input', dest='input_path', help="Video to process (overrides input_path)")
+    parser.add_argument('--output', dest='output_path', help="Output video path (default: blurred_<name> next to the video)")
+    parser.add_argument('--model', dest='model_name', help="YOLO model file (overrides yolo_model)")
+    parser.add_argument('--threshold', dest='confidence_threshold', type=float, help="Confidence threshold (overrides threshold)")
+    parser.add_argument('--batch-size', type=int, help="Frames per YOLO call (overrides batch_size)")
+    parser.add_argument('--detect-every', type=int, help="Run YOLO on every Nth frame and track boxes in between (overrides detect_every)")
+    parser.add_argument('--workers', type=int, help="Blur segments of the video in this many worker processes (overrides workers)")
+    parser.add_argument('--inference-size', type=int, help="Longest side of the frames YOLO sees, e.g. 640, 960 or 1280 (overrides inference_size)")
+    parser.add_argument('--backend', choices=['pytorch', 'onnx', 'openvino'], help="Inference runtime (overrides backend)")
+    parser.add_argument('--cascade', dest='cascade_model', metavar='PERSON_MODEL',
+                        help="Find persons with this model first and run the model only on them (overrides person_model)")
+    parser.add_argument('--tile-size', type=int,
+                        help="Also run the model on overlapping tiles of this many pixels, e.g. 1280 for 4K, 0 = off (overrides tile_size)")
+    parser.add_argument('--motion-threshold', type=float,
+                        help="Skip the model on frames where less than this percent changed, 0 = off (overrides threshold)")
+    parser.add_argument('--blur-method', help="Anonymization method: gaussian, box, pixelate, downscale or fill "
+                                              "(overrides the config)")
+    parser.add_argument('--scale-factor', dest='blur_scale', type=float, help="Enlarge every box by this factor before blurring")
+    parser.add_argument('--buffer-frames', dest='blur_buffer', type=int, help="Blur the boxes of this many frames onto each frame")
+    parser.add_argument('--render', metavar='DETECTIONS',
+                        help="Blur again from a .detections.npy file of an earlier run instead of running the model")
+    parser.add_argument('--ffmpeg', dest='ffmpeg_path', help="Path to the ffmpeg executable")
+    parser.add_argument('--cut', nargs=2, metavar=('START', 'END'), help="Cut the video from START to END (MM:SS)")
+    parser.add_argument('--no-cut', action='store_true', help="Process the whole video even if cut_video is set")
+    parser.add_argument('--resize', dest='resolution', choices=['480p', '720p', '1080p'], help="Resize the video before blurring")
+    parser.add_argument('--stream-input', action='store_true', default=None,
+                        help="Cut/resize with ffmpeg while decoding instead of writing cut_/resized_ files")
+    parser.add_argument('--prepare-only', action='store_true',
+                        help="Only write the cut_/resized_ file and exit, without loading the model")
+    parser.add_argument('--encoder', choices=['ffmpeg', 'opencv'], help="Write the output with an ffmpeg pipe or OpenCV's mp4v writer")
+    parser.add_argument('--crf', type=int, help="Constant rate factor for the ffmpeg encoder, lower is better quality")
+    parser.add_argument('--preset', help="x264/x265 preset for the ffmpeg encoder, e.g. veryfast or medium")
+    parser.add_argument('--keep-audio', action='store_true', default=None, help="Keep the original audio")
+    parser.add_argument('--checkpoint-interval', type=float, metavar='MINUTES',
+                        help="Save a checkpoint to resume from this often, 0 = never (overrides interval)")
+    parser.add_argument('--fresh', action='store_true', help="Start over instead of resuming from a checkpoint")
+    parser.add_argument('--recalibrate', action='store_true',
+                        help="Time the model on this machine again before estimating, e.g. after a hardware change")
+    parser.add_argument('--run-report', action='store_true', default=None,
+                        help="Save stage timings, counters and fps over time as <output>.report.json")
+    parser.add_argument('--stream-metrics', action='store_true', default=None,
+                        help="Append the metrics to <output>.metrics.jsonl every few seconds while running")
+    parser.add_argument('--daemon', action='store_true', default=None,
+                        help="Run in the background daemon that keeps the model loaded, starting it if needed")
+    parser.add_argument('--yes', '-y', dest='headless', action='store_true',
+                        help="Run unattended: no prompts, no notifications and no pause at the end")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    render_settings = None
+    if args.render:
+        from detection_log import read_detection_settings
+        render_settings = read_detection_settings(args.render)
+    # The blur method is looked up for the model the detections were made with
+    options = load_config(args.config, model_name=args.model_name or (render_settings or {}).get('model_name'))
+
+    # Command line arguments override the config file
+    for key in ('input_path', 'output_path', 'model_name', 'confidence_threshold', 'batch_size', 'detect_every',
+                'workers', 'inference_size', 'backend', 'cascade_model', 'tile_size', 'motion_threshold',
+                'blur_method', 'blur_scale', 'blur_buffer', 'ffmpeg_path', 'stream_input', 'encoder', 'crf', 'preset',
+                'keep_audio', 'checkpoint_interval', 'run_report', 'stream_metrics', 'daemon'):
+        value = getattr(args, key)
+        if value is not None:
+            options[key] = value
+    if args.cut:
+        options.update(cut_video=True, start_time=args.cut[0], end_time=args.cut[1])
+    if args.no_cut:
+        options['cut_video'] = False
+    if args.resolution:
+        options.update(resize_video=True, resolution=args.resolution)
+    if args.prepare_only:
+        # The alternative usage: cut and/or resize without blurring, so the model is never imported
+        if not (options['cut_video'] or options['resize_video']):
+            print("Error: nothing to prepare, set cut_video or resize_video (or pass --cut or --resize)")
+            return 1
+        try:
+            video_path = prepare_video(options['input_path'], options['ffmpeg_path'], options['cut_video'],
+                                       options['start_time'], options['end_time'], options['resize_video'],
+                                       options['resolution'])
+        except (IOError, ValueError, subprocess.CalledProcessError) as e:
+            print(f"Error: {e}")
+            return 1
+        print(f"Output file name: {os.path.basename(video_path)}")
+        return 0
+    if args.fresh:
+        options['resume'] = False
+    if args.recalibrate:
+        options['recalibrate'] = True
+    if render_settings is not None:
+        # Decode and track exactly the frames the detections were made on
+        for key in ('input_path', 'cut_video', 'start_time', 'end_time', 'resize_video', 'resolution',
+                    'stream_input', 'detect_every'):
+            options[key] = render_settings[key]
+        options.update(render_from=args.render, workers=1)
+
+    cancel_event = threading.Event()
+    finished_event = threading.Event()
+    quit_watcher = threading.Thread(target=watch_for_quit, args=(cancel_event, finished_event), daemon=True)
+    confirm = None
+    if not args.headless:
+        def confirm(estimated_time):
+            # Ask user if they want to continue
+            print("\n")  # Optional: Add a newline for clarity
+            user_input = input("Tap 'Enter' three times to accept or exit the program").strip().lower()
+            if user_input != '':
+                print("Exiting the program.")
+                return False
+            print("Type 'q' and press 'Enter' to stop early and keep what has been blurred so far.")
+            quit_watcher.start()
+            return True
+
+    workers = options.pop('workers')
+    threads_per_worker = options.pop('threads_per_worker')
+    use_daemon = options.pop('daemon')
+    try:
+        if use_daemon:
+            import daemon
+            daemon.start_daemon(args.config)
+            if workers > 1 and confirm is not None and not confirm(None):
+                return 0
+
+            def show_progress(progress):
+                sys.stdout.write('\r' + format_progress(progress).ljust(60))
+                sys.stdout.flush()
+            result = daemon.submit_job(options, confirm=confirm if workers <= 1 else None, cancel_event=cancel_event,
+                                       on_progress=show_progress, workers=workers,
+                                       threads_per_worker=threads_per_worker)
+            print()
+        elif workers > 1:
+            from segments import process_video_parallel
+            if confirm is not None and not confirm(None):
+                return 0
+            result = process_video_parallel(workers=workers, threads_per_worker=threads_per_worker,
+                                            cancel_event=cancel_event, **options)
+        else:
+            result = process_video(confirm=confirm, cancel_event=cancel_event, **options)
+    except (IOError, ValueError, subprocess.CalledProcessError) as e:
+        # Also a daemon that cannot be started (ConnectionError is an OSError)
+        print(f"Error: {e}")
+        return 1
+    if result.output_path is None:
+        return 0
+
+    elapsed_time = result.elapsed_time
+    if result.audio_output_path:
+        print("\n\n#######################################\n\n")
+        print("\n\nFinished processing video...\n")
+        print("Saving the output files to the same folder as the input video...")
+        print(f"Elapsed time: {round(elapsed_time/60, 2)} minutes")
+        print(f"\nOutput file with audio saved as: {os.path.basename(result.audio_output_path)}\n")
     else:
-        print(f"Elapsed time: {round(elapsed_time/60, 2)} minutes\n")
-
-# Closes all the frames
-cv2.destroyAllWindows()
-
-# After the video processing is completed
-# toast = ToastNotifier()
-# toast.show_toast("Video Processing", "Processing completed successfully!", duration=10, threaded=True)
-
-flash_console_icon(count=10)
-play_notification_sound()  # Play a notification sound (optional)
-
-# Add this line to pause the console
-input("Press 'Enter' to exit the program... ")  # This will keep the console open until you press Enter
+        print("\n\nFinished blurring video...\n")
+        print("Saving the output file to the same folder as the input video...")
+        print(f"Output file name: {os.path.basename(result.output_path)}")
+        if elapsed_time/60 > 120:
+            print(f"Elapsed time: {round(elapsed_time/(60*60), 2)} hours")
+        else:
+            print(f"Elapsed time: {round(elapsed_time/60, 2)} minutes\n")
+    print(f"Processed {result.frames_processed} of {result.total_frames} frames ({round(result.fps, 2)} fps), "
+          f"{result.frames_detected} of them through the model")
+    if result.frames_skipped:
+        print(f"The motion gate skipped the model on {result.frames_skipped} static frames")
+
+    if not args.headless:
+        # After the video processing is completed
+        # toast = ToastNotifier()
+        # toast.show_toast("Video Processing", "Processing completed successfully!", duration=10, threaded=True)
+
+        # Flash the console icon and play a sound, where the system has them (Windows)
+        from notifications import notify_finished
+        notify_finished(count=10)
+
+        # Pause the console until Enter is pressed; the quit watcher owns the input if it is running
+        finished_event.set()
+        if quit_watcher.is_alive():
+            print("Press 'Enter' to exit the program... ")
+            quit_watcher.join()
+        else:
+            input("Press 'Enter' to exit the program... ")  # This will keep the console open until you press Enter
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())